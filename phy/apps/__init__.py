@@ -8,6 +8,7 @@
 #------------------------------------------------------------------------------
 
 from contextlib import contextmanager
+from importlib import import_module
 import logging
 from pathlib import Path
 import sys
@@ -19,16 +20,24 @@ from phylib import add_default_handler, _Formatter   # noqa
 from phylib import _logger_date_fmt, _logger_fmt   # noqa
 
 from phy import __version_git__
-from phy.gui.qt import QtDialogLogger
+from phy.cluster.clustering import Clustering
 from phy.utils.profiling import _enable_profiler, _enable_pdb
 
-from .base import (  # noqa
-    BaseController, WaveformMixin, FeatureMixin, TemplateMixin, TraceMixin)
-
 
 logger = logging.getLogger(__name__)
 
 
+# NOTE: the controllers depend on Qt, they are only imported when they are used, so that the
+# commands without GUI can run on a machine without display.
+_LAZY = ('BaseController', 'WaveformMixin', 'FeatureMixin', 'TemplateMixin', 'TraceMixin')
+
+
+def __getattr__(name):
+    if name not in _LAZY:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    return getattr(import_module('.base', __name__), name)
+
+
 #------------------------------------------------------------------------------
 # CLI utils
 #------------------------------------------------------------------------------
@@ -37,6 +46,8 @@ DEBUG = False
 if '--debug' in sys.argv:  # pragma: no cover
     DEBUG = True
     sys.argv.remove('--debug')
+    # Check the incremental cluster structures after every clustering change.
+    Clustering.check_consistency = True
 
 
 if '--pdb' in sys.argv:  # pragma: no cover
@@ -65,6 +76,7 @@ def exceptionHandler(exception_type, exception, traceback):  # pragma: no cover
 @contextmanager
 def capture_exceptions():  # pragma: no cover
     """Log exceptions instead of crashing the GUI, and display an error dialog on errors."""
+    from phy.gui.qt import QtDialogLogger
     logger.debug("Start capturing exceptions.")
 
     # Add a custom exception hook.
@@ -146,6 +158,8 @@ def cli_trace_gui(ctx, dat_path, **kwargs):
 @phycli.command('template-gui')  # pragma: no cover
 @click.argument('params-path', type=click.Path(exists=True))
 @_gui_command
+@click.option('--low-memory/--no-low-memory', default=False,
+              help="Memory-map the spike clusters, for very large datasets.")
 @click.pass_context
 def cli_template_gui(ctx, params_path, **kwargs):
     """Launch the template GUI on a params.py file."""
@@ -158,6 +172,25 @@ def cli_template_gui(ctx, params_path, **kwargs):
         template_gui(params_path, **kwargs)
 
 
+@phycli.command('curate')
+@click.argument('params-path', type=click.Path(exists=True))
+@click.argument('script-path', type=click.Path(exists=True))
+@click.option('--save/--no-save', default=True, help="Save the clustering after the script.")
+@click.option('--clear-cache/--no-clear-cache', default=False,
+              help="Clear the .phy cache in the data directory.")
+@click.option('--low-memory/--no-low-memory', default=False,
+              help="Memory-map the spike clusters, for very large datasets.")
+@click.pass_context
+def cli_curate(ctx, params_path, script_path, **kwargs):
+    """Run a curation script on a params.py file, without GUI.
+
+    The script has access to the `session` and `model` global variables.
+
+    """
+    from .curate import template_curate
+    template_curate(params_path, script_path, **kwargs)
+
+
 @phycli.command('template-describe')
 @click.argument('params-path', type=click.Path(exists=True))
 @click.pass_context
@@ -167,6 +200,16 @@ def cli_template_describe(ctx, params_path):
     template_describe(params_path)
 
 
+@phycli.command('compute-raw-amplitudes')
+@click.argument('params-path', type=click.Path(exists=True))
+@click.option('-j', '--n-jobs', type=int, help="Number of parallel jobs.")
+@click.pass_context
+def cli_template_compute_raw_amplitudes(ctx, params_path, n_jobs=None):
+    """Compute the raw amplitudes of all spikes, for the amplitude view."""
+    from .template.gui import template_compute_raw_amplitudes
+    template_compute_raw_amplitudes(params_path, n_jobs=n_jobs)
+
+
 #------------------------------------------------------------------------------
 # Kwik GUI
 #------------------------------------------------------------------------------
@@ -0,0 +1,747 @@
+# -*- coding: utf-8 -*-
+
+"""Jobs streaming the raw data."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import os
+from pathlib import Path
+import pickle
+from threading import Lock
+
+import joblib
+import mtscomp
+import numpy as np
+from scipy.signal import butter, sosfiltfilt
+
+from phy.utils.context import SingleFlight
+
+logger = logging.getLogger(__name__)
+
+
+#------------------------------------------------------------------------------
+# Utils
+#------------------------------------------------------------------------------
+
+def _read_padded(traces, t0, t1, channel_ids=None):
+    """Read the raw data between two samples as float32, padded with zeros outside of the
+    recording as in `phylib.io.traces.extract_waveforms()`."""
+    n = traces.shape[0]
+    data = np.asarray(traces[max(0, t0):max(0, min(n, t1))])
+    if channel_ids is not None:
+        data = data[:, channel_ids]
+    if t0 < 0 or t1 > n:
+        data = np.pad(
+            data, ((max(0, -t0), max(0, t1 - max(n, t0))), (0, 0)), mode='constant')
+    return data.astype(np.float32)
+
+
+#------------------------------------------------------------------------------
+# Preprocessing pipeline
+#------------------------------------------------------------------------------
+
+class PreprocessingStage(object):
+    """A stage of a preprocessing pipeline, processing raw data where the channels are on the
+    last axis.
+
+    A stage may process its input in place. The `margin` is the number of samples that must be
+    read on both sides of a chunk for the stage to be exact on the chunk. A stage that
+    `needs_all_channels` is only applied to arrays with the `n_channels` channels of the
+    recording, and it is skipped on arrays with a subset of the channels.
+
+    """
+    margin = 0
+    needs_all_channels = False
+    n_channels = None
+
+    def __call__(self, arr, axis=0):
+        raise NotImplementedError()
+
+
+class CommonAverageReference(PreprocessingStage):
+    """Subtract the median or the mean across channels from every sample."""
+    needs_all_channels = True
+
+    def __init__(self, n_channels=None, kind='median'):
+        assert kind in ('median', 'mean')
+        self.n_channels = n_channels
+        self.kind = kind
+
+    def __call__(self, arr, axis=0):
+        f = np.median if self.kind == 'median' else np.mean
+        arr -= f(arr, axis=-1, keepdims=True).astype(arr.dtype)
+        return arr
+
+
+class SosFilter(PreprocessingStage):
+    """Zero-phase Butterworth filter, with coefficients computed once as second-order
+    sections.
+
+    Constructor
+    -----------
+
+    sample_rate : float
+        The sampling rate, in Hz.
+    low : float
+        The low cutoff frequency in Hz, or None for a low-pass filter.
+    high : float
+        The high cutoff frequency in Hz, or None for a high-pass filter.
+    order : int
+        The order of the filter.
+    margin : int
+        The number of samples read on both sides of every chunk, by default twice the period
+        of the lowest cutoff frequency.
+
+    """
+
+    def __init__(self, sample_rate, low=None, high=None, order=3, margin=None):
+        assert low or high
+        if low and high:
+            wn, btype = (low, high), 'bandpass'
+        elif low:
+            wn, btype = low, 'highpass'
+        else:
+            wn, btype = high, 'lowpass'
+        self.sos = butter(order, wn, btype, fs=sample_rate, output='sos')
+        self.margin = margin if margin is not None else int(2 * sample_rate / (low or high))
+
+    def __call__(self, arr, axis=0):
+        n = arr.shape[axis]
+        if n < 2:
+            return arr
+        padlen = min(3 * (2 * len(self.sos) + 1), n - 1)
+        return sosfiltfilt(self.sos, arr, axis=axis, padlen=padlen).astype(np.float32)
+
+
+class Whitening(PreprocessingStage):
+    """Multiply the channels by a whitening matrix."""
+    needs_all_channels = True
+
+    def __init__(self, wm):
+        self.wm = np.asarray(wm, dtype=np.float32)
+        assert self.wm.ndim == 2 and self.wm.shape[0] == self.wm.shape[1]
+        self.n_channels = self.wm.shape[0]
+
+    def __call__(self, arr, axis=0):
+        return arr @ self.wm
+
+
+class Pipeline(object):
+    """Sequence of preprocessing stages, usable as a raw data filter `(arr, axis) => arr`.
+
+    The input is copied once in a float32 buffer, which is then processed by the successive
+    stages. The margin of the pipeline is the sum of the margins of its stages.
+
+    Constructor
+    -----------
+
+    stages : list
+        A list of `PreprocessingStage` instances.
+
+    """
+
+    def __init__(self, stages):
+        self.stages = list(stages)
+        self.margin = sum(s.margin for s in self.stages)
+        self.needs_all_channels = any(s.needs_all_channels for s in self.stages)
+
+    def __call__(self, arr, axis=0):
+        arr = np.array(arr, dtype=np.float32)
+        for stage in self.stages:
+            if stage.needs_all_channels and arr.shape[-1] != stage.n_channels:
+                continue
+            arr = stage(arr, axis=axis)
+        return arr
+
+    def process(self, traces, t0, t1, channel_ids=None):
+        """Read and process the raw data between two samples, with the margins, and return the
+        `(t1 - t0, n_channels)` processed data."""
+        m = self.margin
+        cols = None if self.needs_all_channels else channel_ids
+        data = self(_read_padded(traces, t0 - m, t1 + m, cols), axis=0)[m:m + t1 - t0]
+        if self.needs_all_channels and channel_ids is not None:
+            data = data[:, channel_ids]
+        return data
+
+    def iter_chunks(self, traces, t0, t1, chunk_size, channel_ids=None):
+        """Yield the `(t0, t1, data)` processed data of successive chunks."""
+        for c0 in range(t0, t1, chunk_size):
+            c1 = min(t1, c0 + chunk_size)
+            yield c0, c1, self.process(traces, c0, c1, channel_ids=channel_ids)
+
+
+#------------------------------------------------------------------------------
+# Spike raw amplitudes
+#------------------------------------------------------------------------------
+
+def _spike_chunks(spike_samples, chunk_size):
+    """Return the `(start, end)` indices of consecutive groups of sorted spikes, every group
+    spanning at most `chunk_size` samples."""
+    if not len(spike_samples):
+        return []
+    edges = np.arange(spike_samples[0], spike_samples[-1] + 1, chunk_size)
+    bounds = np.unique(np.r_[np.searchsorted(spike_samples, edges), len(spike_samples)])
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _chunk_raw_amplitudes(traces, spike_samples, spike_channels, n_samples_waveforms, filter):
+    """Return the raw amplitude of sorted spikes, reading a single chunk of raw data."""
+    nsw = n_samples_waveforms
+    a, b = nsw // 2, nsw - nsw // 2
+    # Chunk of raw data containing the waveforms of all spikes, with the margins of the
+    # filter, filtered along the time axis as in `WaveformExtractor.extract()`.
+    m = getattr(filter, 'margin', 0) if filter is not None else 0
+    t0, t1 = int(spike_samples[0]) - a - m, int(spike_samples[-1]) + b + m
+    data = _read_padded(traces, t0, t1)
+    if filter is not None:
+        data = filter(data, axis=0)
+    # Waveform of every spike on its own channel.
+    rows = (spike_samples - t0)[:, np.newaxis] + np.arange(-a, b)[np.newaxis, :]
+    waveforms = data[rows, spike_channels[:, np.newaxis]]
+    assert waveforms.shape == (len(spike_samples), nsw)
+    return waveforms.max(axis=1) - waveforms.min(axis=1)
+
+
+def compute_spike_raw_amplitudes(
+        traces, spike_samples, spike_channels, n_samples_waveforms, filter=None,
+        chunk_size=30000, n_jobs=None):
+    """Compute the raw amplitude of every spike on a given channel.
+
+    The amplitude of a spike is the peak-to-peak amplitude of its filtered waveform on its
+    channel, as computed by `WaveformMixin.get_spike_raw_amplitudes()`.
+
+    Parameters
+    ----------
+
+    traces : array-like
+        The `(n_samples, n_channels)` raw data.
+    spike_samples : array-like
+        The sample of every spike.
+    spike_channels : array-like
+        The channel of every spike.
+    n_samples_waveforms : int
+        The number of samples of the waveforms.
+    filter : function
+        The function `(data, axis) => filtered_data` applied to every chunk of raw data,
+        along the time axis. The `margin` attribute of the filter, if any, is the number of
+        extra samples read on both sides of every chunk.
+    chunk_size : int
+        The number of samples of the chunks of raw data processed by every task.
+    n_jobs : int
+        The number of threads processing the chunks in parallel, by default the number
+        of CPUs.
+
+    Returns
+    -------
+
+    amplitudes : array
+        The `(n_spikes,)` float32 array of amplitudes.
+
+    """
+    spike_samples = np.asarray(spike_samples, dtype=np.int64)
+    spike_channels = np.asarray(spike_channels, dtype=np.int64)
+    assert spike_samples.shape == spike_channels.shape
+    # The raw data is streamed in chronological order.
+    order = np.argsort(spike_samples, kind='mergesort')
+    spike_samples, spike_channels = spike_samples[order], spike_channels[order]
+    chunks = _spike_chunks(spike_samples, chunk_size)
+    logger.info(
+        "Computing the raw amplitudes of %d spikes in %d chunks.", len(order), len(chunks))
+
+    def _process(chunk):
+        i0, i1 = chunk
+        return _chunk_raw_amplitudes(
+            traces, spike_samples[i0:i1], spike_channels[i0:i1], n_samples_waveforms, filter)
+
+    amplitudes = np.zeros(len(order), dtype=np.float32)
+    # NOTE: the tasks spend most of their time reading and filtering the raw data, which
+    # releases the GIL, and the raw data readers do not need to be pickled.
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        for (i0, i1), out in zip(chunks, executor.map(_process, chunks)):
+            amplitudes[order[i0:i1]] = out
+    return amplitudes
+
+
+#------------------------------------------------------------------------------
+# Batched waveform extraction
+#------------------------------------------------------------------------------
+
+def _coalesce(starts, ends, max_gap, max_block_size):
+    """Group sorted intervals into blocks of contiguous reads. Return the `(t0, t1, i0, i1)`
+    sample range and interval range of every block."""
+    blocks = []
+    i0 = 0
+    for i in range(1, len(starts) + 1):
+        if i < len(starts) and (
+                starts[i] - ends[i - 1] <= max_gap and ends[i] - starts[i0] <= max_block_size):
+            continue
+        blocks.append((int(starts[i0]), int(ends[i - 1]), i0, i))
+        i0 = i
+    return blocks
+
+
+class WaveformExtractor(object):
+    """Extract the filtered waveforms of several sets of spikes in a single pass over the
+    raw data.
+
+    The requested spikes are merged and sorted by sample, and the spikes that are close to
+    each other are read with a single contiguous read. Every block of raw data is filtered
+    once, and the waveforms are then scattered back to every request. The next blocks are
+    read in a background thread while the current one is being filtered.
+
+    Constructor
+    -----------
+
+    traces : array-like
+        The `(n_samples, n_channels)` raw data.
+    n_samples_waveforms : int
+        The number of samples of the waveforms.
+    margin : int
+        The number of extra samples read on both sides of every block, to avoid filtering
+        edge effects. By default, this is the number of samples of the waveforms.
+    max_gap : int
+        The maximum number of samples between two waveforms read in the same block.
+    max_block_size : int
+        The maximum number of samples of a block.
+    readahead : int
+        The number of blocks read in advance.
+
+    """
+
+    def __init__(
+            self, traces, n_samples_waveforms, margin=None, max_gap=1024,
+            max_block_size=32768, readahead=2):
+        self.traces = traces
+        self.n_samples_waveforms = n_samples_waveforms
+        self.margin = margin if margin is not None else n_samples_waveforms
+        self.max_gap = max_gap
+        self.max_block_size = max_block_size
+        self.readahead = readahead
+
+    def _read(self, t0, t1, channel_ids):
+        """Read a block of raw data, padded with zeros outside of the recording."""
+        return _read_padded(self.traces, t0, t1, channel_ids)
+
+    def _iter_blocks(self, blocks, channel_ids):
+        """Yield the data of successive blocks, reading the next blocks in the background."""
+        if not self.readahead:
+            for t0, t1, _, _ in blocks:
+                yield self._read(t0, t1, channel_ids)
+            return
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            pending = deque()
+            for t0, t1, _, _ in blocks:
+                pending.append(executor.submit(self._read, t0, t1, channel_ids))
+                if len(pending) > self.readahead:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+
+    def extract(self, requests, filter=None):
+        """Extract the waveforms of several sets of spikes.
+
+        Parameters
+        ----------
+
+        requests : list
+            A list of `(spike_samples, channel_ids)` pairs.
+        filter : function
+            The function `(data, axis) => filtered_data` applied to every block of raw data,
+            along the time axis. The `margin` attribute of the filter, if larger than the
+            margin of the extractor, is used instead. If the `needs_all_channels` attribute of
+            the filter is true, the blocks are read on all channels.
+
+        Returns
+        -------
+
+        waveforms : list
+            The `(n_spikes, n_samples_waveforms, n_channels)` float32 array of every request.
+
+        """
+        nsw = self.n_samples_waveforms
+        a, b = nsw // 2, nsw - nsw // 2
+        samples = [np.asarray(s, dtype=np.int64).ravel() for s, _ in requests]
+        channels = [np.asarray(c, dtype=np.int64).ravel() for _, c in requests]
+        if not requests or not sum(len(s) for s in samples):
+            return [np.zeros((len(s), nsw, len(c)), dtype=np.float32)
+                    for s, c in zip(samples, channels)]
+        # Union of the spikes, sorted by sample, and union of the channels.
+        union, inv = np.unique(np.concatenate(samples), return_inverse=True)
+        channel_ids = np.unique(np.concatenate(channels))
+        all_channels = getattr(filter, 'needs_all_channels', False)
+        # Waveform windows with the margins, grouped into blocks of contiguous reads.
+        m = max(self.margin, getattr(filter, 'margin', 0) or 0)
+        blocks = _coalesce(union - a - m, union + b + m, self.max_gap, self.max_block_size)
+        logger.log(
+            5, "Extract %d waveforms on %d channels in %d blocks.",
+            len(union), len(channel_ids), len(blocks))
+        out = np.zeros((len(union), nsw, len(channel_ids)), dtype=np.float32)
+        blocks_data = self._iter_blocks(blocks, None if all_channels else channel_ids)
+        for (t0, t1, i0, i1), data in zip(blocks, blocks_data):
+            if filter is not None:
+                data = filter(data, axis=0)
+            if all_channels:
+                data = data[:, channel_ids]
+            rows = (union[i0:i1] - t0)[:, np.newaxis] + np.arange(-a, b)[np.newaxis, :]
+            out[i0:i1] = data[rows]
+        # Scatter the waveforms back to the requests.
+        offsets = np.cumsum([0] + [len(s) for s in samples])
+        return [
+            out[inv[o0:o1]][..., np.searchsorted(channel_ids, c)]
+            for o0, o1, c in zip(offsets[:-1], offsets[1:], channels)]
+
+
+#------------------------------------------------------------------------------
+# Filtered chunk cache
+#------------------------------------------------------------------------------
+
+def _quantize(data):
+    """Return the int16 data and the float32 per-channel scale approximating float data."""
+    data = np.asarray(data, dtype=np.float32)
+    scales = (np.abs(data).max(axis=0, initial=0) / 32767).astype(np.float32)
+    scales[scales == 0] = 1
+    return np.round(data / scales).astype(np.int16), scales
+
+
+def _dequantize(data, scales):
+    """Return the float32 data from the int16 data and the per-channel scale."""
+    return data.astype(np.float32) * scales
+
+
+class ChunkCache(object):
+    """Bounded on-disk store of chunks of float data, with least-recently-used eviction.
+
+    Every chunk is stored in its own file as int16 with a per-channel scale. The access times
+    of the files are updated when they are read, so that the eviction order is kept between
+    sessions.
+
+    Constructor
+    -----------
+
+    path : str or Path
+        The directory of the chunk files.
+    max_size : int
+        The maximum total size of the chunk files, in bytes.
+
+    """
+
+    def __init__(self, path, max_size):
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self.max_size = max_size
+        self._lock = Lock()
+        # Size of every chunk file, as `{file_name: size}`, least recently used first.
+        self._index = OrderedDict()
+        for p in sorted(self.path.glob('*.npz'), key=lambda p: p.stat().st_mtime):
+            self._index[p.name] = p.stat().st_size
+        self.size = sum(self._index.values())
+
+    def _name(self, key):
+        return '-'.join(map(str, key)) + '.npz'
+
+    def _discard(self, name):
+        self.size -= self._index.pop(name, 0)
+        try:
+            (self.path / name).unlink()
+        except OSError:  # pragma: no cover
+            pass
+
+    def __contains__(self, key):
+        return self._name(key) in self._index
+
+    def get(self, key):
+        """Return the float32 data of a chunk, or None if it is not in the cache."""
+        name = self._name(key)
+        with self._lock:
+            if name not in self._index:
+                return None
+            self._index.move_to_end(name)
+        path = self.path / name
+        try:
+            with np.load(path) as f:
+                data, scales = f['data'], f['scales']
+            os.utime(path)
+        except (OSError, ValueError, KeyError):  # pragma: no cover
+            logger.debug("Discarding the corrupted chunk %s.", path)
+            with self._lock:
+                self._discard(name)
+            return None
+        return _dequantize(data, scales)
+
+    def put(self, key, data):
+        """Store the data of a chunk, evict the least recently used chunks if needed, and
+        return the data as it is read back from the cache."""
+        data, scales = _quantize(data)
+        name = self._name(key)
+        path = self.path / name
+        # The chunk is written in a temporary file first, as it may be read concurrently.
+        tmp = self.path / (name + '.tmp%d' % os.getpid())
+        with open(tmp, 'wb') as f:
+            np.savez(f, data=data, scales=scales)
+        os.replace(tmp, path)
+        size = path.stat().st_size
+        with self._lock:
+            self.size += size - self._index.pop(name, 0)
+            self._index[name] = size
+            while self.size > self.max_size and len(self._index) > 1:
+                self._discard(next(iter(self._index)))
+        return _dequantize(data, scales)
+
+
+def _filter_hash(filter, traces):
+    """Return a hash of the parameters of a filter, and of the shape and dtype of the raw data,
+    which identifies the filtered chunks in the chunk cache across sessions.
+
+    Filters such as `Pipeline` instances are hashed with all of their attributes (coefficients,
+    margin, whitening matrix...). Functions are hashed with their name, their code, and the
+    variables of their closure.
+
+    """
+    code = getattr(filter, '__code__', None)
+    cells = tuple(c.cell_contents for c in getattr(filter, '__closure__', None) or ())
+    try:
+        params = joblib.hash((filter, cells))
+    except (pickle.PicklingError, TypeError, AttributeError):
+        # Lambdas and local functions cannot be pickled.
+        params = repr(cells)
+    return joblib.hash((
+        params, getattr(filter, '__qualname__', None), getattr(code, 'co_code', None),
+        getattr(filter, 'margin', 0), tuple(traces.shape), np.dtype(traces.dtype).str))[:16]
+
+
+class CachedFilteredTraces(object):
+    """Array-like view of the filtered raw data, read in fixed-size chunks from a
+    `ChunkCache`.
+
+    A chunk is filtered with the margins of the filter the first time it is read, and it is
+    then stored in the cache. Only slices along the time axis, optionally followed by a
+    channel index, are supported.
+
+    Constructor
+    -----------
+
+    traces : array-like
+        The `(n_samples, n_channels)` raw data.
+    filter : function
+        The function `(data, axis) => filtered_data`. The `margin` attribute of the filter, if
+        any, is the number of extra samples read on both sides of every chunk.
+    cache : ChunkCache
+        The chunk store.
+    name : str
+        The name of the filter, which is part of the keys of the chunks in the store, along with
+        a hash of the parameters of the filter and of the shape and dtype of the raw data.
+    chunk_size : int
+        The number of samples of the chunks.
+
+    """
+
+    def __init__(self, traces, filter, cache, name, chunk_size=30000):
+        self.traces = traces
+        self.filter = filter
+        self.cache = cache
+        self.name = name
+        self.chunk_size = chunk_size
+        self.shape = traces.shape
+        self.ndim = 2
+        self.dtype = np.dtype(np.float32)
+        self._flight = SingleFlight()
+        self._hash = _filter_hash(filter, traces)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _compute(self, i):
+        cs = self.chunk_size
+        t0, t1 = i * cs, min(self.shape[0], (i + 1) * cs)
+        m = getattr(self.filter, 'margin', 0) or 0
+        data = _read_padded(self.traces, t0 - m, t1 + m)
+        if self.filter is not None:
+            data = self.filter(data, axis=0)
+        return data[m:m + t1 - t0]
+
+    def _load(self, i):
+        key = (self.name, self._hash, self.chunk_size, i)
+        data = self.cache.get(key)
+        if data is None:
+            logger.log(5, "Filtering the chunk %d of the raw data with `%s`.", i, self.name)
+            data = self.cache.put(key, self._compute(i))
+        return data
+
+    def chunk(self, i):
+        """Return the filtered data of a chunk."""
+        return self._flight.do(i, self._load, i)
+
+    def __getitem__(self, item):
+        rows, cols = item if isinstance(item, tuple) else (item, slice(None))
+        assert isinstance(rows, slice)
+        start, stop, step = rows.indices(self.shape[0])
+        assert step == 1
+        if stop <= start:
+            return np.zeros((0, self.shape[1]), dtype=np.float32)[:, cols]
+        cs = self.chunk_size
+        i0, i1 = start // cs, (stop - 1) // cs + 1
+        data = [self.chunk(i) for i in range(i0, i1)]
+        data = data[0] if len(data) == 1 else np.concatenate(data)
+        return data[start - i0 * cs:stop - i0 * cs][:, cols]
+
+
+#------------------------------------------------------------------------------
+# Decompressed chunk cache
+#------------------------------------------------------------------------------
+
+class DecompressedChunkCache(object):
+    """Array-like view of an mtscomp compressed file, with a shared LRU cache of the
+    decompressed chunks.
+
+    The chunks needed by a read are decompressed in parallel in a thread pool, and the chunks
+    following the read, in the direction of the successive reads, are decompressed in the
+    background. The cache is thread-safe, and a chunk requested by several threads at the same
+    time is only decompressed once. The other attributes are those of the mtscomp reader.
+
+    Constructor
+    -----------
+
+    reader : mtscomp.Reader
+        The reader of the compressed file.
+    max_size : int
+        The maximum size of the decompressed chunks kept in memory, in bytes.
+    n_threads : int
+        The number of decompression threads, by default the number of CPUs.
+    prefetch : int
+        The number of chunks decompressed in advance after every read.
+
+    """
+
+    def __init__(self, reader, max_size=512 * 1024 ** 2, n_threads=None, prefetch=2):
+        assert isinstance(reader, mtscomp.Reader)
+        self.reader = reader
+        self.max_size = max_size
+        self.n_threads = n_threads
+        self.prefetch = prefetch
+        self._lock = Lock()
+        # Decompressed chunks, as `{chunk_idx: array}`, least recently used first.
+        self._chunks = OrderedDict()
+        self.size = 0
+        self._flight = SingleFlight()
+        self._pool = None
+        self._last_chunk = None
+        self._prefetching = []
+
+    def __getattr__(self, name):
+        # Only called for the attributes that are not defined here.
+        if name == 'reader':  # pragma: no cover
+            raise AttributeError(name)
+        return getattr(self.reader, name)
+
+    def __len__(self):
+        return self.reader.n_samples
+
+    @property
+    def pool(self):
+        """The thread pool decompressing the chunks."""
+        if self._pool is None:
+            self._pool = ThreadPoolExecutor(max_workers=self.n_threads)
+        return self._pool
+
+    def _decompress(self, chunk_idx):
+        r = self.reader
+        start = r.chunk_offsets[chunk_idx]
+        # NOTE: bypass the LRU cache of the mtscomp reader, the chunks are kept here.
+        chunk = mtscomp.Reader.read_chunk(
+            r, chunk_idx, start, r.chunk_offsets[chunk_idx + 1] - start)
+        with self._lock:
+            if chunk_idx not in self._chunks:
+                self._chunks[chunk_idx] = chunk
+                self.size += chunk.nbytes
+            while self.size > self.max_size and len(self._chunks) > 1:
+                _, evicted = self._chunks.popitem(last=False)
+                self.size -= evicted.nbytes
+        return chunk
+
+    def chunk(self, chunk_idx):
+        """Return a decompressed chunk."""
+        with self._lock:
+            chunk = self._chunks.get(chunk_idx, None)
+            if chunk is not None:
+                self._chunks.move_to_end(chunk_idx)
+                return chunk
+        return self._flight.do(chunk_idx, self._decompress, chunk_idx)
+
+    def _prefetch(self, first, last):
+        """Decompress in the background the chunks that are likely to be read next."""
+        forward = self._last_chunk is None or first >= self._last_chunk
+        self._last_chunk = first
+        if not self.prefetch:
+            return
+        if forward:
+            chunk_ids = range(last + 1, min(self.reader.n_chunks, last + 1 + self.prefetch))
+        else:
+            chunk_ids = range(max(0, first - self.prefetch), first)
+        with self._lock:
+            chunk_ids = [i for i in chunk_ids if i not in self._chunks]
+        self._prefetching = [self.pool.submit(self.chunk, i) for i in chunk_ids]
+
+    def read(self, i0, i1):
+        """Return the decompressed data between two samples."""
+        r = self.reader
+        i0, i1 = max(0, i0), min(r.n_samples, i1)
+        if i1 <= i0:
+            return np.zeros((0, r.n_channels), dtype=r.dtype)
+        first, last = r._chunks_for_interval(i0, i1)
+        chunk_ids = range(first, last + 1)
+        if len(chunk_ids) == 1:
+            chunks = [self.chunk(first)]
+        else:
+            chunks = list(self.pool.map(self.chunk, chunk_ids))
+        self._prefetch(first, last)
+        arr = chunks[0] if len(chunks) == 1 else np.concatenate(chunks)
+        offset = r.chunk_bounds[first]
+        return arr[i0 - offset:i1 - offset]
+
+    def __getitem__(self, item):
+        if isinstance(item, tuple):
+            rows, cols = item if len(item) == 2 else (item[0], slice(None))
+            out = self[rows]
+            return out[cols] if np.isscalar(rows) else out[:, cols]
+        if isinstance(item, slice):
+            start, stop, step = item.indices(self.reader.n_samples)
+            return self.read(start, stop)[::step]
+        if isinstance(item, (int, np.integer)):
+            i = int(item) + (self.reader.n_samples if item < 0 else 0)
+            if not 0 <= i < self.reader.n_samples:
+                raise IndexError(
+                    "index %d is out of bounds for axis 0 with size %d" % (
+                        item, self.reader.n_samples))
+            return self.read(i, i + 1)[0]
+        raise NotImplementedError("Indexing with multiple values is currently unsupported.")
+
+    def close(self):
+        """Stop the thread pool and clear the cache."""
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+        with self._lock:
+            self._chunks.clear()
+            self.size = 0
+
+
+def cache_decompressed_chunks(traces, **kwargs):
+    """If the raw data is read from an mtscomp compressed file, make it read through a
+    `DecompressedChunkCache`, and return it. Return None otherwise.
+
+    The keyword arguments are passed to the `DecompressedChunkCache` constructor.
+
+    """
+    reader = getattr(traces, 'reader', None)
+    if isinstance(reader, DecompressedChunkCache):
+        return reader
+    if not isinstance(reader, mtscomp.Reader):
+        return
+    logger.debug("Caching the decompressed chunks of %s.", reader.cdata.name)
+    traces.reader = DecompressedChunkCache(reader, **kwargs)
+    return traces.reader
@@ -13,9 +13,9 @@ import logging
 import os
 from pathlib import Path
 import shutil
+from threading import Lock
 
 import numpy as np
-from scipy.signal import butter, lfilter
 
 from phylib import _add_log_file
 from phylib.io.array import Selector, _flatten
@@ -23,7 +23,13 @@ from phylib.stats import correlograms, firing_rate
 from phylib.utils import Bunch, emit, connect, unconnect
 from phylib.utils._misc import write_tsv
 
-from phy.cluster._utils import RotatingProperty
+from phy.apps._raw import (
+    CachedFilteredTraces, ChunkCache, CommonAverageReference, Pipeline, SosFilter, Whitening,
+    WaveformExtractor, cache_decompressed_chunks, compute_spike_raw_amplitudes)
+from phy.apps.curate import save_spike_clusters_mmap
+from phy.cluster._index import BestChannels, ClustersPerChannel, TemplateCounts
+from phy.cluster._similarity import WaveformSimilarity
+from phy.cluster._utils import RotatingProperty, batch_metric
 from phy.cluster.supervisor import Supervisor
 from phy.cluster.views.base import ManualClusteringView, BaseGlobalView
 from phy.cluster.views import (
@@ -33,10 +39,11 @@ from phy.cluster.views import (
 from phy.cluster.views.trace import _iter_spike_waveforms
 from phy.gui import GUI
 from phy.gui.gui import _prompt_save
-from phy.gui.qt import AsyncCaller
+from phy.gui.qt import AsyncCaller, Prefetcher
 from phy.gui.state import _gui_state_path
 from phy.gui.widgets import IPythonView
 from phy.utils.context import Context, _cache_methods
+from phy.utils.config import load_master_config
 from phy.utils.plugin import attach_plugins
 
 logger = logging.getLogger(__name__)
@@ -52,6 +59,13 @@ def _concatenate_parents_attributes(cls, name):
     return _flatten([getattr(_, name, ()) for _ in inspect.getmro(cls)])
 
 
+def _config_option(gui_name, name, config_dir=None):
+    """Return an option of a GUI in the user configuration file, or None."""
+    config = load_master_config(config_dir=config_dir)
+    c = config.get(gui_name, None)
+    return c.get(name, None) if c else None
+
+
 class Selection(Bunch):
     def __init__(self, controller):
         super(Selection, self).__init__()
@@ -81,16 +95,19 @@ class RawDataFilter(RotatingProperty):
         super(RawDataFilter, self).__init__()
         self.add('raw', lambda x, axis=None: x)
 
-    def add_default_filter(self, sample_rate):
-        b, a = butter(3, 150.0 / sample_rate * 2.0, 'high')
-
-        @self.add_filter
-        def high_pass(arr, axis=0):
-            arr = lfilter(b, a, arr, axis=axis)
-            arr = np.flip(arr, axis=axis)
-            arr = lfilter(b, a, arr, axis=axis)
-            arr = np.flip(arr, axis=axis)
-            return arr
+    def add_default_filter(self, sample_rate, n_channels=None, wm=None):
+        """Add the default preprocessing pipelines: a high-pass filter, optionally preceded
+        by a common average reference, or followed by whitening with the matrix `wm`."""
+        self.add_filter(Pipeline([SosFilter(sample_rate, low=150.)]), name='high_pass')
+        self.add_filter(Pipeline([
+            CommonAverageReference(n_channels),
+            SosFilter(sample_rate, low=150.),
+        ]), name='high_pass_car')
+        if wm is not None and not np.allclose(wm, np.eye(len(wm))):
+            self.add_filter(Pipeline([
+                SosFilter(sample_rate, low=150.),
+                Whitening(wm),
+            ]), name='whitened')
         self.set('high_pass')
 
     def add_filter(self, fun=None, name=None):
@@ -147,6 +164,10 @@ class WaveformMixin(object):
         '_get_mean_waveforms',
     )
 
+    _prefetched = (
+        '_prefetch_waveforms',
+    )
+
     def get_spike_raw_amplitudes(self, spike_ids, channel_id=None, **kwargs):
         """Return the maximum amplitude of the raw waveforms on the best channel of
         the first selected cluster.
@@ -160,24 +181,126 @@ class WaveformMixin(object):
         spike_clusters = self.supervisor.clustering.spike_clusters[spike_ids]
         # Only keep spikes from clusters on the "best" channel.
         to_keep = np.in1d(spike_clusters, self.get_clusters_on_channel(channel_id))
+        # Look up the precomputed amplitudes of the spikes on their peak channel.
+        store = self._load_spike_raw_amplitudes()
+        if store is not None:
+            found = to_keep & (store['channels'][spike_ids] == channel_id)
+            out[found] = store['amplitudes'][spike_ids[found]]
+            to_keep &= ~found
+        if not np.any(to_keep):
+            return out
         # WARNING: extracting raw waveforms is long!
-        waveforms = self.model.get_waveforms(spike_ids[to_keep], [channel_id])
+        waveforms = self._extract_waveforms([spike_ids[to_keep]], [[channel_id]])[0]
         if waveforms is not None:
             waveforms = waveforms[..., 0]
             assert waveforms.ndim == 2  # shape: (n_spikes_kept, n_samples)
-            # Filter the waveforms.
-            waveforms = self.raw_data_filter.apply(waveforms, axis=1)
             # Amplitudes of the kept spikes.
             amplitudes = waveforms.max(axis=1) - waveforms.min(axis=1)
             out[to_keep] = amplitudes
         assert np.all(out >= 0)
         return out
 
+    def _spike_raw_amplitudes_name(self):
+        return 'spike_raw_amplitudes_%s' % self.raw_data_filter.current
+
+    def _load_spike_raw_amplitudes(self):
+        """Return the precomputed raw amplitudes with the current filter, or None."""
+        name = self._spike_raw_amplitudes_name()
+        if name not in self._spike_raw_amplitudes:
+            store = self.context.load(name)
+            if set(store) != {'amplitudes', 'channels'} or (
+                    len(store['amplitudes']) != self.model.n_spikes):
+                store = None
+            self._spike_raw_amplitudes[name] = store
+        return self._spike_raw_amplitudes[name]
+
+    def compute_spike_raw_amplitudes(self, chunk_size=None, n_jobs=None):
+        """Compute the raw amplitude of every spike on the peak channel of its cluster, with
+        the current raw data filter, and save them in the cache directory.
+
+        The raw data is streamed once, in chunks processed in parallel. The amplitudes are
+        then looked up by `get_spike_raw_amplitudes()` for the spikes of any cluster, since
+        they are indexed by spike.
+
+        """
+        if self.model.traces is None:  # pragma: no cover
+            logger.warning("The raw data is not available.")
+            return
+        # Best channel of every spike, looked up by chunks of the spike clusters, which are not
+        # loaded in memory in low-memory mode.
+        clustering = self.supervisor.clustering
+        cluster_ids = clustering.cluster_ids
+        best_channels = np.zeros(int(cluster_ids.max()) + 1 if len(cluster_ids) else 0, np.int64)
+        best_channels[cluster_ids] = self.get_best_channel_ids(cluster_ids)
+        channels = np.zeros(self.model.n_spikes, dtype=np.int64)
+        step = 2 ** 22
+        for i in range(0, self.model.n_spikes, step):
+            channels[i:i + step] = best_channels[clustering.spike_clusters[i:i + step]]
+        amplitudes = compute_spike_raw_amplitudes(
+            self.model.traces, self.model.spike_samples, channels,
+            self.model.n_samples_waveforms, filter=self.raw_data_filter.get(),
+            chunk_size=chunk_size or int(self.model.sample_rate), n_jobs=n_jobs)
+        name = self._spike_raw_amplitudes_name()
+        # Release the memory-mapped files of the previous amplitudes before they are replaced,
+        # which fails on Windows otherwise. They are not used by the views in the meantime.
+        self._spike_raw_amplitudes[name] = None
+        self.context.save(name, dict(amplitudes=amplitudes, channels=channels), kind='npy')
+        self._spike_raw_amplitudes.pop(name, None)
+        return self._load_spike_raw_amplitudes()
+
     def get_mean_spike_raw_amplitudes(self, cluster_id):
         """Return the average of the spike raw amplitudes."""
         spike_ids = self._get_amplitude_spike_ids(cluster_id)
         return np.mean(self.get_spike_raw_amplitudes(spike_ids))
 
+    def _extract_waveforms(self, spike_ids, channel_ids):
+        """Return the filtered waveforms of several sets of spikes, on several sets of
+        channels. The spikes are extracted at once from the raw data, sorted by sample."""
+        if self.model.traces is None or getattr(self.model, 'spike_waveforms', None) is not None:
+            out = [self.model.get_waveforms(s, c) for s, c in zip(spike_ids, channel_ids)]
+            return [
+                self.raw_data_filter.apply(data, axis=1) if data is not None else None
+                for data in out]
+        requests = [(self.model.spike_samples[s], c) for s, c in zip(spike_ids, channel_ids)]
+        filtered = self._get_filtered_traces()
+        if filtered is not None:
+            # The waveforms are read from the filtered chunks, without margins.
+            extractor = WaveformExtractor(filtered, self.model.n_samples_waveforms, margin=0)
+            return extractor.extract(requests)
+        if self._waveform_extractor is None:
+            self._waveform_extractor = WaveformExtractor(
+                self.model.traces, self.model.n_samples_waveforms)
+        return self._waveform_extractor.extract(requests, filter=self.raw_data_filter.get())
+
+    def _extract_selected_waveforms(self, cluster_id):
+        """If the waveforms of a cluster are not in the cache, extract them along with the
+        waveforms of the other selected clusters that are not in the cache either, in a single
+        pass over the raw data."""
+        check = getattr(self._get_waveforms_with_n_spikes, 'check_call_in_cache', None)
+        if check is None:
+            return
+        args = (self.n_spikes_waveforms, self.batch_size_waveforms)
+        current_filter = self.raw_data_filter.current
+        cluster_ids = [cluster_id] + [
+            c for c in self.selection.cluster_ids if c is not None and c != cluster_id]
+        cluster_ids = [
+            c for c in cluster_ids if not check(c, *args, current_filter=current_filter)]
+        if len(cluster_ids) < 2 or cluster_ids[0] != cluster_id:
+            return
+        spike_ids = [self.selector.select_spikes([c], *args) for c in cluster_ids]
+        channel_ids = [self.get_best_channels(c) for c in cluster_ids]
+        data = self._extract_waveforms(spike_ids, channel_ids)
+        # The extracted waveforms are passed to `_get_waveforms_with_n_spikes()`, so that they
+        # are cached like the waveforms extracted separately. This dictionary is shared by the
+        # threads of the views, the waveforms of the clusters that are no longer selected are
+        # dropped.
+        selected = set(self.selection.cluster_ids)
+        with self._extracted_waveforms_lock:
+            for key in [k for k in self._extracted_waveforms if k[0] not in selected]:
+                del self._extracted_waveforms[key]
+            self._extracted_waveforms.update({
+                (c,) + args + (current_filter,): d for c, d in zip(cluster_ids, data)})
+
     def _get_waveforms_with_n_spikes(
             self, cluster_id, n_spikes_waveforms, batch_size_waveforms, current_filter=None):
         # HACK: we pass self.raw_data_filter.current_filter so that it is cached properly.
@@ -186,12 +309,13 @@ class WaveformMixin(object):
             [cluster_id], n_spikes_waveforms, batch_size_waveforms)
         channel_ids = self.get_best_channels(cluster_id)
         channel_labels = self._get_channel_labels(channel_ids)
-        data = self.model.get_waveforms(spike_ids, channel_ids)
-        assert data.ndim == 3  # n_spikes, n_samples, n_channels
-        # data = data - data.mean() if data is not None else None
-        # Filter the waveforms.
-        if data is not None:
-            data = self.raw_data_filter.apply(data, axis=1)
+        # Filtered waveforms, which may have been extracted with other clusters.
+        key = (cluster_id, n_spikes_waveforms, batch_size_waveforms, current_filter)
+        with self._extracted_waveforms_lock:
+            data = self._extracted_waveforms.pop(key, None)
+        if data is None:
+            data = self._extract_waveforms([spike_ids], [channel_ids])[0]
+        assert data is None or data.ndim == 3  # n_spikes, n_samples, n_channels
         return Bunch(
             data=data,
             channel_ids=channel_ids,
@@ -199,12 +323,20 @@ class WaveformMixin(object):
             channel_positions=pos[channel_ids],
         )
 
-    def _get_waveforms(self, cluster_id):
-        """Return a selection of waveforms for a cluster."""
+    def _get_waveforms(self, cluster_id, batch=True):
+        """Return a selection of waveforms for a cluster. If `batch` is True, the waveforms
+        of the other selected clusters are extracted at the same time."""
+        if batch:
+            self._extract_selected_waveforms(cluster_id)
         return self._get_waveforms_with_n_spikes(
             cluster_id, self.n_spikes_waveforms, self.batch_size_waveforms,
             current_filter=self.raw_data_filter.current)
 
+    def _prefetch_waveforms(self, cluster_id):
+        """Warm up the waveform cache of a cluster that is likely to be selected next. The
+        prefetched clusters are not selected, so that their waveforms are extracted alone."""
+        self._get_waveforms(cluster_id, batch=False)
+
     def _get_mean_waveforms(self, cluster_id, current_filter=None):
         """Get the mean waveform of a cluster on its best channels."""
         b = self._get_waveforms(cluster_id)
@@ -213,6 +345,34 @@ class WaveformMixin(object):
         b['alpha'] = 1.
         return b
 
+    def _set_supervisor(self):
+        super(WaveformMixin, self)._set_supervisor()
+
+        # Memory-mapped raw amplitudes of all spikes, for every raw data filter.
+        self._spike_raw_amplitudes = {}
+        # Extraction of the waveforms of several clusters at once.
+        self._waveform_extractor = None
+        self._extracted_waveforms = {}
+        self._extracted_waveforms_lock = Lock()
+
+        # Similarity between the mean waveforms, updated after every clustering action.
+        self._waveform_similarity = WaveformSimilarity(
+            self._get_mean_waveforms, self.supervisor.clustering.cluster_ids,
+            self.model.n_channels)
+
+        @connect(sender=self.supervisor)
+        def on_cluster(sender, up):
+            self._waveform_similarity.update(up)
+
+    def _set_similarity_functions(self):
+        super(WaveformMixin, self)._set_similarity_functions()
+        self.similarity_functions['mean_waveform'] = self.mean_waveform_similarity
+
+    def mean_waveform_similarity(self, cluster_id):
+        """Return the list of similar clusters to a given cluster, on the basis of the cosine
+        similarity between the mean waveforms on the best channels."""
+        return self._waveform_similarity.similarity(cluster_id)
+
     def _set_view_creator(self):
         super(WaveformMixin, self)._set_view_creator()
         self.view_creator['WaveformView'] = self.create_waveform_view
@@ -430,15 +590,29 @@ class TemplateMixin(object):
     _memcached = (
         '_get_template_waveforms',
         'get_mean_spike_template_amplitudes',
-        'get_template_counts',
-        'get_template_for_cluster',
         'get_template_amplitude',
         'get_cluster_amplitude',
     )
 
+    _prefetched = (
+        '_get_template_waveforms',
+    )
+
     def __init__(self, *args, **kwargs):
         super(TemplateMixin, self).__init__(*args, **kwargs)
 
+    def _set_supervisor(self):
+        super(TemplateMixin, self)._set_supervisor()
+
+        # Sparse cluster × template count matrix, updated after every clustering action.
+        self.template_counts = TemplateCounts.from_spike_templates(
+            self.supervisor.clustering.spike_clusters, self.model.spike_templates,
+            n_templates=self.model.n_templates)
+
+        @connect(sender=self.supervisor)
+        def on_cluster(sender, up):
+            self.template_counts.update(up, self.model.spike_templates)
+
     def _get_amplitude_functions(self):
         out = super(TemplateMixin, self)._get_amplitude_functions()
         if getattr(self.model, 'template_features', None) is not None:
@@ -452,17 +626,20 @@ class TemplateMixin(object):
 
     def get_template_counts(self, cluster_id):
         """Return a histogram of the number of spikes in each template for a given cluster."""
-        spike_ids = self.supervisor.clustering.spikes_per_cluster[cluster_id]
-        st = self.model.spike_templates[spike_ids]
-        return np.bincount(st, minlength=self.model.n_templates)
+        return self.template_counts.dense(cluster_id)
 
     def get_template_for_cluster(self, cluster_id):
         """Return the largest template associated to a cluster."""
-        spike_ids = self.supervisor.clustering.spikes_per_cluster[cluster_id]
-        st = self.model.spike_templates[spike_ids]
-        template_ids, counts = np.unique(st, return_counts=True)
-        ind = np.argmax(counts)
-        return template_ids[ind]
+        return self.template_counts.best_templates([cluster_id])[0]
+
+    def get_templates_for_clusters(self, cluster_ids):
+        """Return the largest template of several clusters, as an array.
+
+        This is equivalent to calling `get_template_for_cluster()` on every cluster, the
+        templates with the most spikes are looked up at once in the template count matrix.
+
+        """
+        return self.template_counts.best_templates(cluster_ids)
 
     def get_template_amplitude(self, template_id):
         """Return the maximum amplitude of a template's waveforms across all channels."""
@@ -475,10 +652,19 @@ class TemplateMixin(object):
         template_id = self.get_template_for_cluster(cluster_id)
         return self.get_template_amplitude(template_id)
 
+    @batch_metric
+    def get_cluster_amplitudes(self, cluster_ids):
+        """Return the amplitude of the best template of several clusters."""
+        template_ids = self.get_templates_for_clusters(cluster_ids)
+        # The template amplitudes are cached.
+        unique, inv = np.unique(template_ids, return_inverse=True)
+        amplitudes = np.array([self.get_template_amplitude(t) for t in unique])
+        return amplitudes[inv]
+
     def _set_cluster_metrics(self):
         """Add an amplitude column in the cluster view."""
         super(TemplateMixin, self)._set_cluster_metrics()
-        self.cluster_metrics['amp'] = self.get_cluster_amplitude
+        self.cluster_metrics['amp'] = self.get_cluster_amplitudes
 
     def get_spike_template_amplitudes(self, spike_ids, **kwargs):
         """Return the template amplitudes multiplied by the spike's amplitude."""
@@ -513,9 +699,7 @@ class TemplateMixin(object):
     def _get_template_waveforms(self, cluster_id):
         """Return the waveforms of the templates corresponding to a cluster."""
         pos = self.model.channel_positions
-        count = self.get_template_counts(cluster_id)
-        template_ids = np.nonzero(count)[0]
-        count = count[template_ids]
+        template_ids, count = self.template_counts[cluster_id]
         # Get local channels.
         channel_ids = self.get_best_channels(cluster_id)
         # Get masks, related to the number of spikes per template which the cluster stems from.
@@ -580,10 +764,22 @@ class TraceMixin(object):
     def _get_traces(self, interval, show_all_spikes=False):
         """Get traces and spike waveforms."""
         k = self.model.n_samples_waveforms
-        traces_interval = select_traces(
-            self.model.traces, interval, sample_rate=self.model.sample_rate)
-        # Filter the loaded traces.
-        traces_interval = self.raw_data_filter.apply(traces_interval, axis=0)
+        f = self.raw_data_filter.get()
+        filtered = self._get_filtered_traces()
+        if filtered is not None:
+            # Read the filtered traces from the chunk cache.
+            traces_interval = select_traces(
+                filtered, interval, sample_rate=self.model.sample_rate)
+        elif isinstance(f, Pipeline):
+            # Preprocess the interval with the margins of the pipeline.
+            sr = self.model.sample_rate
+            i, j = int(round(sr * interval[0])), int(round(sr * interval[1]))
+            traces_interval = f.process(self.model.traces, i, j)
+        else:
+            traces_interval = select_traces(
+                self.model.traces, interval, sample_rate=self.model.sample_rate)
+            # Filter the loaded traces.
+            traces_interval = self.raw_data_filter.apply(traces_interval, axis=0)
         out = Bunch(data=traces_interval)
 
         def gbc(cluster_id):
@@ -715,6 +911,20 @@ class BaseController(object):
         Whether to clear the GUI state files on startup.
     enable_threading : boolean
         Whether to enable threading in the views when selecting clusters.
+    low_memory : boolean
+        Whether to memory-map the original `spike_clusters.npy` file rather than keeping the
+        spike-cluster assignments in memory, for very large datasets. The cluster indices are
+        built from the memory-mapped file in chunks. Note that the model still loads the
+        spike clusters in memory when the dataset is opened, this copy is released once the
+        clustering has been created.
+    table_backend : str
+        Backend of the cluster view and similarity view, either `html` or `native`. By default,
+        this is taken from the user configuration file, for example
+        `c.TemplateGUI.table_backend = 'native'`, or from the class attribute.
+    chunk_cache_size : int
+        Maximum size in bytes of the on-disk cache of filtered raw data chunks, or 0 to
+        disable it. By default, this is taken from the user configuration file, for example
+        `c.TemplateGUI.chunk_cache_size = 4 * 1024 ** 3`, or from the class attribute.
 
     Methods to override
     -------------------
@@ -726,8 +936,10 @@ class BaseController(object):
         parameters.
     _set_view_creator() : None => None
         Populate the `self.view_creator` dictionary with custom views.
-    get_best_channels(cluster_id) : int => list
-        Return the list of best channels for any given cluster, sorted by decreasing match.
+    _compute_best_channels(cluster_ids) : list => list
+        Return the list of best channels of every given cluster, sorted by decreasing match.
+        The results are kept in a table persisted in the cache directory, and looked up by
+        `get_best_channels(cluster_id)`.
 
     Model
     -----
@@ -807,6 +1019,22 @@ class BaseController(object):
 
     n_spikes_correlograms = 100000
 
+    # Maximum memory size in bytes of the undo stacks, beyond which older actions are
+    # compressed and spilled to the cache directory (None for no limit).
+    history_max_memory = 256 * 1024 ** 2
+
+    # Backend of the cluster view and similarity view: `html` (web view tables) or `native`
+    # (Qt model/view tables backed by NumPy arrays, faster to start and to update).
+    table_backend = 'html'
+
+    # Maximum size in bytes of the on-disk cache of the filtered raw data, stored in chunks of
+    # `chunk_cache_samples` samples (0 to disable the cache).
+    chunk_cache_size = 0
+    chunk_cache_samples = 30000
+
+    # Maximum memory size in bytes of the decompressed chunks of mtscomp compressed raw data.
+    decompression_cache_size = 512 * 1024 ** 2
+
     # Controller attributes to load/save in the GUI state.
     _state_params = (
         'n_spikes_amplitudes', 'n_spikes_correlograms',
@@ -817,16 +1045,19 @@ class BaseController(object):
     _memcached = (
         'get_mean_firing_rate',
         'get_best_channel',
-        'get_best_channels',
         'get_channel_shank',
         'get_probe_depth',
-        'peak_channel_similarity',
     )
     # Methods that are cached on disk for performance.
     _cached = (
         '_get_correlograms',
         '_get_correlograms_rate',
     )
+    # Methods `cluster_id => data` called in the background on the clusters that are likely
+    # to be selected next, to warm up their cache.
+    _prefetched = (
+        'get_best_channels',
+    )
 
     # Views to load by default.
     _new_views = (
@@ -842,9 +1073,11 @@ class BaseController(object):
     def __init__(
             self, dir_path=None, config_dir=None, model=None,
             clear_cache=None, clear_state=None,
-            enable_threading=True, **kwargs):
+            enable_threading=True, low_memory=False, table_backend=None,
+            chunk_cache_size=None, **kwargs):
 
         self._enable_threading = enable_threading
+        self.low_memory = low_memory
 
         assert dir_path
         self.dir_path = Path(dir_path).resolve()
@@ -856,12 +1089,18 @@ class BaseController(object):
         # Create or reuse a Model instance (any object)
         self.model = self._create_model(dir_path=dir_path, **kwargs) if model is None else model
 
+        # Decompress the chunks of mtscomp compressed raw data in parallel, and keep them.
+        self._decompressed_chunks = cache_decompressed_chunks(
+            getattr(self.model, 'traces', None), max_size=self.decompression_cache_size)
+
         # Set up the cache.
         self._set_cache(clear_cache)
 
         # Raw data filter.
         self.raw_data_filter = RawDataFilter()
-        self.raw_data_filter.add_default_filter(self.model.sample_rate)
+        self.raw_data_filter.add_default_filter(
+            self.model.sample_rate, n_channels=self.model.n_channels,
+            wm=getattr(self.model, 'wm', None))
 
         # Map view names to method creating new views. Other views can be added by plugins.
         self._set_view_creator()
@@ -877,7 +1116,16 @@ class BaseController(object):
         if getattr(self, 'default_views', None) is None:
             self.default_views = _concatenate_parents_attributes(self.__class__, '_new_views')
         self._async_callers = {}
+        self._prefetcher = Prefetcher()
         self.config_dir = config_dir
+        self.table_backend = (
+            table_backend or _config_option(self.gui_name, 'table_backend', config_dir) or
+            self.table_backend)
+        self.chunk_cache_size = (
+            chunk_cache_size if chunk_cache_size is not None else
+            _config_option(self.gui_name, 'chunk_cache_size', config_dir) or
+            self.chunk_cache_size)
+        self._set_chunk_cache()
 
         # Clear the GUI state files if needed.
         if clear_state:
@@ -898,6 +1146,9 @@ class BaseController(object):
         # are concatenated from the object's class parents and mixins.
         self._cache_methods()
 
+        # Load the table of the best channels of every cluster.
+        self._set_best_channels()
+
         # Set up the Supervisor instance, responsible for the clustering process.
         self._set_supervisor()
 
@@ -935,6 +1186,27 @@ class BaseController(object):
             self._clear_cache()
         self.context = Context(self.cache_dir)
 
+    def _set_chunk_cache(self):
+        """Set up the opt-in on-disk cache of the filtered raw data chunks."""
+        self._chunk_cache = None
+        self._filtered_traces = {}
+        if (not self.chunk_cache_size or getattr(self.model, 'traces', None) is None or
+                os.environ.get('PHY_DISABLE_CACHE', False)):
+            return
+        self._chunk_cache = ChunkCache(self.cache_dir / 'filtered_chunks', self.chunk_cache_size)
+
+    def _get_filtered_traces(self):
+        """Return the raw data filtered with the current raw data filter, as an array-like
+        object read from the chunk cache, or None if the chunk cache is disabled."""
+        if self._chunk_cache is None:
+            return
+        name = self.raw_data_filter.current
+        if name not in self._filtered_traces:
+            self._filtered_traces[name] = CachedFilteredTraces(
+                self.model.traces, self.raw_data_filter.get(), self._chunk_cache, name,
+                chunk_size=self.chunk_cache_samples)
+        return self._filtered_traces[name]
+
     def _set_view_creator(self):
         """Set the view creator, a dictionary mapping view names to methods creating views.
 
@@ -957,12 +1229,14 @@ class BaseController(object):
 
     def _set_cluster_metrics(self):
         """Set the cluster metrics dictionary with some default metrics."""
-        self.cluster_metrics = {}  # dictionary {name: function cluster_id => value}, for plugins
-        self.cluster_metrics['ch'] = self.get_best_channel_label
+        # Dictionary {name: function cluster_id => value}, for plugins. The default metrics are
+        # batch metrics that compute the values of all clusters at once.
+        self.cluster_metrics = {}
+        self.cluster_metrics['ch'] = self.get_best_channel_labels
         if getattr(self.model, 'channel_shanks', None) is not None:
-            self.cluster_metrics['sh'] = self.get_channel_shank
-        self.cluster_metrics['depth'] = self.get_probe_depth
-        self.cluster_metrics['fr'] = self.get_mean_firing_rate
+            self.cluster_metrics['sh'] = self.get_channel_shanks
+        self.cluster_metrics['depth'] = self.get_probe_depths
+        self.cluster_metrics['fr'] = self.get_mean_firing_rates
 
     def _set_similarity_functions(self):
         """Set the `similarity_functions` dictionary that maps similarity names to functions
@@ -981,16 +1255,30 @@ class BaseController(object):
         # Cluster groups.
         cluster_groups = self.model.metadata.get('group', {})
 
+        # In low-memory mode, the original spike clusters file is memory-mapped, and the
+        # changes are kept in a sparse overlay.
+        spike_clusters = self.model.spike_clusters
+        path = self.dir_path / 'spike_clusters.npy'
+        if self.low_memory and path.exists():
+            spike_clusters = np.load(path, mmap_mode='r')
+
         # Create the Supervisor instance.
         supervisor = Supervisor(
-            spike_clusters=self.model.spike_clusters,
+            spike_clusters=spike_clusters,
             cluster_groups=cluster_groups,
             cluster_metrics=self.cluster_metrics,
             cluster_labels=self.model.metadata,
             similarity=self.similarity_functions[self.similarity],
             new_cluster_id=new_cluster_id,
             context=self.context,
+            low_memory=self.low_memory,
+            history_max_memory=self.history_max_memory,
+            table_backend=self.table_backend,
         )
+        if self.low_memory:
+            # Release the in-memory copy of the spike clusters loaded by the model.
+            self.model.spike_clusters = supervisor.clustering.spike_clusters
+
         # Load the non-group metadata from the model to the cluster_meta.
         for name in sorted(self.model.metadata):
             if name == 'group':
@@ -999,12 +1287,60 @@ class BaseController(object):
             d = {cluster_id: {name: value} for cluster_id, value in values.items()}
             supervisor.cluster_meta.from_dict(d)
 
+        # Replay the unsaved actions of a previous session, and record the new actions.
+        supervisor.attach_journal(self.cache_dir / 'journal.bin')
+
         # Connect the `save_clustering` event raised by the supervisor when saving
         # to the model's saving functions.
         connect(self.on_save_clustering, sender=supervisor)
 
         self.supervisor = supervisor
 
+        # Inverted index of the clusters on every channel, updated after every clustering
+        # action.
+        self._clusters_per_channel = ClustersPerChannel(
+            lambda cluster_id: self.get_best_channels(cluster_id),
+            supervisor.clustering.cluster_ids)
+
+        @connect(sender=supervisor)
+        def on_cluster(sender, up):
+            self._clusters_per_channel.update(up)
+
+    def _set_best_channels(self):
+        """Load the table of the best channels of every cluster from the cache directory."""
+        arrays = self.context.load('best_channels')
+        if not os.environ.get('PHY_DISABLE_CACHE', False) and (
+                set(arrays) == {'channels', 'offsets', 'clusters'}):
+            self.best_channels = BestChannels(**arrays)
+        else:
+            self.best_channels = BestChannels()
+        self._best_channels_lock = Lock()
+        # Whether the best channels of all clusters have been computed.
+        self._best_channels_complete = False
+
+    def _fill_best_channels(self, cluster_ids):
+        """Compute the best channels of the clusters that are not in the table yet. The first
+        time, the best channels of all clusters are computed at once."""
+        with self._best_channels_lock:
+            if not self._best_channels_complete and getattr(self, 'supervisor', None):
+                cluster_ids = np.union1d(cluster_ids, self.supervisor.clustering.cluster_ids)
+                self._best_channels_complete = True
+            missing = self.best_channels.missing(cluster_ids)
+            if not len(missing):
+                return
+            logger.debug("Computing the best channels of %d clusters.", len(missing))
+            self.best_channels.set(missing, self._compute_best_channels(missing))
+
+    def _save_best_channels(self):
+        """Save the best channels of the existing clusters in the cache directory, if the
+        table has changed since it was loaded."""
+        if not self.best_channels.is_dirty or os.environ.get('PHY_DISABLE_CACHE', False):
+            return
+        self.context.save(
+            'best_channels',
+            self.best_channels.to_arrays(self.supervisor.clustering.cluster_ids), kind='npy')
+        self.best_channels.is_dirty = False
+
     def _set_selector(self):
         """Set the Selector instance."""
         def spikes_per_cluster(cluster_id):
@@ -1019,6 +1355,17 @@ class BaseController(object):
             cached = _concatenate_parents_attributes(self.__class__, '_cached')
             _cache_methods(self, memcached, cached)
 
+    def _prefetch(self, cluster_ids):
+        """Warm up the cache of some clusters by calling the methods specified in
+        `self._prefetched` in a low-priority background thread. The pending calls of the
+        previous prefetch are cancelled."""
+        if not self._enable_threading or os.environ.get('PHY_DISABLE_CACHE', False):
+            return
+        names = _concatenate_parents_attributes(self.__class__, '_prefetched')
+        logger.log(5, "Prefetch clusters %s.", cluster_ids)
+        self._prefetcher.prefetch(
+            (getattr(self, name), (cluster_id,)) for cluster_id in cluster_ids for name in names)
+
     def _get_channel_labels(self, channel_ids=None):
         """Return the labels of a list of channels."""
         if channel_ids is None:
@@ -1055,8 +1402,8 @@ class BaseController(object):
                 return
 
             def _update_plot():
-                # The call to all_cluster_ids blocks until the cluster view JavaScript returns
-                # the cluster ids.
+                # The cluster ids are read from the supervisor's mirror of the cluster view,
+                # without waiting for the view.
                 view.set_cluster_ids(self.supervisor.all_cluster_ids)
                 # Replot the view entirely.
                 view.plot()
@@ -1129,12 +1476,20 @@ class BaseController(object):
     def on_save_clustering(self, sender, spike_clusters, groups, *labels):
         """Save the modified data."""
         # Save the clusters.
-        self.model.save_spike_clusters(spike_clusters)
+        if self.low_memory:
+            self._save_spike_clusters_mmap(spike_clusters)
+        else:
+            self.model.save_spike_clusters(spike_clusters)
         # Save cluster metadata.
         for name, values in labels:
             self.model.save_metadata(name, values)
         self._save_cluster_info()
 
+    def _save_spike_clusters_mmap(self, spike_clusters):
+        """Save the spike clusters when the original file is memory-mapped, in low-memory mode.
+        The overlay of the clustering is then rebased on the saved file."""
+        save_spike_clusters_mmap(self.dir_path / 'spike_clusters.npy', self.supervisor.clustering)
+
     def _save_cluster_info(self):
         """Save all the contents of the cluster view into `cluster_info.tsv`."""
         write_tsv(
@@ -1162,11 +1517,25 @@ class BaseController(object):
         """Return the channel label of the best channel, for display in the cluster view."""
         return self._get_channel_labels([self.get_best_channel(cluster_id)])[0]
 
-    def get_best_channels(self, cluster_id):  # pragma: no cover
-        """Return the best channels of a given cluster. To be overriden."""
+    def _compute_best_channels(self, cluster_ids):  # pragma: no cover
+        """Return the best channels of several clusters. To be overriden."""
         logger.warning(
-            "This method should be overriden and return a non-empty list of best channels.")
-        return []
+            "This method should be overriden and return non-empty lists of best channels.")
+        return [[] for _ in cluster_ids]
+
+    def get_best_channels(self, cluster_id):
+        """Return the best channels of a given cluster, sorted by decreasing match.
+
+        The best channels are looked up in a table, where they are added with
+        `_compute_best_channels()`: for all clusters at once the first time, and then for the
+        new clusters only.
+
+        """
+        channel_ids = self.best_channels.get(cluster_id)
+        if channel_ids is None:
+            self._fill_best_channels([cluster_id])
+            channel_ids = self.best_channels[cluster_id]
+        return channel_ids
 
     def get_channel_shank(self, cluster_id):
         """Return the shank of a cluster's best channel, if the channel_shanks array is available.
@@ -1179,11 +1548,38 @@ class BaseController(object):
         channel_id = self.get_best_channel(cluster_id)
         return 0 if channel_id is None else self.model.channel_positions[channel_id, 1]
 
+    # Batch cluster metrics
+    # -------------------------------------------------------------------------
+
+    def get_best_channel_ids(self, cluster_ids):
+        """Return the best channel id of several clusters, as an array. To be overriden by
+        subclasses that can compute them at once."""
+        return np.array([self.get_best_channel(c) for c in cluster_ids], dtype=np.int64)
+
+    @batch_metric
+    def get_mean_firing_rates(self, cluster_ids):
+        """Return the mean firing rate of several clusters."""
+        return self.supervisor.n_spikes(cluster_ids) / max(1, self.model.duration)
+
+    @batch_metric
+    def get_best_channel_labels(self, cluster_ids):
+        """Return the label of the best channel of several clusters."""
+        return np.array(self._get_channel_labels(self.get_best_channel_ids(cluster_ids)))
+
+    @batch_metric
+    def get_channel_shanks(self, cluster_ids):
+        """Return the shank of the best channel of several clusters."""
+        return np.asarray(self.model.channel_shanks)[self.get_best_channel_ids(cluster_ids)]
+
+    @batch_metric
+    def get_probe_depths(self, cluster_ids):
+        """Return the depth of several clusters."""
+        pos = np.asarray(self.model.channel_positions)
+        return pos[self.get_best_channel_ids(cluster_ids), 1]
+
     def get_clusters_on_channel(self, channel_id):
         """Return all clusters which have the specified channel among their best channels."""
-        return [
-            cluster_id for cluster_id in self.supervisor.clustering.cluster_ids
-            if channel_id in self.get_best_channels(cluster_id)]
+        return self._clusters_per_channel.clusters(channel_id)
 
     # Default similarity functions
     # -------------------------------------------------------------------------
@@ -1204,9 +1600,7 @@ class BaseController(object):
 
         """
         ch = self.get_best_channel(cluster_id)
-        return [
-            (other, 1.) for other in self.supervisor.clustering.cluster_ids
-            if ch in self.get_best_channels(other)]
+        return [(other, 1.) for other in self.get_clusters_on_channel(ch)]
 
     # Public spike methods
     # -------------------------------------------------------------------------
@@ -1266,9 +1660,9 @@ class BaseController(object):
         """
         out = []
         n = self.n_spikes_amplitudes if not load_all else None
-        if name == 'raw' and n is not None:
-            # HACK: currently extracting waveforms is very slow, we should probably save
-            # a spike_waveforms.npy and spike_waveforms_ind.npy arrays.
+        if name == 'raw' and n is not None and self._load_spike_raw_amplitudes() is None:
+            # Extracting waveforms is very slow, unless the raw amplitudes have been
+            # precomputed with `compute_spike_raw_amplitudes()`.
             n //= 5
         # Find the first cluster, used to determine the best channels.
         first_cluster = next(cluster_id for cluster_id in cluster_ids if cluster_id is not None)
@@ -1631,10 +2025,7 @@ class BaseController(object):
                     if isinstance(supervisor, Supervisor):
                         # After a clustering action, get the cluster ids as shown
                         # in the cluster view, and update the color selector accordingly.
-                        @supervisor.cluster_view.get_ids
-                        def _update(cluster_ids):
-                            if cluster_ids is not None:
-                                view.set_cluster_ids(cluster_ids)
+                        view.set_cluster_ids(supervisor.all_cluster_ids)
 
         # Get the state's current sort, and make sure the cluster view is initialized with it.
         self.supervisor.attach(gui)
@@ -1654,6 +2045,11 @@ class BaseController(object):
             # emit('select', sender, self.supervisor.selected + cluster_ids)
             self.supervisor.select(self.supervisor.selected + cluster_ids)
 
+        # Warm up the cache of the clusters that the wizard is likely to select next.
+        @connect(sender=self.supervisor)
+        def on_upcoming(sender, cluster_ids):
+            self._prefetch(cluster_ids)
+
         # Prompt save.
         @connect(sender=gui)
         def on_close(sender):
@@ -1661,6 +2057,8 @@ class BaseController(object):
             unconnect(on_view_ready, self)
             unconnect(on_add_view_, self)
             unconnect(on_select_more, self)
+            unconnect(on_upcoming, self)
+            self._prefetcher.cancel()
             # Show save prompt if an action was done.
             do_prompt_save = kwargs.get('do_prompt_save', True)
             if do_prompt_save and self.supervisor.is_dirty():  # pragma: no cover
@@ -1671,6 +2069,9 @@ class BaseController(object):
                     # Prevent closing of the GUI by returning False.
                     return False
                 # Otherwise (r is 'close') we do nothing and close as usual.
+            # The changes are either saved or discarded, so that they must not be replayed
+            # at the next launch.
+            self.supervisor.clear_journal()
 
         # Status bar handler
         handler = StatusBarHandler(gui)
@@ -1692,9 +2093,12 @@ class BaseController(object):
             for param in self._state_params:
                 gui.state[param] = getattr(self, param, None)
 
-            # Save the memcache.
+            # Save the memcache and the best channels.
             gui.state['GUI_VERSION'] = self.gui_version
             self.context.save_memcache()
+            self._save_best_channels()
+            if self._decompressed_chunks is not None:
+                self._decompressed_chunks.close()
 
             # Remove the status bar handler when closing the GUI.
             logging.getLogger('phy').removeHandler(handler)
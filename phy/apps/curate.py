@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+
+"""Headless curation of template datasets.
+
+This module does not depend on Qt or OpenGL, so that curation scripts can run on compute nodes
+without display.
+
+"""
+
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import logging
+import os
+from pathlib import Path
+import runpy
+import shutil
+
+import numpy as np
+
+from phylib import _add_log_file
+from phylib.io.model import load_model
+from phylib.utils import connect
+from phylib.utils._misc import write_tsv
+
+from phy.cluster._index import TemplateCounts
+from phy.cluster._utils import batch_metric
+from phy.cluster.session import CurationSession
+from phy.utils.context import Context
+
+logger = logging.getLogger(__name__)
+
+
+#------------------------------------------------------------------------------
+# Utils
+#------------------------------------------------------------------------------
+
+def save_spike_clusters_mmap(path, clustering):
+    """Save the spike clusters in low-memory mode, when the original file is memory-mapped.
+
+    The spike clusters are written chunk by chunk to two temporary files. The overlay is
+    rebased on the first one, so that the original file is no longer mapped and can be
+    atomically replaced by the second one (replacing a mapped file fails on Windows). The
+    overlay is then rebased on the saved file.
+
+    """
+    path = Path(path)
+    tmp_paths = [path.with_suffix('.tmp%d.npy' % i) for i in range(2)]
+    logger.debug("Save spike clusters to `%s`.", path)
+    clustering.spike_clusters.save(tmp_paths[0])
+    shutil.copyfile(tmp_paths[0], tmp_paths[1])
+    clustering.rebase(np.load(tmp_paths[0], mmap_mode='r'))
+    os.replace(tmp_paths[1], path)
+    clustering.rebase(np.load(path, mmap_mode='r'))
+    try:
+        os.remove(tmp_paths[0])
+    except OSError:  # pragma: no cover
+        logger.debug("Unable to remove `%s`.", tmp_paths[0])
+
+
+#------------------------------------------------------------------------------
+# Template cluster metrics
+#------------------------------------------------------------------------------
+
+class TemplateClusterMetrics(object):
+    """Default cluster metrics of a template dataset, derived from the model and the template
+    of every cluster with the most spikes, without the GUI controller.
+
+    These are the columns of the cluster view of the template GUI: best channel (`ch`), shank
+    (`sh`), depth, mean firing rate (`fr`), and template amplitude (`amp`).
+
+    Constructor
+    -----------
+
+    model : TemplateModel
+        The template model.
+    session : CurationSession
+        The curation session, whose clustering actions update the cluster × template counts.
+
+    """
+
+    def __init__(self, model, session):
+        self.model = model
+        self.session = session
+        self.template_counts = TemplateCounts.from_spike_templates(
+            session.clustering.spike_clusters, model.spike_templates,
+            n_templates=model.n_templates)
+        # Best channel and amplitude of every template, as `{template_id: (channel, amp)}`.
+        self._templates = {}
+        connect(self._on_cluster, event='cluster', sender=session)
+
+    def _on_cluster(self, sender, up):
+        self.template_counts.update(up, self.model.spike_templates)
+
+    def _template(self, template_id):
+        """Return the best channel and the amplitude of a template."""
+        if template_id not in self._templates:
+            template = self.model.get_template(template_id)
+            if not template:  # pragma: no cover
+                self._templates[template_id] = (0, 0.)
+            else:
+                w = template.template
+                self._templates[template_id] = (
+                    int(template.channel_ids[0]), float((w.max(axis=0) - w.min(axis=0)).max()))
+        return self._templates[template_id]
+
+    def _template_values(self, cluster_ids, i):
+        template_ids = self.template_counts.best_templates(cluster_ids)
+        unique, inv = np.unique(template_ids, return_inverse=True)
+        return np.array([self._template(t)[i] for t in unique])[inv]
+
+    def best_channel_ids(self, cluster_ids):
+        """Return the best channel of several clusters."""
+        return self._template_values(cluster_ids, 0).astype(np.int64)
+
+    @batch_metric
+    def channel_labels(self, cluster_ids):
+        """Return the label of the best channel of several clusters."""
+        channel_ids = self.best_channel_ids(cluster_ids)
+        if (hasattr(self.model, 'channel_mapping') and
+                getattr(self.model, 'show_mapped_channels', True)):
+            channel_ids = np.asarray(self.model.channel_mapping)[channel_ids]
+        return np.array(['%d' % ch for ch in channel_ids])
+
+    @batch_metric
+    def channel_shanks(self, cluster_ids):
+        """Return the shank of the best channel of several clusters."""
+        return np.asarray(self.model.channel_shanks)[self.best_channel_ids(cluster_ids)]
+
+    @batch_metric
+    def probe_depths(self, cluster_ids):
+        """Return the depth of several clusters."""
+        pos = np.asarray(self.model.channel_positions)
+        return pos[self.best_channel_ids(cluster_ids), 1]
+
+    @batch_metric
+    def firing_rates(self, cluster_ids):
+        """Return the mean firing rate of several clusters."""
+        return self.session.n_spikes(cluster_ids) / max(1, self.model.duration)
+
+    @batch_metric
+    def amplitudes(self, cluster_ids):
+        """Return the amplitude of the best template of several clusters."""
+        return self._template_values(cluster_ids, 1)
+
+    def to_dict(self):
+        """Return the cluster metrics, as a dictionary `{name: batch_function}`."""
+        metrics = {'ch': self.channel_labels}
+        if getattr(self.model, 'channel_shanks', None) is not None:
+            metrics['sh'] = self.channel_shanks
+        metrics['depth'] = self.probe_depths
+        metrics['fr'] = self.firing_rates
+        metrics['amp'] = self.amplitudes
+        return metrics
+
+
+#------------------------------------------------------------------------------
+# Curation session of a template dataset
+#------------------------------------------------------------------------------
+
+def create_template_session(
+        model, dir_path=None, clear_cache=False, low_memory=False,
+        history_max_memory=256 * 1024 ** 2):
+    """Create a curation session on a template dataset, without GUI.
+
+    The session shares the `.phy` cache directory and the action journal with the template GUI,
+    and the clustering is saved to the dataset files by `session.save()`.
+
+    """
+    dir_path = Path(dir_path or model.dir_path)
+    cache_dir = dir_path / '.phy'
+    if clear_cache:
+        logger.warning("Deleting the cache directory %s.", cache_dir)
+        shutil.rmtree(cache_dir, ignore_errors=True)
+    context = Context(cache_dir)
+
+    # In low-memory mode, the original spike clusters file is memory-mapped, and the changes
+    # are kept in a sparse overlay.
+    spike_clusters = model.spike_clusters
+    path = dir_path / 'spike_clusters.npy'
+    if low_memory and path.exists():
+        spike_clusters = np.load(path, mmap_mode='r')
+
+    session = CurationSession(
+        spike_clusters=spike_clusters,
+        cluster_groups=model.metadata.get('group', {}),
+        cluster_labels=model.metadata,
+        new_cluster_id=context.load('new_cluster_id').get('new_cluster_id', None),
+        context=context,
+        low_memory=low_memory,
+        history_max_memory=history_max_memory,
+    )
+    if low_memory:
+        # Release the in-memory copy of the spike clusters loaded by the model.
+        model.spike_clusters = session.clustering.spike_clusters
+    session.cluster_metrics.update(TemplateClusterMetrics(model, session).to_dict())
+
+    @connect(sender=session)
+    def on_save_clustering(sender, spike_clusters, groups, *labels):
+        if low_memory:
+            save_spike_clusters_mmap(path, session.clustering)
+        else:
+            model.save_spike_clusters(spike_clusters)
+        for name, values in labels:
+            model.save_metadata(name, values)
+        write_tsv(
+            dir_path / 'cluster_info.tsv', session.cluster_info,
+            first_field='id', exclude_fields=('is_masked',), n_significant_figures=8)
+
+    # Replay the unsaved actions of a previous session, and record the new actions.
+    session.attach_journal(cache_dir / 'journal.bin')
+    return session
+
+
+def template_curate(params_path, script_path, save=True, **kwargs):
+    """Run a curation script on a template dataset, without GUI.
+
+    The script is executed with the following global variables: `session` (the
+    `CurationSession` instance) and `model`.
+
+    """
+    p = Path(params_path)
+    dir_path = p.parent
+    _add_log_file(dir_path / 'phy.log')
+
+    model = load_model(params_path)
+    session = create_template_session(model, dir_path=dir_path, **kwargs)
+    logger.info("Run the curation script %s.", script_path)
+    runpy.run_path(str(script_path), init_globals=dict(session=session, model=model))
+    if save and session.is_dirty():
+        session.save()
+    model.close()
+    return session
@@ -178,8 +178,9 @@ class KwikController(WaveformMixin, FeatureMixin, TraceMixin, BaseController):
     def _get_mean_masks(self, cluster_id):
         return np.mean(self._get_masks(cluster_id), axis=0)
 
-    def _get_waveforms(self, cluster_id):
-        """Return a selection of waveforms for a cluster."""
+    def _get_waveforms(self, cluster_id, batch=True):
+        """Return a selection of waveforms for a cluster. The waveforms are read from the
+        model, they are never extracted along with the other selected clusters."""
         pos = self.model.channel_positions
         spike_ids = self.selector.select_spikes(
             [cluster_id], self.n_spikes_waveforms, self.batch_size_waveforms)
@@ -204,11 +205,8 @@ class KwikController(WaveformMixin, FeatureMixin, TraceMixin, BaseController):
         b['alpha'] = 1.
         return b
 
-    # Public methods
-    # -------------------------------------------------------------------------
-
-    def get_best_channels(self, cluster_id):
-        """Get the best channels of a given cluster."""
+    def _get_best_channels(self, cluster_id):
+        """Get the best channels of a given cluster, from its mean masks."""
         mm = self._get_mean_masks(cluster_id)
         channel_ids = np.argsort(mm)[::-1]
         ind = mm[channel_ids] > .1
@@ -218,6 +216,13 @@ class KwikController(WaveformMixin, FeatureMixin, TraceMixin, BaseController):
             channel_ids = channel_ids[:4]
         return channel_ids
 
+    def _compute_best_channels(self, cluster_ids):
+        """Get the best channels of several clusters."""
+        return [self._get_best_channels(cluster_id) for cluster_id in cluster_ids]
+
+    # Public methods
+    # -------------------------------------------------------------------------
+
     def on_save_clustering(self, sender, spike_clusters, groups, *labels):
         """Save the modified data."""
         groups = {c: g.title() for c, g in groups.items()}
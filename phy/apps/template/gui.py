@@ -8,7 +8,6 @@
 #------------------------------------------------------------------------------
 
 import logging
-from operator import itemgetter
 from pathlib import Path
 
 import numpy as np
@@ -17,6 +16,7 @@ from phylib import _add_log_file
 from phylib.io.model import TemplateModel, load_model
 from phylib.utils import Bunch, connect
 
+from phy.cluster._similarity import TemplateSimilarity
 from phy.cluster.views import ScatterView
 from phy.gui import create_app, run_app
 from ..base import WaveformMixin, FeatureMixin, TemplateMixin, TraceMixin, BaseController
@@ -63,6 +63,9 @@ class TemplateController(WaveformMixin, FeatureMixin, TemplateMixin, TraceMixin,
     # Specific views implemented in this class.
     _new_views = ('TemplateFeatureView',)
 
+    # Methods that are cached in memory (and on disk) for performance.
+    _memcached = ('get_template_channels',)
+
     # Classes to load by default, in that order. The view refresh follows the same order
     # when the cluster selection changes.
     default_views = (
@@ -95,6 +98,16 @@ class TemplateController(WaveformMixin, FeatureMixin, TemplateMixin, TraceMixin,
         super(TemplateController, self)._set_supervisor()
 
         supervisor = self.supervisor
+
+        # Top-k index of the template similarity between clusters, updated after every
+        # clustering action, after the template count matrix.
+        self._template_similarity = TemplateSimilarity(
+            self.model.similar_templates, self.template_counts)
+
+        @connect(sender=supervisor)
+        def on_cluster(sender, up):
+            self._template_similarity.update(up)
+
         @connect(sender=supervisor)
         def on_attach_gui(sender):
             @supervisor.actions.add(shortcut='shift+ctrl+k', set_busy=True)
@@ -107,6 +120,9 @@ class TemplateController(WaveformMixin, FeatureMixin, TemplateMixin, TraceMixin,
 
     def _set_similarity_functions(self):
         super(TemplateController, self)._set_similarity_functions()
+        # The mean waveforms require the raw data.
+        if self.model.traces is None:
+            self.similarity_functions.pop('mean_waveform', None)
         self.similarity_functions['template'] = self.template_similarity
         self.similarity = 'template'
 
@@ -141,34 +157,43 @@ class TemplateController(WaveformMixin, FeatureMixin, TemplateMixin, TraceMixin,
         super(TemplateController, self)._set_view_creator()
         self.view_creator['TemplateFeatureView'] = self.create_template_feature_view
 
+    def _compute_best_channels(self, cluster_ids):
+        """Return the best channels of several clusters, which are those of their largest
+        templates. The largest templates are looked up at once in the template count matrix,
+        so that a new cluster reuses the channels of a template of its parents."""
+        template_ids = self.get_templates_for_clusters(cluster_ids)
+        unique, inv = np.unique(template_ids, return_inverse=True)
+        channels = [self.get_template_channels(t) for t in unique]
+        return [channels[i] for i in inv]
+
     # Public methods
     # -------------------------------------------------------------------------
 
-    def get_best_channels(self, cluster_id):
-        """Return the best channels of a given cluster."""
-        template_id = self.get_template_for_cluster(cluster_id)
+    def get_template_channels(self, template_id):
+        """Return the best channels of a given template."""
         template = self.model.get_template(template_id)
         if not template:  # pragma: no cover
             return [0]
         return template.channel_ids
 
+    def get_template_best_channel(self, template_id):
+        """Return the best channel of a given template."""
+        return self.get_template_channels(template_id)[0]
+
+    def get_best_channel_ids(self, cluster_ids):
+        """Return the best channel id of several clusters, looked up at once in the best
+        channel table."""
+        self._fill_best_channels(cluster_ids)
+        return self.best_channels.best_channel(cluster_ids)
+
     def template_similarity(self, cluster_id):
-        """Return the list of similar clusters to a given cluster."""
-        # Templates of the cluster.
-        temp_i = np.nonzero(self.get_template_counts(cluster_id))[0]
-        # The similarity of the cluster with each template.
-        sims = np.max(self.model.similar_templates[temp_i, :], axis=0)
-
-        def _sim_ij(cj):
-            # Templates of the cluster.
-            if cj < self.model.n_templates:
-                return float(sims[cj])
-            temp_j = np.nonzero(self.get_template_counts(cj))[0]
-            return float(np.max(sims[temp_j]))
-
-        out = [(cj, _sim_ij(cj)) for cj in self.supervisor.clustering.cluster_ids]
-        # NOTE: hard-limit to 100 for performance reasons.
-        return sorted(out, key=itemgetter(1), reverse=True)[:100]
+        """Return the list of similar clusters to a given cluster.
+
+        The 100 most similar clusters are looked up in an index that is updated incrementally
+        after every clustering action.
+
+        """
+        return self._template_similarity.similarity(cluster_id)
 
     def get_template_amplitude(self, template_id):
         """Return the maximum amplitude of a template's waveforms across all channels."""
@@ -204,6 +229,17 @@ def template_gui(params_path, **kwargs):  # pragma: no cover
     controller.model.close()
 
 
+def template_compute_raw_amplitudes(params_path, n_jobs=None):
+    """Compute the raw amplitudes of all spikes of a template dataset, without GUI."""
+    p = Path(params_path)
+    dir_path = p.parent
+    _add_log_file(dir_path / 'phy.log')
+
+    controller = TemplateController(model=load_model(params_path), dir_path=dir_path)
+    controller.compute_spike_raw_amplitudes(n_jobs=n_jobs)
+    controller.model.close()
+
+
 def template_describe(params_path):
     """Describe a template dataset."""
     model = load_model(params_path)
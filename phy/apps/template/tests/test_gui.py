@@ -98,6 +98,15 @@ class TemplateControllerDenseTests(TemplateControllerTests, unittest.TestCase):
             self.amplitude_view.next_amplitudes_type()
         self.amplitude_view.previous_amplitudes_type()
 
+    def test_compute_spike_raw_amplitudes(self):
+        self.next()
+        store = self.controller.compute_spike_raw_amplitudes()
+        self.assertEqual(len(store['amplitudes']), self.model.n_spikes)
+        # The memory-mapped amplitudes are replaced when they are computed again.
+        self.assertTrue(self.controller.get_mean_spike_raw_amplitudes(self.selected[0]) >= 0)
+        store = self.controller.compute_spike_raw_amplitudes()
+        self.assertEqual(len(store['channels']), self.model.n_spikes)
+
     def test_z1_close_reopen(self):
         cluster_ids = self.cluster_ids
         spike_clusters = self.supervisor.clustering.spike_clusters
@@ -397,6 +397,16 @@ class MockControllerWTests(MinimalControllerTests, unittest.TestCase):
         self.waveform_view.actions.next_waveforms_type()
         self.waveform_view.actions.change_n_spikes_waveforms(200)
 
+    def test_prefetch_waveforms(self):
+        self.next()
+        cluster_id = self.cluster_ids[-1]
+        self.controller._prefetch_waveforms(cluster_id)
+        b = self.controller._get_waveforms(cluster_id)
+        self.assertEqual(b.data.ndim, 3)
+        # Only the waveforms of the selected clusters may be kept for later.
+        self.assertTrue(all(
+            key[0] in self.selected for key in self.controller._extracted_waveforms))
+
     def test_mean_amplitudes(self):
         self.next()
         self.assertTrue(self.controller.get_mean_spike_raw_amplitudes(self.selected[0]) >= 0)
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+
+"""Test the headless curation."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import subprocess
+import sys
+
+import numpy as np
+from numpy.testing import assert_array_equal as ae
+
+from phylib.io.model import load_model
+from phylib.io.tests.conftest import _make_dataset
+
+from phy.cluster.clustering import Clustering
+from ..curate import template_curate, create_template_session, save_spike_clusters_mmap
+
+
+#------------------------------------------------------------------------------
+# Tests
+#------------------------------------------------------------------------------
+
+_SCRIPT = (
+    "session.merge(list(session.cluster_ids[:2]))\n"
+    "session.move('good', [c for c, n in session.get_metric('n_spikes').items() if n > 0])\n")
+
+
+def _check_curated(params_path):
+    model = load_model(params_path)
+    n = model.n_templates
+    assert len(np.unique(model.spike_clusters)) == n - 1
+    assert set(model.metadata['group'].values()) == {'good'}
+    model.close()
+
+
+def test_save_spike_clusters_mmap(tempdir):
+    path = tempdir / 'spike_clusters.npy'
+    np.save(path, np.repeat(np.arange(10), 10))
+    clustering = Clustering(np.load(path, mmap_mode='r'), low_memory=True)
+
+    up = clustering.merge([0, 1])
+    save_spike_clusters_mmap(path, clustering)
+    ae(np.load(path), clustering.spike_clusters)
+    assert clustering.spike_clusters.n_modified == 0
+    assert sorted(p.name for p in tempdir.iterdir()) == ['spike_clusters.npy']
+
+    # The changes after the save are kept in the overlay of the saved file.
+    clustering.split(np.arange(5))
+    assert clustering.spike_clusters.n_modified == 20
+    save_spike_clusters_mmap(path, clustering)
+    ae(np.load(path), clustering.spike_clusters)
+
+    # The actions before the save can still be undone.
+    clustering.undo()
+    clustering.undo()
+    ae(clustering.cluster_ids, np.arange(10))
+    assert up.added[0] not in clustering.cluster_ids
+
+
+def test_template_session(tempdir):
+    model = load_model(_make_dataset(tempdir, param='dense', has_spike_attributes=False))
+    session = create_template_session(model)
+    cluster_ids = list(session.cluster_ids[:3])
+    for name in ('ch', 'depth', 'fr', 'amp'):
+        values = session.get_metric(name, cluster_ids)
+        assert len(values) == 3
+
+    # The metrics follow the clustering actions.
+    amp = session.get_metric('amp', cluster_ids[:1])
+    up = session.merge(cluster_ids[:2])
+    assert session.get_metric('fr', [up.added[0]])[up.added[0]] > 0
+    assert session.get_metric('amp', [up.added[0]])[up.added[0]] > 0
+    session.undo()
+    assert session.get_metric('amp', cluster_ids[:1]) == amp
+    model.close()
+
+
+def test_template_curate(tempdir):
+    params_path = _make_dataset(tempdir, param='dense', has_spike_attributes=False)
+    script_path = tempdir / 'script.py'
+    script_path.write_text(_SCRIPT)
+    session = template_curate(params_path, script_path)
+    assert not session.is_dirty()
+    _check_curated(params_path)
+
+
+def test_template_curate_low_memory(tempdir):
+    params_path = _make_dataset(tempdir, param='dense', has_spike_attributes=False)
+    script_path = tempdir / 'script.py'
+    script_path.write_text(_SCRIPT)
+    template_curate(params_path, script_path, low_memory=True)
+    _check_curated(params_path)
+
+
+def test_template_curate_without_qt(tempdir):
+    params_path = _make_dataset(tempdir, param='dense', has_spike_attributes=False)
+    script_path = tempdir / 'script.py'
+    script_path.write_text(_SCRIPT)
+    # Block the import of Qt and OpenGL in a new interpreter.
+    code = (
+        "import sys\n"
+        "sys.modules['PyQt5'] = None\n"
+        "sys.modules['OpenGL'] = None\n"
+        "from phy.apps.curate import template_curate\n"
+        "import phy.cluster\n"
+        "template_curate(%r, %r)\n"
+        "assert 'phy.gui' not in sys.modules\n" % (str(params_path), str(script_path)))
+    subprocess.run([sys.executable, '-c', code], check=True)
+    _check_curated(params_path)
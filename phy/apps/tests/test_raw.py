@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+
+"""Test the raw data jobs."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+from concurrent.futures import ThreadPoolExecutor, wait
+
+import mtscomp
+import numpy as np
+from numpy.testing import assert_allclose as ac
+from numpy.testing import assert_array_equal as ae
+
+from pytest import raises
+
+from phylib.io.mock import artificial_traces
+from phylib.io.traces import extract_waveforms, MtscompEphysReader
+
+from .._raw import (
+    _coalesce, _spike_chunks, compute_spike_raw_amplitudes, WaveformExtractor,
+    CommonAverageReference, Pipeline, SosFilter, Whitening, ChunkCache, CachedFilteredTraces,
+    DecompressedChunkCache, cache_decompressed_chunks)
+
+
+#------------------------------------------------------------------------------
+# Test preprocessing pipeline
+#------------------------------------------------------------------------------
+
+def test_preprocessing_stages():
+    n_samples, n_channels = 1000, 4
+    rng = np.random.RandomState(0)
+    arr = rng.randn(n_samples, n_channels).astype(np.float32)
+
+    car = CommonAverageReference(n_channels)
+    out = car(arr.copy())
+    ac(np.median(out, axis=1), 0, atol=1e-6)
+    out = CommonAverageReference(n_channels, kind='mean')(arr.copy())
+    ac(out.mean(axis=1), 0, atol=1e-6)
+
+    filt = SosFilter(1000., low=10., high=100.)
+    assert filt.margin == 200
+    out = filt(arr, axis=0)
+    assert out.dtype == np.float32
+    assert out.shape == arr.shape
+    # Filtering along the second axis of waveforms.
+    ac(filt(arr[np.newaxis], axis=1)[0], out, atol=1e-5)
+    assert SosFilter(1000., high=100., margin=5).margin == 5
+
+    wm = rng.randn(n_channels, n_channels)
+    ac(Whitening(wm)(arr), arr @ wm, rtol=1e-4, atol=1e-4)
+
+    pipeline = Pipeline([car, filt, Whitening(wm)])
+    assert pipeline.margin == 200
+    assert pipeline.needs_all_channels
+    out = pipeline(arr)
+    ac(out, filt(car(arr.copy())) @ wm, rtol=1e-4, atol=1e-4)
+    # The stages needing all channels are skipped on a subset of the channels.
+    ac(pipeline(arr[:, :2]), filt(arr[:, :2]), atol=1e-5)
+
+
+def test_pipeline_chunks():
+    n_samples, n_channels = 5000, 4
+    traces = artificial_traces(n_samples, n_channels)
+    pipeline = Pipeline([
+        CommonAverageReference(n_channels), SosFilter(1000., low=20., margin=500)])
+    expected = pipeline(traces)
+
+    chunks = list(pipeline.iter_chunks(traces, 0, n_samples, 1000))
+    assert [(t0, t1) for t0, t1, _ in chunks] == [(i, i + 1000) for i in range(0, 5000, 1000)]
+    out = np.concatenate([data for _, _, data in chunks])
+    assert out.shape == expected.shape
+    # The chunks match the whole processed data away from the edges of the recording.
+    ac(out[500:-500], expected[500:-500], atol=1e-3 * np.abs(expected).max())
+
+    out = pipeline.process(traces, 2000, 2500, channel_ids=[3, 1])
+    ac(out, expected[2000:2500, [3, 1]], atol=1e-3 * np.abs(expected).max())
+
+
+#------------------------------------------------------------------------------
+# Test spike raw amplitudes
+#------------------------------------------------------------------------------
+
+def test_spike_chunks():
+    assert _spike_chunks([], 10) == []
+    assert _spike_chunks(np.array([0, 3, 9, 10, 25, 26]), 10) == [(0, 3), (3, 4), (4, 6)]
+
+
+def test_compute_spike_raw_amplitudes():
+    n_samples, n_channels, n_spikes, nsw = 2000, 8, 100, 20
+    rng = np.random.RandomState(0)
+    traces = artificial_traces(n_samples, n_channels)
+    # Unsorted spikes, including spikes at the edges of the recording.
+    spike_samples = np.r_[0, n_samples - 1, rng.randint(0, n_samples, n_spikes - 2)]
+    spike_channels = rng.randint(0, n_channels, n_spikes)
+
+    def filter(arr, axis=None):
+        return 2 * arr
+
+    amplitudes = compute_spike_raw_amplitudes(
+        traces, spike_samples, spike_channels, nsw, filter=filter, chunk_size=100, n_jobs=3)
+    assert amplitudes.shape == (n_spikes,)
+
+    for i in range(n_spikes):
+        w = extract_waveforms(traces, spike_samples[i:i + 1], [spike_channels[i]], nsw)
+        w = filter(w[0, :, 0].astype(np.float32), axis=0)
+        ac(amplitudes[i], w.max() - w.min(), rtol=1e-5)
+
+    # With a pipeline, the amplitudes match the waveforms extracted with the same pipeline.
+    pipeline = Pipeline([CommonAverageReference(n_channels), SosFilter(1000., low=50.)])
+    amplitudes = compute_spike_raw_amplitudes(
+        traces, spike_samples, spike_channels, nsw, filter=pipeline, chunk_size=100)
+    extractor = WaveformExtractor(traces, nsw)
+    for i in range(n_spikes):
+        w = extractor.extract([(spike_samples[i:i + 1], [spike_channels[i]])], pipeline)[0]
+        ac(amplitudes[i], w.max() - w.min(), rtol=1e-2)
+
+
+#------------------------------------------------------------------------------
+# Test batched waveform extraction
+#------------------------------------------------------------------------------
+
+def test_coalesce():
+    starts, ends = np.array([0, 5, 30, 32, 100]), np.array([10, 15, 40, 42, 110])
+    assert _coalesce(starts, ends, 0, 1000) == [(0, 15, 0, 2), (30, 42, 2, 4), (100, 110, 4, 5)]
+    assert _coalesce(starts, ends, 100, 1000) == [(0, 110, 0, 5)]
+    assert _coalesce(starts, ends, 100, 40) == [(0, 40, 0, 3), (32, 42, 3, 4), (100, 110, 4, 5)]
+
+
+def test_waveform_extractor():
+    n_samples, n_channels, nsw = 2000, 8, 20
+    rng = np.random.RandomState(0)
+    traces = artificial_traces(n_samples, n_channels)
+    requests = [
+        (np.sort(rng.randint(0, n_samples, 10)), [3, 1]),
+        (np.r_[0, 500, 501, n_samples - 1], [0, 1, 7]),
+        (np.zeros(0, dtype=np.int64), [2]),
+    ]
+    calls = []
+
+    def filter(arr, axis=None):
+        calls.append(arr.shape)
+        return 2 * arr
+
+    for readahead in (0, 2):
+        del calls[:]
+        extractor = WaveformExtractor(
+            traces, nsw, max_gap=100, max_block_size=500, readahead=readahead)
+        out = extractor.extract(requests, filter=filter)
+        assert len(out) == len(requests)
+        for (samples, channel_ids), waveforms in zip(requests, out):
+            assert waveforms.shape == (len(samples), nsw, len(channel_ids))
+            expected = extract_waveforms(traces, samples, channel_ids, nsw)
+            ac(waveforms, 2 * expected, rtol=1e-6)
+        # Every block is filtered once, on the union of the channels.
+        assert 0 < len(calls) < 14
+        assert all(shape[1] == 5 for shape in calls)
+
+    assert extractor.extract([]) == []
+
+
+#------------------------------------------------------------------------------
+# Test filtered chunk cache
+#------------------------------------------------------------------------------
+
+def test_chunk_cache(tempdir):
+    rng = np.random.RandomState(0)
+    data = rng.randn(1000, 4).astype(np.float32)
+    data[:, 2] = 0
+
+    cache = ChunkCache(tempdir / 'chunks', 20000)
+    assert cache.get(('f', 0)) is None
+    out = cache.put(('f', 0), data)
+    assert ('f', 0) in cache
+    ac(out, data, atol=np.abs(data).max() / 32767)
+    ac(cache.get(('f', 0)), out)
+    # The chunks are stored as int16.
+    assert 8000 < cache.size < 9000
+
+    # The least recently used chunk is evicted.
+    cache.put(('f', 1), data)
+    cache.get(('f', 0))
+    cache.put(('f', 2), data)
+    assert ('f', 0) in cache
+    assert ('f', 1) not in cache
+    assert ('f', 2) in cache
+    assert cache.size <= 20000
+
+    # The cache is persistent.
+    cache = ChunkCache(tempdir / 'chunks', 20000)
+    ac(cache.get(('f', 2)), out)
+    assert cache.get(('f', 1)) is None
+
+
+def test_cached_filtered_traces(tempdir):
+    n_samples, n_channels = 5000, 4
+    traces = artificial_traces(n_samples, n_channels)
+    pipeline = Pipeline([SosFilter(1000., low=20., margin=500)])
+    calls = []
+
+    def filter(arr, axis=0):
+        calls.append(arr.shape)
+        return pipeline(arr, axis=axis)
+    filter.margin = pipeline.margin
+
+    cache = ChunkCache(tempdir / 'chunks', 10 * 1024 ** 2)
+    filtered = CachedFilteredTraces(traces, filter, cache, 'high_pass', chunk_size=1000)
+    assert filtered.shape == traces.shape
+    assert len(filtered) == n_samples
+
+    expected = pipeline(traces)
+    atol = 1e-3 * np.abs(expected).max()
+    ac(filtered[1500:3200], expected[1500:3200], atol=atol)
+    assert calls == [(2000, n_channels)] * 3
+    ac(filtered[2000:2100, [3, 1]], expected[2000:2100, [3, 1]], atol=atol)
+    ac(filtered[-10:], pipeline.process(traces, n_samples - 10, n_samples), atol=atol)
+    assert len(calls) == 4
+    assert filtered[10:10].shape == (0, n_channels)
+
+    # The waveform extractor reads the filtered chunks, which are already in the cache.
+    samples = np.array([1200, 2500, 4990])
+    out = WaveformExtractor(filtered, 20, margin=0).extract([(samples, [0, 2])])[0]
+    ac(out[:2], WaveformExtractor(traces, 20, margin=500).extract(
+        [(samples[:2], [0, 2])], filter=pipeline)[0], atol=atol)
+    assert len(calls) == 4
+
+    # The chunks of a filter with the same name but other parameters are not reused.
+    other = Pipeline([SosFilter(1000., low=50., margin=500)])
+    filtered = CachedFilteredTraces(traces, other, cache, 'high_pass', chunk_size=1000)
+    ac(filtered[1500:1600], other(traces)[1500:1600], atol=atol)
+    filtered = CachedFilteredTraces(
+        traces[:, :2], pipeline, cache, 'high_pass', chunk_size=1000)
+    assert filtered[:10].shape == (10, 2)
+
+    # The chunks are reused by an identical filter.
+    n = len(cache._index)
+    filtered = CachedFilteredTraces(
+        traces, Pipeline([SosFilter(1000., low=50., margin=500)]), cache, 'high_pass',
+        chunk_size=1000)
+    filtered[1500:1600]
+    assert len(cache._index) == n
+
+
+#------------------------------------------------------------------------------
+# Test decompressed chunk cache
+#------------------------------------------------------------------------------
+
+def _compress(tempdir, n_channels):
+    """Save raw data with 10 chunks of 1000 samples in an mtscomp compressed file."""
+    arr = (100 * artificial_traces(10000, n_channels)).astype(np.int16)
+    arr.tofile(tempdir / 'data.bin')
+    mtscomp.compress(
+        tempdir / 'data.bin', tempdir / 'data.cbin', tempdir / 'data.ch',
+        sample_rate=1000., n_channels=n_channels, dtype=np.int16, chunk_duration=1.)
+    return arr
+
+
+def test_decompressed_chunk_cache(tempdir):
+    n_channels = 4
+    arr = _compress(tempdir, n_channels)
+    reader = mtscomp.Reader()
+    reader.open(tempdir / 'data.cbin', tempdir / 'data.ch')
+    assert reader.n_chunks == 10
+    # Every chunk takes 8000 bytes.
+    cache = DecompressedChunkCache(reader, max_size=5 * 8000, n_threads=2, prefetch=2)
+    assert cache.shape == arr.shape
+    assert cache.n_chunks == 10
+
+    ae(cache[1500:3200], arr[1500:3200])
+    ae(cache[2000:2100, [3, 1]], arr[2000:2100, [3, 1]])
+    ae(cache[-10:], arr[-10:])
+    ae(cache[-1], arr[-1])
+    ae(cache[5, 2], arr[5, 2])
+    ae(cache[:0], arr[:0])
+    with raises(IndexError):
+        cache[10000]
+
+    # The cache is bounded, and the last chunk is kept.
+    cache.close()
+    ae(cache[9500:], arr[9500:])
+    assert 9 in cache._chunks
+    assert cache.size <= cache.max_size
+    # Reading backward prefetches the previous chunks.
+    cache[8500:8600]
+    wait(cache._prefetching)
+    assert {6, 7, 8} <= set(cache._chunks)
+
+    # Concurrent reads of the same chunks.
+    cache.close()
+    with ThreadPoolExecutor(4) as executor:
+        for out in executor.map(lambda i: cache[i:i + 2000], range(0, 8000, 500)):
+            assert out.shape == (2000, n_channels)
+    ae(cache[:], arr)
+    cache.close()
+
+
+def test_cache_decompressed_chunks(tempdir):
+    assert cache_decompressed_chunks(None) is None
+    assert cache_decompressed_chunks(np.zeros((10, 2))) is None
+
+    arr = _compress(tempdir, 4)
+    reader = mtscomp.Reader()
+    reader.open(tempdir / 'data.cbin', tempdir / 'data.ch')
+    traces = MtscompEphysReader(reader)[:, [2, 0]]
+    cache = cache_decompressed_chunks(traces, max_size=1024 ** 2)
+    assert isinstance(cache, DecompressedChunkCache)
+    assert cache_decompressed_chunks(traces) is cache
+    ae(traces[1500:3200], arr[1500:3200, [2, 0]])
+    assert set(cache._chunks) >= {1, 2, 3}
+    cache.close()
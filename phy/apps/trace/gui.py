@@ -15,6 +15,7 @@ import numpy as np
 from phylib.io.model import load_raw_data
 from phylib.utils import Bunch
 
+from phy.apps._raw import cache_decompressed_chunks
 from phy.apps.template import get_template_params
 from phy.cluster.views.trace import TraceView, select_traces
 from phy.gui import create_app, run_app, GUI
@@ -54,6 +55,8 @@ def create_trace_gui(dat_path, **kwargs):
 
     if dat_path.suffix == '.cbin':  # pragma: no cover
         data = load_raw_data(path=dat_path)
+        # Decompress the chunks in parallel, and keep them while scrolling.
+        cache_decompressed_chunks(data)
         sample_rate = data.sample_rate
         n_channels_dat = data.shape[1]
     else:
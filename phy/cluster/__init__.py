@@ -3,7 +3,48 @@
 
 """Manual clustering facilities."""
 
-from ._utils import ClusterMeta, UpdateInfo
+from importlib import import_module
+
+from ._utils import ClusterMeta, UpdateInfo, batch_metric
 from .clustering import Clustering
-from .supervisor import Supervisor, ClusterView, SimilarityView
-from .views import *  # noqa
+from .session import CurationSession
+
+# NOTE: the supervisor and the views depend on Qt and OpenGL, they are only imported when they
+# are used, so that the headless curation session can be used on a machine without display.
+_LAZY = {
+    'Supervisor': '.supervisor',
+    'ClusterView': '.supervisor',
+    'SimilarityView': '.supervisor',
+    'NativeClusterView': '.supervisor',
+    'NativeSimilarityView': '.supervisor',
+    'ManualClusteringView': '.views',
+    'AmplitudeView': '.views',
+    'CorrelogramView': '.views',
+    'FeatureView': '.views',
+    'HistogramView': '.views',
+    'ISIView': '.views',
+    'FiringRateView': '.views',
+    'ProbeView': '.views',
+    'RasterView': '.views',
+    'ScatterView': '.views',
+    'TemplateView': '.views',
+    'TraceView': '.views',
+    'TraceImageView': '.views',
+    'select_traces': '.views',
+    'WaveformView': '.views',
+}
+
+# The lazy names are imported by `from phy.cluster import *`.
+__all__ = [
+    'ClusterMeta', 'UpdateInfo', 'batch_metric', 'Clustering', 'CurationSession',
+] + list(_LAZY)
+
+
+def __getattr__(name):
+    if name not in _LAZY:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    return getattr(import_module(_LAZY[name], __name__), name)
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_LAZY))
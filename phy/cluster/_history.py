@@ -6,30 +6,206 @@
 # Imports
 #------------------------------------------------------------------------------
 
+import logging
+from pathlib import Path
+import pickle
+import tempfile
+import zlib
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+#------------------------------------------------------------------------------
+# Spilling history items to disk
+#------------------------------------------------------------------------------
+
+def _nbytes(item):
+    """Approximate memory size of a history item, only counting NumPy arrays."""
+    if isinstance(item, np.ndarray):
+        return item.nbytes
+    elif isinstance(item, (tuple, list)):
+        return sum(_nbytes(x) for x in item)
+    elif isinstance(item, dict):
+        return sum(_nbytes(x) for x in item.values())
+    return 0
+
+
+class _EncodedArray(object):
+    """Compressed one-dimensional integer array.
+
+    Sorted arrays (like spike ids) are delta-encoded. The values are stored with the smallest
+    integer type and compressed with zlib.
+
+    """
+    def __init__(self, arr):
+        self.dtype = arr.dtype
+        self.delta = len(arr) > 1 and bool(np.all(arr[1:] >= arr[:-1]))
+        if self.delta:
+            arr = np.diff(arr, prepend=0)
+        dtype = np.result_type(
+            np.min_scalar_type(arr.min()), np.min_scalar_type(arr.max())) if len(arr) else np.int8
+        self.storage_dtype = dtype
+        self.data = zlib.compress(arr.astype(dtype).tobytes(), 1)
+
+    def decode(self):
+        arr = np.frombuffer(zlib.decompress(self.data), dtype=self.storage_dtype)
+        if self.delta:
+            arr = np.cumsum(arr, dtype=np.int64)
+        return arr.astype(self.dtype)
+
+
+def _encode(obj):
+    """Compress the integer arrays in a history item."""
+    if isinstance(obj, np.ndarray) and obj.ndim == 1 and obj.dtype.kind in 'iu':
+        return _EncodedArray(obj)
+    elif type(obj) in (tuple, list):
+        return type(obj)(_encode(x) for x in obj)
+    return obj
+
+
+def _decode(obj):
+    """Decompress the arrays in a history item."""
+    if isinstance(obj, _EncodedArray):
+        return obj.decode()
+    elif type(obj) in (tuple, list):
+        return type(obj)(_decode(x) for x in obj)
+    return obj
+
+
+class _Spilled(object):
+    """Placeholder for a history item stored on disk."""
+    def __init__(self, offset, size):
+        self.offset = offset
+        self.size = size
+
+
+class _SpillFile(object):
+    """Append-only file with the history items spilled to disk."""
+    def __init__(self, path=None):
+        if path is None:
+            self._f = tempfile.TemporaryFile()
+        else:
+            path = Path(path)
+            path.parent.mkdir(parents=True, exist_ok=True)
+            self._f = open(path, 'w+b')
+
+    def write(self, item):
+        data = pickle.dumps(_encode(item), protocol=pickle.HIGHEST_PROTOCOL)
+        self._f.seek(0, 2)
+        offset = self._f.tell()
+        self._f.write(data)
+        return _Spilled(offset, len(data))
+
+    def read(self, spilled):
+        self._f.seek(spilled.offset)
+        return _decode(pickle.loads(self._f.read(spilled.size)))
+
+    def clear(self):
+        self._f.seek(0)
+        self._f.truncate()
+
+    def __del__(self):
+        self._f.close()
+
 
 #------------------------------------------------------------------------------
 # History class
 #------------------------------------------------------------------------------
 
 class History(object):
-    """Implement a history of actions with an undo stack."""
-
-    def __init__(self, base_item=None):
+    """Implement a history of actions with an undo stack.
+
+    Constructor
+    -----------
+
+    base_item : object
+        The first item in the history, which cannot be undone.
+    max_memory : int
+        If set, maximum size in bytes of the NumPy arrays contained in the history items kept
+        in memory. When the history grows beyond this size, the items that are the furthest
+        from the current position are compressed and spilled to disk. They are transparently
+        loaded back when needed, for example on undo.
+    path : str or Path
+        Path to the file where the history items are spilled (a temporary file by default).
+
+    """
+
+    def __init__(self, base_item=None, max_memory=None, path=None):
+        self._max_memory = max_memory
+        self._path = path
+        self._spill_file = None
         self.clear(base_item)
 
     def clear(self, base_item=None):
         """Clear the history."""
         # List of changes, contains at least the base item.
         self._history = [base_item]
+        # Memory size of every item (0 for items spilled to disk), and location of the
+        # items that have been spilled at least once.
+        self._nbytes = [0]
+        self._spilled = [None]
+        self._total_nbytes = 0
+        if self._spill_file:
+            self._spill_file.clear()
         # Index of the current item.
         self._index = 0
 
+    def set_max_memory(self, max_memory, path=None):
+        """Set the maximum memory size of the history items, beyond which older items are
+        spilled to disk."""
+        self._max_memory = max_memory
+        # NOTE: the spill file cannot change once some items have been spilled.
+        if self._spill_file is None:
+            self._path = path
+        self._check_memory()
+
+    @property
+    def n_spilled(self):
+        """Number of history items that are currently stored on disk."""
+        return sum(1 for item in self._history if isinstance(item, _Spilled))
+
+    def _get(self, i):
+        """Return the i-th item, loading it from disk if needed."""
+        item = self._history[i]
+        if not isinstance(item, _Spilled):
+            return item
+        logger.log(5, "Load history item %d from disk.", i)
+        item = self._spill_file.read(item)
+        self._history[i] = item
+        self._nbytes[i] = _nbytes(item)
+        self._total_nbytes += self._nbytes[i]
+        self._check_memory(keep=i)
+        return item
+
+    def _spill(self, i):
+        """Spill the i-th item to disk."""
+        if self._spilled[i] is None:
+            if self._spill_file is None:
+                self._spill_file = _SpillFile(self._path)
+            self._spilled[i] = self._spill_file.write(self._history[i])
+        self._history[i] = self._spilled[i]
+        self._total_nbytes -= self._nbytes[i]
+        self._nbytes[i] = 0
+
+    def _check_memory(self, keep=None):
+        """Spill the items the furthest from the current position until the history fits in
+        the memory budget."""
+        if self._max_memory is None or self._total_nbytes <= self._max_memory:
+            return
+        candidates = sorted(
+            (i for i in range(1, len(self._history)) if self._nbytes[i] and i != keep),
+            key=lambda i: abs(i - self._index))
+        while candidates and self._total_nbytes > self._max_memory:
+            self._spill(candidates.pop())
+
     @property
     def current_item(self):
         """Return the current element."""
         if self._history and self._index >= 0:
             self._check_index()
-            return self._history[self._index]
+            return self._get(self._index)
 
     @property
     def current_position(self):
@@ -72,7 +248,7 @@ class History(object):
         assert 0 <= end <= len(self._history)
         assert 0 <= start <= end - 1
         for i in range(start, end):
-            yield self._history[i]
+            yield self._get(i)
 
     def __iter__(self):
         return self.iter()
@@ -84,12 +260,19 @@ class History(object):
         """Add an item in the history."""
         self._check_index()
         # Possibly truncate the history up to the current point.
-        self._history = self._history[:self._index + 1]
+        n = self._index + 1
+        self._total_nbytes -= sum(self._nbytes[n:])
+        self._history, self._nbytes, self._spilled = (
+            self._history[:n], self._nbytes[:n], self._spilled[:n])
         # Append the item
         self._history.append(item)
+        self._nbytes.append(_nbytes(item))
+        self._spilled.append(None)
+        self._total_nbytes += self._nbytes[-1]
         # Increment the index.
         self._index += 1
         self._check_index()
+        self._check_memory(keep=self._index)
         # Check that the current element is what was provided to the function.
         assert id(self.current_item) == id(item)
 
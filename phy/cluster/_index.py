@@ -0,0 +1,832 @@
+# -*- coding: utf-8 -*-
+
+"""Compact indices of the spikes, templates, and channels of every cluster."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+from bisect import bisect_left, insort
+import logging
+from threading import Lock
+
+import numpy as np
+
+from phylib.utils._types import _as_array
+
+logger = logging.getLogger(__name__)
+
+
+#------------------------------------------------------------------------------
+# Utils
+#------------------------------------------------------------------------------
+
+def _grow(arr, n, fill=None):
+    """Return an array with the same first items as `arr`, with a capacity of at least `n`
+    items. The array is only reallocated if needed, and its capacity is at least doubled."""
+    if n <= len(arr):
+        return arr
+    out = np.empty(max(n, 2 * len(arr)), dtype=arr.dtype)
+    out[:len(arr)] = arr
+    if fill is not None:
+        out[len(arr):] = fill
+    return out
+
+
+def _iter_chunks(arr, chunk_size):
+    """Yield the offset and the contents of the successive chunks of a one-dimensional array,
+    which may be memory-mapped or an `OverlayArray`, so that it is never loaded entirely."""
+    for i in range(0, len(arr), chunk_size):
+        yield i, np.asarray(arr[i:i + chunk_size])
+
+
+def _group(spike_ids, spike_clusters):
+    """Sort spikes by cluster and then by spike id. Return the sorted spike ids, the start
+    and end indices of every group, and the cluster id of every group."""
+    spike_ids = _as_array(spike_ids, dtype=np.int64)
+    spike_clusters = _as_array(spike_clusters)
+    order = np.lexsort((spike_ids, spike_clusters))
+    spike_ids = spike_ids[order]
+    spike_clusters = spike_clusters[order]
+    bounds = np.nonzero(np.diff(spike_clusters))[0] + 1
+    starts = np.r_[0, bounds]
+    ends = np.r_[bounds, len(spike_ids)]
+    return spike_ids, starts, ends, spike_clusters[starts]
+
+
+def _count_pairs(spike_clusters, spike_templates):
+    """Count the spikes of every (cluster, template) pair. Return the sorted templates and
+    counts of every cluster, the end index of every cluster, and the cluster ids."""
+    spike_clusters = _as_array(spike_clusters, dtype=np.int64)
+    spike_templates = _as_array(spike_templates, dtype=np.int64)
+    assert spike_clusters.shape == spike_templates.shape
+    if not len(spike_clusters):
+        empty = np.zeros(0, dtype=np.int64)
+        return empty, empty, empty, empty
+    n = int(spike_templates.max()) + 1
+    pairs, counts = np.unique(spike_clusters * n + spike_templates, return_counts=True)
+    clusters, templates = pairs // n, pairs % n
+    bounds = np.nonzero(np.diff(clusters))[0] + 1
+    ends = np.r_[bounds, len(pairs)]
+    return templates, counts.astype(np.int64), ends, clusters[ends - 1]
+
+
+#------------------------------------------------------------------------------
+# SpikesPerCluster class
+#------------------------------------------------------------------------------
+
+class SpikesPerCluster(object):
+    """Compact CSR index of the spikes belonging to every cluster.
+
+    The index is made of three arrays: the spike ids sorted by cluster, the offsets of every
+    cluster in the spike array, and the id of every cluster. These arrays can be saved
+    to and loaded from `.npy` files, in which case the spike array can be memory-mapped.
+
+    The object implements a read-only dictionary interface `{cluster_id: spike_ids}`, where
+    the spike ids are returned as array views, without copy.
+
+    Constructor
+    -----------
+
+    spikes : array-like
+        The spike ids, sorted by cluster, and by increasing spike id within every cluster.
+    offsets : array-like
+        The `(n_clusters + 1,)` offsets of every cluster in the `spikes` array.
+    clusters : array-like
+        The `(n_clusters,)` cluster ids.
+
+    Notes
+    -----
+
+    Changes are done in place in amortized time proportional to the number of affected spikes:
+    the spikes of new clusters are appended at the end of the index, whereas the spikes of
+    removed clusters are marked as deleted. The index is compacted when deleted spikes take
+    more space than the live ones.
+
+    """
+
+    def __init__(self, spikes=None, offsets=None, clusters=None):
+        spikes = spikes if spikes is not None else np.zeros(0, dtype=np.int64)
+        offsets = offsets if offsets is not None else np.zeros(1, dtype=np.int64)
+        clusters = clusters if clusters is not None else np.zeros(0, dtype=np.int64)
+        assert len(offsets) == len(clusters) + 1
+        assert offsets[0] == 0 and offsets[-1] == len(spikes)
+        # NOTE: the base spike array may be memory-mapped and read-only, new clusters are
+        # appended to a separate buffer.
+        self._base = spikes
+        self._extra = np.zeros(0, dtype=np.int64)
+        self._n_extra = 0
+        # Per-segment arrays, a removed segment has a cluster id of -1.
+        self._n_segments = len(clusters)
+        self._offsets = np.array(offsets, dtype=np.int64)
+        self._clusters = np.array(clusters, dtype=np.int64)
+        assert np.all(self._clusters >= 0)
+        # Map cluster ids to segment indices (-1 for non-existing clusters).
+        n = int(self._clusters.max()) + 1 if len(self._clusters) else 0
+        self._lookup = np.full(n, -1, dtype=np.int64)
+        self._lookup[self._clusters] = np.arange(self._n_segments)
+        self._n_dead = 0
+        # Whether the index has changed since it was created from arrays.
+        self.is_dirty = False
+
+    @classmethod
+    def from_spike_clusters(cls, spike_clusters, chunk_size=2 ** 22):
+        """Create the index from a spike-clusters assignment array. Negative cluster ids
+        are ignored.
+
+        The array is read in chunks, so that a memory-mapped array or an `OverlayArray` is never
+        loaded entirely: the spikes of every cluster are counted in a first pass, and they are
+        written to their place in the index in a second pass.
+
+        """
+        # First pass: number of spikes in every cluster.
+        counts = np.zeros(0, dtype=np.int64)
+        for _, chunk in _iter_chunks(spike_clusters, chunk_size):
+            chunk = chunk[chunk >= 0]
+            if len(chunk):
+                c = np.bincount(chunk)
+                counts = np.r_[counts, np.zeros(max(0, len(c) - len(counts)), dtype=np.int64)]
+                counts[:len(c)] += c
+        clusters = np.nonzero(counts)[0]
+        offsets = np.r_[0, np.cumsum(counts[clusters])].astype(np.int64)
+        # Second pass: every spike is written after the spikes of the same cluster in the
+        # previous chunks, so that the spike ids are increasing within every cluster.
+        spikes = np.empty(offsets[-1], dtype=np.int64)
+        start = np.zeros(len(counts), dtype=np.int64)
+        start[clusters] = offsets[:-1]
+        for i, chunk in _iter_chunks(spike_clusters, chunk_size):
+            spike_ids = np.nonzero(chunk >= 0)[0]
+            chunk = chunk[spike_ids]
+            if not len(chunk):
+                continue
+            # NOTE: this sort method is stable, spike ids are increasing within every cluster.
+            order = np.argsort(chunk, kind='mergesort')
+            spike_ids, chunk = spike_ids[order] + i, chunk[order]
+            first = np.r_[0, np.nonzero(np.diff(chunk))[0] + 1]
+            sizes = np.diff(np.r_[first, len(chunk)])
+            rank = np.arange(len(chunk)) - np.repeat(first, sizes)
+            spikes[start[chunk] + rank] = spike_ids
+            start[chunk[first]] += sizes
+        spc = cls(spikes, offsets, clusters)
+        spc.is_dirty = True
+        return spc
+
+    @classmethod
+    def from_dict(cls, spikes_per_cluster):
+        """Create the index from a `{cluster_id: spike_ids}` dictionary."""
+        clusters = np.array(sorted(spikes_per_cluster), dtype=np.int64)
+        arrs = [_as_array(spikes_per_cluster[c], dtype=np.int64) for c in clusters]
+        spikes = np.concatenate(arrs) if arrs else np.zeros(0, dtype=np.int64)
+        offsets = np.r_[0, np.cumsum([len(arr) for arr in arrs], dtype=np.int64)]
+        spc = cls(spikes, offsets, clusters)
+        spc.is_dirty = True
+        return spc
+
+    # Internal methods
+    # -------------------------------------------------------------------------
+
+    def _segment_index(self, cluster_id):
+        """Return the segment index of a cluster, or -1 if it does not exist."""
+        if 0 <= cluster_id < len(self._lookup):
+            return self._lookup[cluster_id]
+        return -1
+
+    def _segment(self, i):
+        """Return the spike ids in a given segment, as a read-only view."""
+        o0, o1 = self._offsets[i], self._offsets[i + 1]
+        nb = len(self._base)
+        out = self._base[o0:o1] if o0 < nb else self._extra[o0 - nb:o1 - nb]
+        out = out.view()
+        out.flags.writeable = False
+        return out
+
+    def _segment_indices(self, cluster_ids):
+        """Return the segment indices of existing clusters among a list of clusters."""
+        cluster_ids = _as_array(cluster_ids, dtype=np.int64)
+        cluster_ids = cluster_ids[(cluster_ids >= 0) & (cluster_ids < len(self._lookup))]
+        idx = self._lookup[cluster_ids]
+        return idx[idx >= 0]
+
+    def _append(self, spikes, ends, clusters):
+        """Append new segments to the index."""
+        n, k = self._n_extra, len(clusters)
+        end = self._offsets[self._n_segments]
+        # Append the spikes.
+        self._extra = _grow(self._extra, n + len(spikes))
+        self._extra[n:n + len(spikes)] = spikes
+        self._n_extra += len(spikes)
+        # Append the segments.
+        s = self._n_segments
+        self._offsets = _grow(self._offsets, s + k + 1)
+        self._offsets[s + 1:s + k + 1] = end + ends
+        self._clusters = _grow(self._clusters, s + k)
+        self._clusters[s:s + k] = clusters
+        self._lookup = _grow(self._lookup, int(clusters.max()) + 1 if k else 0, fill=-1)
+        self._lookup[clusters] = np.arange(s, s + k)
+        self._n_segments += k
+        self.is_dirty = True
+        # Compact the index if there are too many removed spikes.
+        if self._n_dead > max(self.n_spikes, 1024):
+            self.compact()
+
+    # Public methods
+    # -------------------------------------------------------------------------
+
+    @property
+    def cluster_ids(self):
+        """Sorted array of the cluster ids in the index."""
+        return np.nonzero(self._lookup >= 0)[0]
+
+    @property
+    def n_spikes(self):
+        """Total number of spikes in the index."""
+        return int(self._offsets[self._n_segments]) - self._n_dead
+
+    def counts(self, cluster_ids):
+        """Return the number of spikes in each of the specified clusters."""
+        cluster_ids = _as_array(cluster_ids, dtype=np.int64)
+        out = np.zeros(len(cluster_ids), dtype=np.int64)
+        valid = (cluster_ids >= 0) & (cluster_ids < len(self._lookup))
+        idx = self._lookup[cluster_ids[valid]]
+        sizes = np.where(idx >= 0, self._offsets[idx + 1] - self._offsets[idx], 0)
+        out[valid] = sizes
+        return out
+
+    def spikes_in_clusters(self, cluster_ids):
+        """Return the sorted array of spike ids belonging to a list of clusters."""
+        arrs = [self._segment(i) for i in self._segment_indices(cluster_ids)]
+        if not arrs:
+            return np.array([], dtype=np.int64)
+        elif len(arrs) == 1:
+            return arrs[0].copy()
+        return np.sort(np.concatenate(arrs))
+
+    def remove(self, cluster_ids):
+        """Remove some clusters from the index."""
+        idx = self._segment_indices(cluster_ids)
+        if not len(idx):
+            return
+        self._n_dead += int(np.sum(self._offsets[idx + 1] - self._offsets[idx]))
+        self._lookup[self._clusters[idx]] = -1
+        self._clusters[idx] = -1
+        self.is_dirty = True
+
+    def add(self, cluster_id, spike_ids):
+        """Add a cluster with a sorted array of spike ids, replacing the cluster if it
+        already exists."""
+        self.remove([cluster_id])
+        spike_ids = _as_array(spike_ids, dtype=np.int64)
+        self._append(spike_ids, np.array([len(spike_ids)]), np.array([cluster_id]))
+
+    def assign(self, spike_ids, spike_clusters):
+        """Add clusters given the cluster ids of some spikes, replacing existing clusters."""
+        if not len(spike_ids):
+            return
+        spike_ids, _, ends, clusters = _group(spike_ids, spike_clusters)
+        self.remove(clusters)
+        self._append(spike_ids, ends, clusters)
+
+    def compact(self):
+        """Rewrite the index in memory, without the removed spikes, and sorted by cluster."""
+        logger.log(5, "Compact the spikes per cluster index.")
+        cluster_ids = self.cluster_ids
+        arrs = [self._segment(i) for i in self._lookup[cluster_ids]]
+        spikes = np.concatenate(arrs) if arrs else np.zeros(0, dtype=np.int64)
+        offsets = np.r_[0, np.cumsum([len(arr) for arr in arrs], dtype=np.int64)]
+        is_dirty = self.is_dirty
+        self.__init__(spikes, offsets, cluster_ids)
+        self.is_dirty = is_dirty
+
+    def to_arrays(self):
+        """Return the compacted index as a dictionary with the `spikes`, `offsets`, and
+        `clusters` arrays."""
+        if self._n_dead or self._n_extra:
+            self.compact()
+        return {
+            'spikes': self._base,
+            'offsets': self._offsets[:self._n_segments + 1],
+            'clusters': self._clusters[:self._n_segments],
+        }
+
+    # Dictionary interface
+    # -------------------------------------------------------------------------
+
+    def __getitem__(self, cluster_id):
+        i = self._segment_index(cluster_id)
+        if i < 0:
+            raise KeyError(cluster_id)
+        return self._segment(i)
+
+    def get(self, cluster_id, default=None):
+        i = self._segment_index(cluster_id)
+        return self._segment(i) if i >= 0 else default
+
+    def __contains__(self, cluster_id):
+        return self._segment_index(cluster_id) >= 0
+
+    def __len__(self):
+        return len(self.cluster_ids)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        return [int(c) for c in self.cluster_ids]
+
+    def values(self):
+        return [self[c] for c in self.keys()]
+
+    def items(self):
+        return [(c, self[c]) for c in self.keys()]
+
+    def __repr__(self):
+        return '<SpikesPerCluster %d clusters, %d spikes>' % (len(self), self.n_spikes)
+
+
+#------------------------------------------------------------------------------
+# TemplateCounts class
+#------------------------------------------------------------------------------
+
+class TemplateCounts(object):
+    """Sparse CSR matrix with the number of spikes of every template in every cluster.
+
+    The matrix is made of four arrays: the template ids and the spike counts of the non-zero
+    entries, sorted by cluster and by template within every cluster, the offsets of every
+    cluster in these arrays, and the id of every cluster.
+
+    Constructor
+    -----------
+
+    templates : array-like
+        The template ids of the non-zero entries.
+    counts : array-like
+        The number of spikes of the non-zero entries.
+    offsets : array-like
+        The `(n_clusters + 1,)` offsets of every cluster in the `templates` and `counts` arrays.
+    clusters : array-like
+        The `(n_clusters,)` cluster ids.
+    n_templates : int
+        The total number of templates.
+
+    Notes
+    -----
+
+    As with `SpikesPerCluster`, the rows of new clusters are appended at the end of the arrays,
+    and the rows of removed clusters are marked as deleted. The row of a merged cluster is the
+    sum of the rows of the merged clusters, the other new clusters are counted from their
+    spikes only.
+
+    """
+
+    def __init__(self, templates=None, counts=None, offsets=None, clusters=None, n_templates=0):
+        templates = templates if templates is not None else np.zeros(0, dtype=np.int64)
+        counts = counts if counts is not None else np.zeros(0, dtype=np.int64)
+        offsets = offsets if offsets is not None else np.zeros(1, dtype=np.int64)
+        clusters = clusters if clusters is not None else np.zeros(0, dtype=np.int64)
+        assert len(templates) == len(counts)
+        assert len(offsets) == len(clusters) + 1
+        assert offsets[0] == 0 and offsets[-1] == len(templates)
+        self._templates = np.array(templates, dtype=np.int64)
+        self._counts = np.array(counts, dtype=np.int64)
+        self._nnz = len(templates)
+        # Per-row arrays, a removed row has a cluster id of -1.
+        self._n_rows = len(clusters)
+        self._offsets = np.array(offsets, dtype=np.int64)
+        self._clusters = np.array(clusters, dtype=np.int64)
+        # Map cluster ids to row indices (-1 for non-existing clusters).
+        n = int(self._clusters.max()) + 1 if len(self._clusters) else 0
+        self._lookup = np.full(n, -1, dtype=np.int64)
+        self._lookup[self._clusters] = np.arange(self._n_rows)
+        self._n_dead = 0
+        self.n_templates = max(
+            n_templates, int(self._templates.max()) + 1 if self._nnz else 0)
+
+    @classmethod
+    def from_spike_templates(
+            cls, spike_clusters, spike_templates, n_templates=0, chunk_size=2 ** 22):
+        """Create the matrix in a single pass over the spike clusters and spike templates.
+        Negative cluster ids are ignored.
+
+        The arrays are read in chunks, so that a memory-mapped array or an `OverlayArray` is
+        never loaded entirely. The pairs counted in every chunk are then combined.
+
+        """
+        assert len(spike_clusters) == len(spike_templates)
+        n = max(n_templates, max(
+            (int(chunk.max()) + 1 for _, chunk in _iter_chunks(spike_templates, chunk_size)),
+            default=0))
+        pairs, counts = [], []
+        for i, chunk in _iter_chunks(spike_clusters, chunk_size):
+            chunk = chunk.astype(np.int64)
+            templates = np.asarray(spike_templates[i:i + len(chunk)], dtype=np.int64)
+            keep = chunk >= 0
+            p, c = np.unique(chunk[keep] * n + templates[keep], return_counts=True)
+            pairs.append(p)
+            counts.append(c)
+        if len(pairs) > 1:
+            p, inv = np.unique(np.concatenate(pairs), return_inverse=True)
+            c = np.bincount(inv.ravel(), weights=np.concatenate(counts))
+        elif pairs:
+            p, c = pairs[0], counts[0]
+        if not pairs or not len(p):
+            return cls(n_templates=n_templates)
+        clusters, templates = p // n, p % n
+        bounds = np.nonzero(np.diff(clusters))[0] + 1
+        ends = np.r_[bounds, len(p)]
+        return cls(
+            templates, c.astype(np.int64), np.r_[0, ends], clusters[ends - 1],
+            n_templates=n_templates)
+
+    # Internal methods
+    # -------------------------------------------------------------------------
+
+    def _row_index(self, cluster_id):
+        """Return the row index of a cluster, or -1 if it does not exist."""
+        if 0 <= cluster_id < len(self._lookup):
+            return self._lookup[cluster_id]
+        return -1
+
+    def _row(self, i):
+        """Return the template ids and counts in a given row, as read-only views."""
+        o0, o1 = self._offsets[i], self._offsets[i + 1]
+        templates, counts = self._templates[o0:o1].view(), self._counts[o0:o1].view()
+        templates.flags.writeable = counts.flags.writeable = False
+        return templates, counts
+
+    def _row_indices(self, cluster_ids):
+        """Return the row indices of a list of clusters, which must exist."""
+        cluster_ids = _as_array(cluster_ids, dtype=np.int64)
+        idx = self._lookup[cluster_ids]
+        if np.any(idx < 0):
+            raise KeyError(cluster_ids[idx < 0])
+        return idx
+
+    def _append(self, templates, counts, ends, clusters):
+        """Append new rows to the matrix."""
+        n, k = self._nnz, len(clusters)
+        self._templates = _grow(self._templates, n + len(templates))
+        self._templates[n:n + len(templates)] = templates
+        self._counts = _grow(self._counts, n + len(counts))
+        self._counts[n:n + len(counts)] = counts
+        self._nnz += len(templates)
+        r = self._n_rows
+        self._offsets = _grow(self._offsets, r + k + 1)
+        self._offsets[r + 1:r + k + 1] = n + ends
+        self._clusters = _grow(self._clusters, r + k)
+        self._clusters[r:r + k] = clusters
+        self._lookup = _grow(self._lookup, int(clusters.max()) + 1 if k else 0, fill=-1)
+        self._lookup[clusters] = np.arange(r, r + k)
+        self._n_rows += k
+        if len(templates):
+            self.n_templates = max(self.n_templates, int(templates.max()) + 1)
+        # Compact the matrix if there are too many removed entries.
+        if self._n_dead > max(self._nnz - self._n_dead, 1024):
+            self.compact()
+
+    # Public methods
+    # -------------------------------------------------------------------------
+
+    @property
+    def cluster_ids(self):
+        """Sorted array of the cluster ids in the matrix."""
+        return np.nonzero(self._lookup >= 0)[0]
+
+    def dense(self, cluster_id):
+        """Return the number of spikes of every template in a cluster, as a
+        `(n_templates,)` array."""
+        templates, counts = self[cluster_id]
+        out = np.zeros(self.n_templates, dtype=np.int64)
+        out[templates] = counts
+        return out
+
+    def best_templates(self, cluster_ids):
+        """Return the template with the most spikes in every cluster, and the smallest
+        template id in case of a tie."""
+        idx = self._row_indices(cluster_ids)
+        if not len(idx):
+            return np.zeros(0, dtype=np.int64)
+        sizes = self._offsets[idx + 1] - self._offsets[idx]
+        assert np.all(sizes > 0)
+        rows = np.repeat(np.arange(len(idx)), sizes)
+        entries = np.arange(len(rows)) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+        entries += np.repeat(self._offsets[idx], sizes)
+        templates, counts = self._templates[entries], self._counts[entries]
+        order = np.lexsort((templates, -counts, rows))
+        first = np.r_[True, rows[order][1:] != rows[order][:-1]]
+        return templates[order][first]
+
+    def reduce(self, values, cluster_ids=None, ufunc=np.maximum):
+        """Reduce per-template values over the templates of every cluster, with a NumPy
+        ufunc, reading the rows in place without compacting the matrix.
+
+        Parameters
+        ----------
+
+        values : array-like
+            The `(n_templates,)` array of per-template values.
+        cluster_ids : array-like
+            The clusters, by default all clusters, sorted by id.
+        ufunc : NumPy ufunc
+            The reduction, by default the maximum.
+
+        """
+        cluster_ids = self.cluster_ids if cluster_ids is None else cluster_ids
+        idx = self._row_indices(cluster_ids)
+        values = np.asarray(values)
+        if not len(idx):
+            return np.zeros(0, dtype=values.dtype)
+        # The rows are never empty, the removed rows are reduced as well and dropped.
+        reduced = ufunc.reduceat(
+            values[self._templates[:self._nnz]], self._offsets[:self._n_rows])
+        return reduced[idx]
+
+    def remove(self, cluster_ids):
+        """Remove some clusters from the matrix."""
+        cluster_ids = _as_array(cluster_ids, dtype=np.int64)
+        cluster_ids = cluster_ids[(cluster_ids >= 0) & (cluster_ids < len(self._lookup))]
+        idx = self._lookup[cluster_ids]
+        idx = idx[idx >= 0]
+        if not len(idx):
+            return
+        self._n_dead += int(np.sum(self._offsets[idx + 1] - self._offsets[idx]))
+        self._lookup[self._clusters[idx]] = -1
+        self._clusters[idx] = -1
+
+    def merge(self, cluster_ids, to):
+        """Add a new cluster whose row is the sum of the rows of some clusters, and remove
+        these clusters."""
+        rows = [self[c] for c in cluster_ids]
+        templates, inv = np.unique(np.concatenate([t for t, _ in rows]), return_inverse=True)
+        counts = np.bincount(inv, weights=np.concatenate([c for _, c in rows]))
+        self.remove(cluster_ids)
+        self._append(
+            templates, counts.astype(np.int64), np.array([len(templates)]), np.array([to]))
+
+    def assign(self, spike_clusters, spike_templates):
+        """Add clusters given the cluster ids and the template ids of all of their spikes,
+        replacing existing clusters."""
+        if not len(spike_clusters):
+            return
+        templates, counts, ends, clusters = _count_pairs(spike_clusters, spike_templates)
+        self.remove(clusters)
+        self._append(templates, counts, ends, clusters)
+
+    def update(self, up, spike_templates):
+        """Update the matrix after a clustering action, given the template of every spike."""
+        if not up.added and not up.deleted:
+            return
+        if up.get('spike_clusters', None) is None:
+            # Merge: the new row is the sum of the rows of the merged clusters.
+            assert len(up.added) == 1
+            self.merge(up.deleted, up.added[0])
+            return
+        # Other actions: count the templates of the spikes that changed cluster.
+        self.remove(up.deleted)
+        self.assign(up.spike_clusters, _as_array(spike_templates)[up.spike_ids])
+
+    def compact(self):
+        """Rewrite the matrix in memory, without the removed rows, and sorted by cluster."""
+        logger.log(5, "Compact the template counts.")
+        cluster_ids = self.cluster_ids
+        rows = [self._row(i) for i in self._lookup[cluster_ids]]
+        templates = np.concatenate([t for t, _ in rows]) if rows else None
+        counts = np.concatenate([c for _, c in rows]) if rows else None
+        offsets = np.r_[0, np.cumsum([len(t) for t, _ in rows], dtype=np.int64)]
+        self.__init__(templates, counts, offsets, cluster_ids, n_templates=self.n_templates)
+
+    def to_arrays(self):
+        """Return the compacted matrix as a dictionary with the `templates`, `counts`,
+        `offsets`, and `clusters` arrays."""
+        clusters = self._clusters[:self._n_rows]
+        if self._n_dead or np.any(clusters[1:] <= clusters[:-1]):
+            self.compact()
+        return {
+            'templates': self._templates[:self._nnz],
+            'counts': self._counts[:self._nnz],
+            'offsets': self._offsets[:self._n_rows + 1],
+            'clusters': self._clusters[:self._n_rows],
+        }
+
+    # Dictionary interface
+    # -------------------------------------------------------------------------
+
+    def __getitem__(self, cluster_id):
+        """Return the template ids and the spike counts of a cluster."""
+        i = self._row_index(cluster_id)
+        if i < 0:
+            raise KeyError(cluster_id)
+        return self._row(i)
+
+    def __contains__(self, cluster_id):
+        return self._row_index(cluster_id) >= 0
+
+    def __len__(self):
+        return len(self.cluster_ids)
+
+    def __repr__(self):
+        return '<TemplateCounts %d clusters, %d templates>' % (len(self), self.n_templates)
+
+
+#------------------------------------------------------------------------------
+# BestChannels class
+#------------------------------------------------------------------------------
+
+class BestChannels(object):
+    """Compact CSR table of the best channels of every cluster.
+
+    Like `SpikesPerCluster`, the table is made of three arrays: the channel ids sorted by
+    cluster, the offsets of every cluster in the channel array, and the sorted cluster ids.
+    These arrays can be saved to and loaded from `.npy` files, in which case they can be
+    memory-mapped.
+
+    Constructor
+    -----------
+
+    channels : array-like
+        The channel ids of every cluster, sorted by cluster, and by decreasing match within
+        every cluster.
+    offsets : array-like
+        The `(n_clusters + 1,)` offsets of every cluster in the `channels` array.
+    clusters : array-like
+        The `(n_clusters,)` sorted cluster ids.
+
+    Notes
+    -----
+
+    Since cluster ids are never reused for different spikes, the table is append-only: the
+    best channels of new clusters are kept in a dictionary until the table is compacted
+    with `to_arrays()`.
+
+    """
+
+    def __init__(self, channels=None, offsets=None, clusters=None):
+        channels = channels if channels is not None else np.zeros(0, dtype=np.int64)
+        offsets = offsets if offsets is not None else np.zeros(1, dtype=np.int64)
+        clusters = clusters if clusters is not None else np.zeros(0, dtype=np.int64)
+        assert len(offsets) == len(clusters) + 1
+        assert offsets[0] == 0 and offsets[-1] == len(channels)
+        self._channels = channels
+        self._offsets = offsets
+        self._clusters = clusters
+        # Best channels of the clusters added since the table was created from arrays.
+        self._new = {}
+        self.is_dirty = False
+
+    @classmethod
+    def from_dict(cls, best_channels):
+        """Create the table from a `{cluster_id: channel_ids}` dictionary."""
+        table = cls()
+        table.set(list(best_channels), list(best_channels.values()))
+        return table
+
+    def _index(self, cluster_ids):
+        """Return the row of every cluster in the base arrays, or -1."""
+        cluster_ids = _as_array(cluster_ids, dtype=np.int64)
+        if not len(self._clusters):
+            return np.full(len(cluster_ids), -1, dtype=np.int64)
+        idx = np.minimum(np.searchsorted(self._clusters, cluster_ids), len(self._clusters) - 1)
+        return np.where(self._clusters[idx] == cluster_ids, idx, -1)
+
+    # Public methods
+    # -------------------------------------------------------------------------
+
+    @property
+    def cluster_ids(self):
+        """Sorted array of the cluster ids in the table."""
+        new = np.array(sorted(self._new), dtype=np.int64)
+        return np.union1d(np.asarray(self._clusters, dtype=np.int64), new)
+
+    def missing(self, cluster_ids):
+        """Return the clusters that are not in the table, among a list of clusters."""
+        cluster_ids = np.unique(_as_array(cluster_ids, dtype=np.int64))
+        in_base = self._index(cluster_ids) >= 0
+        return np.array(
+            [c for c, b in zip(cluster_ids, in_base) if not b and c not in self._new],
+            dtype=np.int64)
+
+    def set(self, cluster_ids, channel_ids):
+        """Set the best channels of several clusters."""
+        for cluster_id, ch in zip(cluster_ids, channel_ids):
+            self._new[int(cluster_id)] = _as_array(ch, dtype=np.int64)
+        self.is_dirty = True
+
+    def best_channel(self, cluster_ids):
+        """Return the first best channel of several clusters, as an array."""
+        cluster_ids = _as_array(cluster_ids, dtype=np.int64)
+        idx = self._index(cluster_ids)
+        out = np.zeros(len(cluster_ids), dtype=np.int64)
+        in_base = idx >= 0
+        out[in_base] = self._channels[self._offsets[idx[in_base]]]
+        for i in np.nonzero(~in_base)[0]:
+            out[i] = self[cluster_ids[i]][0]
+        return out
+
+    def to_arrays(self, cluster_ids=None):
+        """Return the compacted table as a dictionary with the `channels`, `offsets`, and
+        `clusters` arrays, with all clusters or the specified clusters only."""
+        cluster_ids = self.cluster_ids if cluster_ids is None else np.intersect1d(
+            self.cluster_ids, cluster_ids)
+        arrs = [self[c] for c in cluster_ids]
+        channels = np.concatenate(arrs) if arrs else np.zeros(0, dtype=np.int64)
+        offsets = np.r_[0, np.cumsum([len(arr) for arr in arrs], dtype=np.int64)]
+        return {
+            'channels': channels.astype(np.int64),
+            'offsets': offsets.astype(np.int64),
+            'clusters': cluster_ids.astype(np.int64),
+        }
+
+    def __getitem__(self, cluster_id):
+        out = self.get(cluster_id)
+        if out is None:
+            raise KeyError(cluster_id)
+        return out
+
+    def get(self, cluster_id, default=None):
+        out = self._new.get(cluster_id)
+        if out is not None:
+            return out
+        i = self._index([cluster_id])[0]
+        if i < 0:
+            return default
+        return np.asarray(self._channels[self._offsets[i]:self._offsets[i + 1]])
+
+    def __contains__(self, cluster_id):
+        return self.get(cluster_id) is not None
+
+    def __len__(self):
+        return len(self.cluster_ids)
+
+    def __repr__(self):
+        return '<BestChannels %d clusters>' % len(self)
+
+
+#------------------------------------------------------------------------------
+# ClustersPerChannel class
+#------------------------------------------------------------------------------
+
+class ClustersPerChannel(object):
+    """Inverted index mapping every channel to the sorted list of the clusters that have
+    this channel among their best channels.
+
+    Constructor
+    -----------
+
+    get_best_channels : function
+        Function `cluster_id => channel_ids` returning the best channels of a cluster.
+    cluster_ids : array-like
+        The initial cluster ids.
+
+    Notes
+    -----
+
+    The best channels of the clusters are only requested when the index is queried, and
+    only for the clusters that are not indexed yet. The index may be queried from several
+    threads.
+
+    """
+
+    def __init__(self, get_best_channels, cluster_ids=()):
+        self.get_best_channels = get_best_channels
+        # Clusters that are not indexed yet.
+        self._pending = set(int(c) for c in cluster_ids)
+        # Best channels of every indexed cluster.
+        self._channels = {}
+        # Sorted list of the indexed clusters on every channel.
+        self._clusters = {}
+        self._lock = Lock()
+
+    def _add(self, cluster_id):
+        channel_ids = [int(ch) for ch in self.get_best_channels(cluster_id)]
+        self._channels[cluster_id] = channel_ids
+        for channel_id in channel_ids:
+            insort(self._clusters.setdefault(channel_id, []), cluster_id)
+
+    def _remove(self, cluster_id):
+        for channel_id in self._channels.pop(cluster_id, ()):
+            clusters = self._clusters[channel_id]
+            del clusters[bisect_left(clusters, cluster_id)]
+
+    def _flush(self):
+        """Index the pending clusters."""
+        for cluster_id in sorted(self._pending):
+            self._add(cluster_id)
+        self._pending.clear()
+
+    def update(self, up):
+        """Update the index after a clustering action."""
+        if not up.added and not up.deleted:
+            return
+        with self._lock:
+            for cluster_id in up.deleted:
+                if cluster_id in self._pending:
+                    self._pending.discard(cluster_id)
+                else:
+                    self._remove(cluster_id)
+            self._pending.update(up.added)
+
+    def clusters(self, channel_id):
+        """Return the sorted list of the clusters that have a given channel among their best
+        channels."""
+        with self._lock:
+            self._flush()
+            return list(self._clusters.get(int(channel_id), ()))
@@ -0,0 +1,156 @@
+# -*- coding: utf-8 -*-
+
+"""Append-only journal of clustering actions."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import json
+import logging
+from pathlib import Path
+import struct
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+#------------------------------------------------------------------------------
+# Journal format
+#------------------------------------------------------------------------------
+
+# The file starts with a header (magic, version, number of spikes), followed by records made
+# of a kind (uint8), a payload size (uint32), and the payload.
+_MAGIC = b'PHYJ'
+_VERSION = 1
+_HEADER = struct.Struct('<4sHQ')
+_RECORD = struct.Struct('<BI')
+
+# Record kinds.
+ASSIGN = 1  # payload: int64 spike ids, followed by their int64 cluster ids
+MERGE = 2  # payload: int64 new cluster id, followed by the int64 merged cluster ids
+METADATA = 3  # payload: JSON list [field, cluster_ids, value]
+
+
+def _json_default(obj):
+    """Convert NumPy scalars when encoding JSON."""
+    if isinstance(obj, np.generic):
+        return obj.item()
+    raise TypeError(obj)  # pragma: no cover
+
+
+#------------------------------------------------------------------------------
+# ActionJournal class
+#------------------------------------------------------------------------------
+
+class ActionJournal(object):
+    """Append-only binary journal of the clustering and cluster metadata changes.
+
+    Every change is appended and flushed to the file as soon as it is made, so that unsaved
+    changes can be replayed after a crash. The journal is cleared when the clustering is saved.
+
+    Constructor
+    -----------
+
+    path : str or Path
+        Path to the journal file.
+    n_spikes : int
+        Total number of spikes, used to check that the journal matches the dataset.
+
+    """
+
+    def __init__(self, path, n_spikes):
+        self.path = Path(path)
+        self.n_spikes = int(n_spikes)
+
+    def _write(self, kind, payload):
+        """Append a record to the journal."""
+        with open(self.path, 'ab') as f:
+            if f.tell() == 0:
+                f.write(_HEADER.pack(_MAGIC, _VERSION, self.n_spikes))
+            f.write(_RECORD.pack(kind, len(payload)) + payload)
+
+    def append_assign(self, spike_ids, spike_clusters):
+        """Record a spike-cluster assignment with absolute cluster ids."""
+        spike_ids = np.asarray(spike_ids, dtype=np.int64)
+        spike_clusters = np.asarray(spike_clusters, dtype=np.int64)
+        assert spike_ids.shape == spike_clusters.shape
+        self._write(ASSIGN, spike_ids.tobytes() + spike_clusters.tobytes())
+
+    def append_merge(self, cluster_ids, to):
+        """Record a merge of several clusters into a new cluster."""
+        self._write(MERGE, np.r_[to, cluster_ids].astype(np.int64).tobytes())
+
+    def append_metadata(self, field, cluster_ids, value):
+        """Record a cluster metadata change."""
+        payload = json.dumps([field, list(cluster_ids), value], default=_json_default)
+        self._write(METADATA, payload.encode('utf-8'))
+
+    def read(self):
+        """Return the list of `(kind, data, end_offset)` records in the journal.
+
+        A truncated record at the end of the file (interrupted write) is ignored, and a
+        journal created for another dataset is discarded.
+
+        """
+        if not self.path.exists():
+            return []
+        buf = self.path.read_bytes()
+        if len(buf) < _HEADER.size:
+            return []
+        magic, version, n_spikes = _HEADER.unpack_from(buf)
+        if magic != _MAGIC or version != _VERSION or n_spikes != self.n_spikes:
+            logger.warning("Discard the invalid action journal %s.", self.path)
+            self.clear()
+            return []
+        records = []
+        i = _HEADER.size
+        while i + _RECORD.size <= len(buf):
+            kind, size = _RECORD.unpack_from(buf, i)
+            j = i + _RECORD.size + size
+            if j > len(buf):
+                logger.debug("Ignore a truncated record at the end of the action journal.")
+                break
+            payload = buf[i + _RECORD.size:j]
+            if kind == ASSIGN:
+                data = np.frombuffer(payload, dtype=np.int64).reshape((2, -1))
+            elif kind == MERGE:
+                arr = np.frombuffer(payload, dtype=np.int64)
+                data = (arr[1:], int(arr[0]))
+            elif kind == METADATA:
+                data = json.loads(payload.decode('utf-8'))
+            else:  # pragma: no cover
+                logger.warning("Unknown record in the action journal.")
+                break
+            records.append((kind, data, j))
+            i = j
+        return records
+
+    def recover(self):
+        """Return the records in the journal, and discard the truncated record left at the
+        end of the file by an interrupted write, so that new records are appended after the
+        last valid record."""
+        records = self.read()
+        end = records[-1][2] if records else 0
+        if self.path.exists() and self.path.stat().st_size > end:
+            logger.debug("Truncate the action journal %s to %d bytes.", self.path, end)
+            if end:
+                self.truncate(end)
+            else:
+                self.clear()
+        return records
+
+    def truncate(self, offset):
+        """Discard all records after a given offset."""
+        if self.path.exists():
+            with open(self.path, 'r+b') as f:
+                f.truncate(offset)
+
+    def clear(self):
+        """Remove all records from the journal."""
+        if self.path.exists():
+            self.path.unlink()
+
+    def __len__(self):
+        return len(self.read())
@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+
+"""Read-only array with a sparse copy-on-write overlay."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import logging
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+
+#------------------------------------------------------------------------------
+# Utils
+#------------------------------------------------------------------------------
+
+def _last_unique(indices, values):
+    """Sort some indices and keep the last value of every duplicate index, like NumPy
+    fancy-index assignment."""
+    order = np.argsort(indices, kind='mergesort')
+    indices, values = indices[order], values[order]
+    last = np.r_[indices[1:] != indices[:-1], True]
+    return indices[last], values[last]
+
+
+#------------------------------------------------------------------------------
+# OverlayArray class
+#------------------------------------------------------------------------------
+
+class OverlayArray(object):
+    """One-dimensional array made of a read-only base array (typically memory-mapped), and
+    a sparse overlay of modified items kept in memory.
+
+    Reading items returns the base values patched with the overlay, whereas writing items
+    only updates the overlay. Items that are set back to their base values are removed
+    from the overlay, so that its size is the number of items that differ from the base.
+
+    Constructor
+    -----------
+
+    base : array-like
+        The one-dimensional base array. It is never modified and is not copied.
+    dtype : NumPy dtype
+        The data type of the values returned by the array (by default, that of the base).
+
+    """
+
+    # Number of items read at once when scanning the whole array.
+    chunk_size = 2 ** 22
+
+    def __init__(self, base, dtype=None):
+        assert base.ndim == 1
+        self._base = base
+        self.dtype = np.dtype(dtype or base.dtype)
+        self.reset()
+
+    def reset(self):
+        """Discard all changes."""
+        # Sorted indices of the modified items, and their values.
+        self._indices = np.zeros(0, dtype=np.int64)
+        self._values = np.zeros(0, dtype=self.dtype)
+
+    @property
+    def base(self):
+        """The read-only base array."""
+        return self._base
+
+    def rebase(self, base):
+        """Replace the base array by another array with the same length and the same values
+        outside of the overlay, typically the file where the array has been saved. The items that
+        do not differ from the new base are removed from the overlay, and the previous base array
+        is no longer referenced."""
+        assert base.shape == self._base.shape
+        self._base = base
+        if len(self._indices):
+            changed = self._values != base[self._indices]
+            self._indices, self._values = self._indices[changed], self._values[changed]
+
+    @property
+    def n_modified(self):
+        """Number of items that differ from the base array."""
+        return len(self._indices)
+
+    @property
+    def shape(self):
+        return self._base.shape
+
+    @property
+    def ndim(self):
+        return 1
+
+    def __len__(self):
+        return len(self._base)
+
+    def _to_indices(self, item):
+        """Convert an index, slice, or boolean mask, to an array of indices."""
+        if isinstance(item, slice):
+            return np.arange(*item.indices(len(self)))
+        item = np.asarray(item)
+        if item.dtype == bool:
+            return np.nonzero(item)[0]
+        return item.astype(np.int64) % len(self)
+
+    def _patch(self, indices, out):
+        """Replace the values of modified items in an array of values."""
+        if not len(self._indices) or not len(indices):
+            return out
+        pos = np.searchsorted(self._indices, indices)
+        pos[pos == len(self._indices)] = 0
+        found = self._indices[pos] == indices
+        out[found] = self._values[pos[found]]
+        return out
+
+    def __getitem__(self, item):
+        if isinstance(item, (int, np.integer)):
+            return self[np.array([item])][0]
+        if isinstance(item, slice) and not len(self._indices):
+            return np.array(self._base[item], dtype=self.dtype)
+        indices = self._to_indices(item)
+        out = np.array(self._base[indices], dtype=self.dtype)
+        return self._patch(indices.ravel(), out.ravel()).reshape(indices.shape)
+
+    def __setitem__(self, item, values):
+        indices = self._to_indices(item).ravel()
+        values = np.broadcast_to(np.asarray(values, dtype=self.dtype), indices.shape)
+        if not len(indices):
+            return
+        indices, values = _last_unique(indices, values)
+        # Remove the previous values of these items from the overlay.
+        keep = ~np.isin(self._indices, indices, assume_unique=True)
+        self._indices, self._values = self._indices[keep], self._values[keep]
+        # Only keep the values that differ from the base.
+        changed = values != self._base[indices]
+        indices = np.concatenate((self._indices, indices[changed]))
+        values = np.concatenate((self._values, values[changed]))
+        order = np.argsort(indices, kind='mergesort')
+        self._indices, self._values = indices[order], values[order]
+
+    def iter_chunks(self):
+        """Yield the successive chunks of the array, with the overlay applied."""
+        for i in range(0, len(self), self.chunk_size):
+            yield self[i:i + self.chunk_size]
+
+    def __array__(self, dtype=None):
+        logger.log(5, "Materialize an array of %d items in memory.", len(self))
+        out = np.array(self._base, dtype=self.dtype)
+        out[self._indices] = self._values
+        return out.astype(dtype) if dtype is not None else out
+
+    def save(self, path):
+        """Save the array to a `.npy` file, chunk by chunk, without loading it in memory."""
+        out = np.lib.format.open_memmap(str(path), mode='w+', dtype=self.dtype, shape=self.shape)
+        for i, chunk in enumerate(self.iter_chunks()):
+            out[i * self.chunk_size:i * self.chunk_size + len(chunk)] = chunk
+        out.flush()
+        del out
+
+    def copy(self):
+        """Return a full copy of the array in memory."""
+        return np.asarray(self)
+
+    def max(self):
+        return max(int(chunk.max()) for chunk in self.iter_chunks()) if len(self) else None
+
+    def __repr__(self):
+        return '<OverlayArray %d items, %d modified>' % (len(self), self.n_modified)
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+
+"""Incremental similarity measures between clusters."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import logging
+
+import numpy as np
+from scipy import sparse
+
+logger = logging.getLogger(__name__)
+
+
+#------------------------------------------------------------------------------
+# Utils
+#------------------------------------------------------------------------------
+
+def _top(cluster_ids, similarities, n, threshold=-np.inf):
+    """Return the `n` most similar clusters, sorted by decreasing similarity, and by
+    increasing cluster id in case of a tie, and the largest similarity of the other clusters
+    (or the passed threshold if it is larger)."""
+    if len(cluster_ids) > n:
+        # Keep all clusters tied with the n-th one, the ties are broken by the sort below.
+        nth = np.partition(similarities, len(similarities) - n)[len(similarities) - n]
+        keep = similarities >= nth
+        threshold = max(threshold, similarities[~keep].max(initial=-np.inf))
+        cluster_ids, similarities = cluster_ids[keep], similarities[keep]
+    order = np.lexsort((cluster_ids, -similarities))
+    if len(order) > n:
+        threshold = max(threshold, similarities[order[n]])
+    order = order[:n]
+    return cluster_ids[order], similarities[order], threshold
+
+
+#------------------------------------------------------------------------------
+# TemplateSimilarity class
+#------------------------------------------------------------------------------
+
+class TemplateSimilarity(object):
+    """Top-k index of the similarity between clusters, derived from the similarity between
+    the templates of their spikes.
+
+    The similarity between two clusters is the maximum similarity between any template of the
+    first cluster and any template of the second cluster.
+
+    Constructor
+    -----------
+
+    similar_templates : array-like
+        The `(n_templates, n_templates)` template similarity matrix.
+    template_counts : TemplateCounts
+        The cluster × template count matrix, which must be updated before this index after
+        every clustering action.
+    k : int
+        The maximum number of similar clusters returned for a given cluster.
+
+    Notes
+    -----
+
+    The most similar clusters of a cluster are computed the first time they are requested,
+    with a few vectorized operations on all clusters, and they are kept in the index along with
+    the largest similarity of the clusters that were left out. After a clustering action, the
+    new clusters are inserted in the kept lists where they rank, so that subsequent requests
+    are answered by a lookup. A list is only recomputed when too many of its clusters have been
+    deleted. The rows of the template counts are read in place, the index never compacts them.
+
+    """
+
+    def __init__(self, similar_templates, template_counts, k=100):
+        self.similar_templates = similar_templates
+        self.template_counts = template_counts
+        self.k = k
+        # Extra clusters kept in every list to absorb the deleted clusters.
+        self._capacity = 2 * k
+        # Most similar clusters, as `{cluster_id: (cluster_ids, similarities, threshold)}`
+        # where the threshold is the largest similarity of the clusters left out.
+        self._top = {}
+        self._cluster_ids = None
+
+    # Internal methods
+    # -------------------------------------------------------------------------
+
+    @property
+    def cluster_ids(self):
+        """Sorted array of the existing clusters."""
+        if self._cluster_ids is None:
+            self._cluster_ids = self.template_counts.cluster_ids
+        return self._cluster_ids
+
+    def _reduce(self, template_similarities):
+        """Return the maximum of per-template similarities over the templates of every
+        cluster."""
+        cluster_ids = self.cluster_ids
+        return cluster_ids, self.template_counts.reduce(template_similarities, cluster_ids)
+
+    def _row(self, cluster_id):
+        """Return the similarity of a cluster with every cluster."""
+        templates, _ = self.template_counts[cluster_id]
+        return self._reduce(np.asarray(self.similar_templates[templates, :]).max(axis=0))
+
+    def _column(self, cluster_id):
+        """Return the similarity of every cluster with a cluster."""
+        templates, _ = self.template_counts[cluster_id]
+        return self._reduce(np.asarray(self.similar_templates[:, templates]).max(axis=1))
+
+    def _compute(self, cluster_id):
+        """Compute and keep the most similar clusters of a cluster."""
+        self._top[cluster_id] = _top(*self._row(cluster_id), self._capacity)
+        return self._top[cluster_id]
+
+    def _insert(self, added):
+        """Insert new clusters in the kept lists where they rank."""
+        if not self._top:
+            return
+        others = np.array(list(self._top), dtype=np.int64)
+        thresholds = np.array([self._top[other][2] for other in others])
+        for cluster_id in added:
+            cluster_ids, similarities = self._column(cluster_id)
+            s = similarities[np.searchsorted(cluster_ids, others)]
+            # Only the lists where the new cluster ranks before the clusters that were left
+            # out change. A cluster id that comes back after an undo or a redo has the same
+            # spikes, so that it can only be in these lists.
+            for i in np.nonzero(s >= thresholds)[0]:
+                ids, sims, threshold = self._top[others[i]]
+                keep = ids != cluster_id
+                self._top[others[i]] = _top(
+                    np.r_[ids[keep], cluster_id], np.r_[sims[keep], s[i]], self._capacity,
+                    threshold=threshold)
+                thresholds[i] = self._top[others[i]][2]
+
+    # Public methods
+    # -------------------------------------------------------------------------
+
+    def update(self, up):
+        """Update the index after a clustering action."""
+        if not up.added and not up.deleted:
+            return
+        for cluster_id in up.deleted:
+            self._top.pop(cluster_id, None)
+        self._cluster_ids = None
+        self._insert(sorted(up.added))
+        logger.log(5, "Updated the template similarity of %d clusters.", len(up.added))
+
+    def similarity(self, cluster_id):
+        """Return the list of the `k` most similar clusters to a given cluster, as a list
+        of `(other_cluster_id, similarity)` pairs sorted by decreasing similarity."""
+        if cluster_id not in self.template_counts:
+            return []
+        ids, sims, _ = self._top.get(cluster_id) or self._compute(cluster_id)
+        alive = np.isin(ids, self.cluster_ids)
+        n = min(self.k, len(self.cluster_ids))
+        if alive.sum() < n:
+            ids, sims, _ = self._compute(cluster_id)
+            alive = np.ones(len(ids), dtype=bool)
+        ids, sims = ids[alive][:self.k], sims[alive][:self.k]
+        return [(int(c), float(s)) for c, s in zip(ids, sims)]
+
+
+#------------------------------------------------------------------------------
+# WaveformSimilarity class
+#------------------------------------------------------------------------------
+
+class WaveformSimilarity(object):
+    """Cosine similarity between the mean waveforms of clusters, computed with sparse matrix
+    products.
+
+    The normalized mean waveforms of all clusters are kept as the rows of a sparse matrix,
+    where the columns are the (channel, sample) pairs. The similarities to a given cluster are
+    computed with a single sparse matrix-vector product, and the similarities between all
+    clusters with a single sparse matrix-matrix product.
+
+    Constructor
+    -----------
+
+    get_mean_waveforms : function
+        Function `cluster_id => Bunch(data, channel_ids)` returning the mean waveform of a
+        cluster as an array of shape `(1, n_samples, n_channels_loc)` or
+        `(n_samples, n_channels_loc)` on the channels `channel_ids`.
+    cluster_ids : array-like
+        The initial cluster ids.
+    n_channels : int
+        The total number of channels.
+    k : int
+        The maximum number of similar clusters returned for a given cluster.
+
+    Notes
+    -----
+
+    The mean waveforms are computed lazily, the first time a similarity is requested. After a
+    clustering action, only the mean waveforms of the new clusters are computed.
+
+    """
+
+    def __init__(self, get_mean_waveforms, cluster_ids, n_channels, k=100):
+        self.get_mean_waveforms = get_mean_waveforms
+        self.n_channels = n_channels
+        self.k = k
+        self.n_samples = None
+        self._cluster_ids = set(int(c) for c in cluster_ids)
+        # Sparse normalized waveform of every cluster, as `{cluster_id: (indices, values)}`.
+        self._rows = {}
+        self._matrix = self._pattern = None
+
+    # Internal methods
+    # -------------------------------------------------------------------------
+
+    def _row(self, cluster_id):
+        """Return the column indices and the values of the normalized mean waveform of a
+        cluster."""
+        b = self.get_mean_waveforms(cluster_id)
+        data = getattr(b, 'data', None)
+        if data is None:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+        data = np.asarray(data, dtype=np.float32)
+        data = data[0] if data.ndim == 3 else data
+        n_samples, n_channels_loc = data.shape
+        self.n_samples = self.n_samples or n_samples
+        assert n_samples == self.n_samples
+        channel_ids = np.asarray(b.channel_ids, dtype=np.int64)
+        assert channel_ids.shape == (n_channels_loc,)
+        # The column of a (channel, sample) pair is `channel * n_samples + sample`.
+        indices = channel_ids[np.newaxis, :] * n_samples + np.arange(n_samples)[:, np.newaxis]
+        norm = np.sqrt(np.sum(data ** 2))
+        values = data / norm if norm > 0 else data
+        return indices.ravel(), values.ravel()
+
+    @property
+    def cluster_ids(self):
+        """Sorted array of the clusters."""
+        return np.array(sorted(self._cluster_ids), dtype=np.int64)
+
+    def matrix(self):
+        """Return the cluster ids, and the sparse `(n_clusters, n_channels * n_samples)` matrix
+        with the normalized mean waveform of every cluster."""
+        if self._matrix is None:
+            cluster_ids = self.cluster_ids
+            missing = [c for c in cluster_ids if c not in self._rows]
+            if missing:
+                logger.debug("Computing the mean waveforms of %d clusters.", len(missing))
+            for cluster_id in missing:
+                self._rows[cluster_id] = self._row(cluster_id)
+            rows = [self._rows[c] for c in cluster_ids]
+            indptr = np.r_[0, np.cumsum([len(i) for i, _ in rows])]
+            indices = np.concatenate([i for i, _ in rows]) if rows else np.zeros(0)
+            values = np.concatenate([v for _, v in rows]) if rows else np.zeros(0)
+            shape = (len(cluster_ids), self.n_channels * (self.n_samples or 0))
+            m = sparse.csr_matrix((values, indices, indptr), shape=shape)
+            # Sparsity pattern of the matrix, used to find the clusters with common channels.
+            self._pattern = sparse.csr_matrix(
+                (np.ones_like(m.data), m.indices, m.indptr), shape=m.shape)
+            self._matrix = cluster_ids, m
+        return self._matrix
+
+    # Public methods
+    # -------------------------------------------------------------------------
+
+    def update(self, up):
+        """Update the clusters after a clustering action. The mean waveforms of the new
+        clusters will be computed at the next request."""
+        if not up.added and not up.deleted:
+            return
+        for cluster_id in up.deleted:
+            self._cluster_ids.discard(cluster_id)
+            self._rows.pop(cluster_id, None)
+        self._cluster_ids.update(up.added)
+        self._matrix = None
+
+    def pairwise(self):
+        """Return the cluster ids, and the sparse matrix of the similarities between all
+        clusters."""
+        cluster_ids, m = self.matrix()
+        return cluster_ids, m.dot(m.T).tocsr()
+
+    def similarity(self, cluster_id):
+        """Return the list of the `k` most similar clusters to a given cluster, as a list of
+        `(other_cluster_id, similarity)` pairs sorted by decreasing similarity. Clusters that
+        do not share any channel with the cluster are not returned."""
+        if cluster_id not in self._cluster_ids:
+            return []
+        cluster_ids, m = self.matrix()
+        i = np.searchsorted(cluster_ids, cluster_id)
+        query = m[i].toarray().ravel()
+        sims = m.dot(query)
+        # Only keep the clusters with common channels, except the cluster itself.
+        overlap = self._pattern.dot((query != 0).astype(m.dtype)) > 0
+        overlap[i] = False
+        ids, sims, _ = _top(cluster_ids[overlap], sims[overlap], self.k)
+        return [(int(c), float(s)) for c, s in zip(ids, sims)]
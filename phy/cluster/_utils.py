@@ -8,11 +8,15 @@
 
 import numpy as np
 
-from copy import deepcopy
+from contextlib import contextmanager
+from functools import wraps
 import logging
 
 from ._history import History
-from phylib.utils import Bunch, _as_list, _is_list, emit, silent
+from ._index import _grow
+from phylib.io.array import _unique
+from phylib.utils import Bunch, _as_list, _is_list, emit
+from phylib.utils._types import _is_array_like
 
 logger = logging.getLogger(__name__)
 
@@ -33,6 +37,34 @@ def _join(clusters):
     return '[{}]'.format(', '.join(map(str, clusters)))
 
 
+def batch_metric(f):
+    """Decorator for cluster metrics that compute the values of several clusters at once.
+
+    The decorated function takes an array of cluster ids and returns an array of values. It
+    can still be called with a single cluster id, in which case it returns a single value.
+
+    """
+    @wraps(f)
+    def wrapped(*args):
+        *args, cluster_ids = args
+        if not _is_array_like(cluster_ids):
+            return np.asarray(f(*args, np.array([cluster_ids])))[0].item()
+        return f(*args, np.asarray(cluster_ids))
+    wrapped.is_batch = True
+    return wrapped
+
+
+def _metric_values(func, cluster_ids):
+    """Return the list of values of a cluster metric for several clusters.
+
+    Batch metrics are called once with all clusters, other metrics are called once per cluster.
+
+    """
+    if getattr(func, 'is_batch', False):
+        return np.asarray(func(np.asarray(cluster_ids))).tolist()
+    return [func(cluster_id) for cluster_id in cluster_ids]
+
+
 def create_cluster_meta(cluster_groups):
     """Return a ClusterMeta instance with cluster group support."""
     meta = ClusterMeta()
@@ -61,7 +93,10 @@ class UpdateInfo(Bunch):
     history : str
         undo, redo, or None
     spike_ids : array-like
-        All spike ids that were affected by the clustering action.
+        All spike ids that were affected by the clustering action. This is a read-only NumPy
+        array shared with the undo stack, it should not be converted to a list.
+    spike_clusters : array-like
+        Only for assignments: read-only NumPy array with the new cluster ids of `spike_ids`.
     added : list
         List of new cluster ids.
     deleted : list
@@ -74,6 +109,9 @@ class UpdateInfo(Bunch):
         List of cluster ids that had a change of metadata.
     metadata_value : str
         The new metadata value for the affected change.
+    metadata_changes : list
+        Only for batches of metadata changes with several fields or values: list of
+        `(field, clusters, value)` tuples.
     undo_state : Bunch
         Returned during an undo, it contains information about the undone action. This is used
         when redoing the undone action.
@@ -93,9 +131,6 @@ class UpdateInfo(Bunch):
         )
         d.update(kwargs)
         super(UpdateInfo, self).__init__(d)
-        # NOTE: we have to ensure we only use native types and not NumPy arrays so that
-        # the history stack works correctly.
-        assert all(not isinstance(v, np.ndarray) for v in self.values())
 
     def __repr__(self):
         desc = self.description
@@ -118,27 +153,118 @@ class UpdateInfo(Bunch):
 # ClusterMetadataUpdater class
 #------------------------------------------------------------------------------
 
+class _Column(object):
+    """Categorical column of cluster metadata values.
+
+    Every row contains an integer code into the list of distinct values of the column. The
+    code 0 means that no value has been set for that row.
+
+    """
+    def __init__(self, n_rows=0):
+        self.codes = np.zeros(n_rows, dtype=np.int32)
+        self.values = [None]
+        self._codes = {}
+        self._values_array = None
+
+    def code(self, value):
+        """Return the code of a value, adding the value to the column if needed."""
+        # NOTE: the type is part of the key so that 1, 1.0, and True have different codes.
+        key = (type(value), value)
+        try:
+            code = self._codes.get(key, None)
+        except TypeError:  # pragma: no cover
+            # Unhashable values always get a new code.
+            key = code = None
+        if code is None:
+            code = len(self.values)
+            self.values.append(value)
+            self._values_array = None
+            if key is not None:
+                self._codes[key] = code
+        return code
+
+    def decode(self, codes, default=None):
+        """Return the object array of the values corresponding to an array of codes."""
+        if self._values_array is None:
+            self._values_array = np.empty(len(self.values), dtype=object)
+            self._values_array[:] = self.values
+        values = self._values_array[codes]
+        values[codes == 0] = default
+        return values
+
+
 class ClusterMeta(object):
-    """Handle cluster metadata changes."""
+    """Handle cluster metadata changes.
+
+    The values are stored column by column: every cluster with metadata has a row, and every
+    field is a categorical column of these rows. Every change recorded in the undo stack
+    contains the previous values of the changed rows, so that undoing a change does not need
+    to replay the history.
+
+    """
     def __init__(self):
         self._fields = {}
+        self._columns = {}
         self._reset_data()
 
     def _reset_data(self):
-        self._data = {}
-        self._data_base = {}
-        # The stack contains (clusters, field, value, update_info, undo_state)
-        # tuples.
-        self._undo_stack = History((None, None, None, None, None))
+        # Cluster id of every row, and map from cluster ids to rows (-1 if no row).
+        self._row_clusters = np.zeros(0, dtype=np.int64)
+        self._n_rows = 0
+        self._lookup = np.zeros(0, dtype=np.int64)
+        for name in self._columns:
+            self._columns[name] = _Column()
+        # The stack contains (changes, update_info, undo_state) tuples, where changes is a list
+        # of (field, clusters, value, rows, previous_codes) tuples.
+        self._undo_stack = History((None, None, None))
+        # List of changes in the current batch, if any.
+        self._batch = None
+        self._batch_up = None  # UpdateInfo instance yielded by the current batch
+
+    def _rows(self, clusters, create=False):
+        """Return the rows of some clusters, -1 for clusters without a row, unless `create`
+        is True in which case new rows are created."""
+        clusters = np.asarray(clusters, dtype=np.int64).ravel()
+        rows = np.full(len(clusters), -1, dtype=np.int64)
+        valid = (clusters >= 0) & (clusters < len(self._lookup))
+        rows[valid] = self._lookup[clusters[valid]]
+        if not create or np.all(rows >= 0):
+            return rows
+        # Create the missing rows.
+        new = _unique(clusters[rows < 0])
+        assert np.all(new >= 0)
+        n, k = self._n_rows, len(new)
+        self._row_clusters = _grow(self._row_clusters, n + k)
+        self._row_clusters[n:n + k] = new
+        self._lookup = _grow(self._lookup, int(new.max()) + 1, fill=-1)
+        self._lookup[new] = np.arange(n, n + k)
+        for column in self._columns.values():
+            column.codes = _grow(column.codes, len(self._row_clusters), fill=0)
+        self._n_rows += k
+        return self._lookup[clusters]
+
+    def _codes(self, field, clusters):
+        """Return the codes of some clusters for a given field."""
+        rows = self._rows(clusters)
+        codes = np.zeros(len(rows), dtype=np.int32)
+        codes[rows >= 0] = self._columns[field].codes[rows[rows >= 0]]
+        return codes
 
     @property
     def fields(self):
         """List of fields."""
         return sorted(self._fields.keys())
 
+    def set_history_max_memory(self, max_memory, path=None):
+        """Set the maximum memory size of the undo stack, beyond which older changes are
+        compressed and spilled to disk, in the specified file."""
+        self._undo_stack.set_max_memory(max_memory, path=path)
+
     def add_field(self, name, default_value=None):
         """Add a field with an optional default value."""
         self._fields[name] = default_value
+        if name not in self._columns:
+            self._columns[name] = _Column(len(self._row_clusters))
 
         def func(cluster):
             return self.get(name, cluster)
@@ -147,18 +273,31 @@ class ClusterMeta(object):
 
     def from_dict(self, dic):
         """Import data from a `{cluster_id: {field: value}}` dictionary."""
-        #self._reset_data()
-        # Do not raise events here.
-        with silent():
-            for cluster, vals in dic.items():
-                for field, value in vals.items():
-                    self.set(field, [cluster], value, add_to_stack=False)
-        self._data_base = deepcopy(self._data)
+        values = {}
+        for cluster, vals in dic.items():
+            for field, value in vals.items():
+                values.setdefault(field, ([], []))
+                values[field][0].append(cluster)
+                values[field][1].append(value)
+        for field, (clusters, vals) in values.items():
+            if field not in self._fields:
+                self.add_field(field)
+            rows = self._rows(clusters, create=True)
+            column = self._columns[field]
+            column.codes[rows] = [column.code(value) for value in vals]
 
     def to_dict(self, field):
         """Export data to a `{cluster_id: value}` dictionary, for a particular field."""
         assert field in self._fields, "This field doesn't exist"
-        return {cluster: self.get(field, cluster) for cluster in self._data.keys()}
+        n = self._n_rows
+        # Keep the clusters that have a value for any field.
+        has_value = np.zeros(n, dtype=bool)
+        for column in self._columns.values():
+            has_value |= column.codes[:n] > 0
+        column = self._columns[field]
+        clusters = self._row_clusters[:n][has_value]
+        values = column.decode(column.codes[:n][has_value], self._fields[field])
+        return dict(zip(clusters.tolist(), values.tolist()))
 
     def set(self, field, clusters, value, add_to_stack=True):
         """Set the value of one of several clusters.
@@ -187,29 +326,88 @@ class ClusterMeta(object):
         assert field in self._fields
 
         clusters = _as_list(clusters)
-        for cluster in clusters:
-            if cluster not in self._data:
-                self._data[cluster] = {}
-            self._data[cluster][field] = value
+        rows = self._rows(clusters, create=True)
+        column = self._columns[field]
+        previous = column.codes[rows]
+        column.codes[rows] = column.code(value)
 
         up = UpdateInfo(description='metadata_' + field,
                         metadata_changed=clusters,
                         metadata_value=value,
                         )
-        undo_state = emit('request_undo_state', self, up)
 
-        if add_to_stack:
-            self._undo_stack.add((clusters, field, value, up, undo_state))
+        change = (field, clusters, value, rows, previous)
+        if add_to_stack and self._batch is not None:
+            self._batch.append(change)
+        elif add_to_stack:
+            undo_state = emit('request_undo_state', self, up)
+            self._undo_stack.add(([change], up, undo_state))
             emit('cluster', self, up)
 
         return up
 
+    @contextmanager
+    def batch(self):
+        """Context manager grouping several metadata changes into a single action.
+
+        The `cluster` event is only emitted once at the end of the batch. If all changes
+        concern the same field and value, the yielded `UpdateInfo` instance is that of a
+        regular metadata change. Otherwise, its description is `metadata` and its
+        `metadata_changes` item is a list of `(field, clusters, value)` tuples with the final
+        value of every changed cluster. Nested batches are part of the outer batch, and yield
+        the `UpdateInfo` instance of the outer batch.
+
+        """
+        if self._batch is not None:
+            yield self._batch_up
+            return
+        up = self._batch_up = UpdateInfo()
+        self._batch = []
+        try:
+            yield up
+        finally:
+            changes, self._batch = self._batch, None
+            self._batch_up = None
+            if changes:
+                up.update(self._end_batch(changes))
+                undo_state = emit('request_undo_state', self, up)
+                self._undo_stack.add((changes, up, undo_state))
+                emit('cluster', self, up)
+
+    def _end_batch(self, changes):
+        """Return the UpdateInfo instance of a batch of changes."""
+        # Changed clusters of every field, in the order of the changes.
+        changed = {}
+        for field, clusters, _, _, _ in changes:
+            changed.setdefault(field, {}).update(dict.fromkeys(clusters))
+        # Group the changed clusters by field and final value, as a cluster may have been
+        # changed several times in the batch.
+        groups = {}
+        for field, clusters in changed.items():
+            for cluster, value in zip(clusters, self.get(field, list(clusters))):
+                groups.setdefault((field, value), []).append(cluster)
+        clusters = list(dict.fromkeys(c for _, cl, _, _, _ in changes for c in cl))
+        if len(groups) == 1:
+            (field, value), = groups
+            return UpdateInfo(
+                description='metadata_' + field, metadata_changed=clusters, metadata_value=value)
+        return UpdateInfo(
+            description='metadata', metadata_changed=clusters,
+            metadata_changes=[(field, cl, value) for (field, value), cl in groups.items()])
+
     def get(self, field, cluster):
-        """Retrieve the value of one cluster for a given field."""
-        if _is_list(cluster):
-            return [self.get(field, c) for c in cluster]
+        """Retrieve the value of one cluster for a given field.
+
+        If `cluster` is a list or an array of cluster ids, return the list of values.
+
+        """
         assert field in self._fields
-        return self._data.get(cluster, {}).get(field, self._fields[field])
+        column = self._columns[field]
+        if _is_list(cluster) or isinstance(cluster, np.ndarray):
+            return column.decode(self._codes(field, cluster), self._fields[field]).tolist()
+        row = self._lookup[cluster] if 0 <= cluster < len(self._lookup) else -1
+        code = column.codes[row] if row >= 0 else 0
+        return column.values[code] if code else self._fields[field]
 
     def set_from_descendants(self, descendants, largest_old_cluster=None):
         """Update metadata of some clusters given the metadata of their ascendants.
@@ -223,15 +421,15 @@ class ClusterMeta(object):
             If available, the cluster id of the largest old cluster, used as a reference.
 
         """
+        if not len(descendants):
+            return
+        old_clusters = _unique([old for old, _ in descendants])
+        new_clusters = _unique([new for _, new in descendants])
         for field in self.fields:
             # Consider the default value for the current field.
             default = self._fields[field]
-            # This maps old cluster ids to their values.
-            old_values = {old: self.get(field, old) for old, _ in descendants}
-            # This is the set of new clusters.
-            new_clusters = set(new for _, new in descendants)
             # This is the set of old non-default values.
-            old_values_set = set(old_values.values())
+            old_values_set = set(self.get(field, old_clusters))
             if default in old_values_set:
                 old_values_set.remove(default)
             # old_values_set contains all non-default values of the modified clusters.
@@ -248,11 +446,13 @@ class ClusterMeta(object):
                 # We ensure that the largest old cluster is specified.
                 assert largest_old_cluster is not None
                 # We choose this value.
-                new_value = old_values[largest_old_cluster]
+                new_value = self.get(field, largest_old_cluster)
             # Set the new value to all new clusters that don't already have a non-default value.
-            for new in new_clusters:
-                if self.get(field, new) == default:
-                    self.set(field, new, new_value, add_to_stack=False)
+            new_values = self.get(field, new_clusters)
+            to_set = [new for new, value in zip(new_clusters.tolist(), new_values)
+                      if value == default]
+            if to_set:
+                self.set(field, to_set, new_value, add_to_stack=False)
 
     def undo(self):
         """Undo the last metadata change.
@@ -266,10 +466,9 @@ class ClusterMeta(object):
         args = self._undo_stack.back()
         if args is None:
             return
-        self._data = deepcopy(self._data_base)
-        for clusters, field, value, up, undo_state in self._undo_stack:
-            if clusters is not None:
-                self.set(field, clusters, value, add_to_stack=False)
+        # Restore the previous values of the changed rows.
+        for field, _, _, rows, previous in reversed(args[0]):
+            self._columns[field].codes[rows] = previous
 
         # Return the UpdateInfo instance of the undo action.
         up, undo_state = args[-2:]
@@ -291,8 +490,10 @@ class ClusterMeta(object):
         args = self._undo_stack.forward()
         if args is None:
             return
-        clusters, field, value, up, undo_state = args
-        self.set(field, clusters, value, add_to_stack=False)
+        changes, up, undo_state = args
+        for field, _, value, rows, _ in changes:
+            column = self._columns[field]
+            column.codes[rows] = column.code(value)
 
         # Return the UpdateInfo instance of the redo action.
         up.history = 'redo'
@@ -6,14 +6,17 @@
 # Imports
 #------------------------------------------------------------------------------
 
+from contextlib import contextmanager
 import logging
 
 import numpy as np
 
 from phylib.utils._types import _as_array, _is_array_like
-from phylib.io.array import _unique, _spikes_in_clusters, _spikes_per_cluster
+from phylib.io.array import _unique, _spikes_in_clusters
 from ._utils import UpdateInfo
 from ._history import History
+from ._index import SpikesPerCluster
+from ._overlay import OverlayArray
 from phylib.utils.event import emit
 
 logger = logging.getLogger(__name__)
@@ -23,7 +26,7 @@ logger = logging.getLogger(__name__)
 # Clustering class
 #------------------------------------------------------------------------------
 
-def _extend_spikes(spike_ids, spike_clusters):
+def _extend_spikes(spike_ids, spike_clusters, spikes_per_cluster=None):
     """Return all spikes belonging to the clusters containing the specified
     spikes."""
     # We find the spikes belonging to modified clusters.
@@ -31,7 +34,11 @@ def _extend_spikes(spike_ids, spike_clusters):
     old_spike_clusters = spike_clusters[spike_ids]
     unique_clusters = _unique(old_spike_clusters)
     # Now we take all spikes from these clusters.
-    changed_spike_ids = _spikes_in_clusters(spike_clusters, unique_clusters)
+    if spikes_per_cluster is not None:
+        # OPTIM: use the spikes per cluster index rather than scanning all spikes.
+        changed_spike_ids = spikes_per_cluster.spikes_in_clusters(unique_clusters)
+    else:
+        changed_spike_ids = _spikes_in_clusters(spike_clusters, unique_clusters)
     # These are the new spikes that need to be reassigned.
     extended_spike_ids = np.setdiff1d(changed_spike_ids, spike_ids, assume_unique=True)
     return extended_spike_ids
@@ -46,11 +53,14 @@ def _concatenate_spike_clusters(*pairs):
     return concat[:, 0].astype(np.int64), concat[:, 1].astype(np.int64)
 
 
-def _extend_assignment(spike_ids, old_spike_clusters, spike_clusters_rel, new_cluster_id):
+def _extend_assignment(
+        spike_ids, old_spike_clusters, spike_clusters_rel, new_cluster_id,
+        spikes_per_cluster=None):
     # 1. Add spikes that belong to modified clusters.
     # 2. Find new cluster ids for all changed clusters.
 
-    old_spike_clusters = _as_array(old_spike_clusters)
+    if not isinstance(old_spike_clusters, OverlayArray):
+        old_spike_clusters = _as_array(old_spike_clusters)
     spike_ids = _as_array(spike_ids)
 
     assert isinstance(spike_clusters_rel, (list, np.ndarray))
@@ -61,7 +71,8 @@ def _extend_assignment(spike_ids, old_spike_clusters, spike_clusters_rel, new_cl
     new_spike_clusters = (spike_clusters_rel + (new_cluster_id - spike_clusters_rel.min()))
 
     # We find the spikes belonging to modified clusters.
-    extended_spike_ids = _extend_spikes(spike_ids, old_spike_clusters)
+    extended_spike_ids = _extend_spikes(
+        spike_ids, old_spike_clusters, spikes_per_cluster=spikes_per_cluster)
     if len(extended_spike_ids) == 0:
         return spike_ids, new_spike_clusters
 
@@ -78,17 +89,40 @@ def _extend_assignment(spike_ids, old_spike_clusters, spike_clusters_rel, new_cl
         (spike_ids, new_spike_clusters), (extended_spike_ids, extended_spike_clusters))
 
 
+def _read_only(arr):
+    """Return a read-only view of an array, to be shared safely by UpdateInfo listeners."""
+    arr = _as_array(arr).view()
+    arr.flags.writeable = False
+    return arr
+
+
+def _scan_clusters(spike_clusters):
+    """Return the sorted non-empty cluster ids, and the number of clustered spikes, reading
+    the spike clusters chunk by chunk when they are not fully in memory."""
+    if isinstance(spike_clusters, OverlayArray):
+        chunks = spike_clusters.iter_chunks()
+    else:
+        chunks = [spike_clusters]
+    cluster_ids, n_spikes = np.array([], dtype=np.int64), 0
+    for chunk in chunks:
+        cluster_ids = np.union1d(cluster_ids, _unique(chunk))
+        n_spikes += int(np.sum(chunk >= 0))
+    return cluster_ids.astype(np.int64), n_spikes
+
+
 def _assign_update_info(spike_ids, old_spike_clusters, new_spike_clusters):
     old_clusters = _unique(old_spike_clusters)
     new_clusters = _unique(new_spike_clusters)
     largest_old_cluster = np.bincount(old_spike_clusters).argmax()
-    descendants = list(set(zip(old_spike_clusters, new_spike_clusters)))
+    # Unique (old_cluster, new_cluster) pairs, sorted by old and new cluster.
+    pairs = np.unique(np.c_[old_spike_clusters, new_spike_clusters], axis=0)
+    descendants = [(int(old), int(new)) for old, new in pairs]
     update_info = UpdateInfo(
         description='assign',
-        spike_ids=list(spike_ids),
-        spike_clusters=list(new_spike_clusters),
-        added=list(new_clusters),
-        deleted=list(old_clusters),
+        spike_ids=_read_only(spike_ids),
+        spike_clusters=_read_only(new_spike_clusters),
+        added=new_clusters.tolist(),
+        deleted=old_clusters.tolist(),
         descendants=descendants,
         largest_old_cluster=int(largest_old_cluster),
     )
@@ -106,26 +140,38 @@ class Clustering(object):
     new_cluster_id : int
         Cluster id that is not used yet (and not used in the cache if there is one). We need to
         ensure that cluster ids are unique and not reused in a given session.
-    spikes_per_cluster : dict
-        Dictionary mapping each cluster id to the spike ids belonging to it. This is recomputed
+    spikes_per_cluster : SpikesPerCluster or dict
+        Index of the spike ids belonging to each cluster. This is recomputed
         if not given. This object may take a while to compute, so it may be cached and passed
         to the constructor.
+    checkpoint_interval : int
+        If set, a full copy of the spike-cluster assignments is kept every `checkpoint_interval`
+        actions. This is only used as a fallback when a history item does not carry
+        its reverse delta.
+    low_memory : boolean
+        If True, the original spike-cluster assignments are not copied and may be a read-only
+        memory-mapped array. The cluster ids are stored as 32-bit integers, and the changes are
+        kept in a sparse overlay that only contains the modified spikes. The `spike_clusters`
+        property then returns an `OverlayArray` rather than a NumPy array.
 
     Features
     --------
 
     * List of clusters appearing in a `spike_clusters` array
-    * Dictionary of spikes per cluster
+    * Index of spikes per cluster
     * Merge
     * Split and assign
+    * Batches of actions
     * Undo/redo stack
 
     Notes
     -----
 
     The undo stack works by keeping the list of all spike cluster changes
-    made successively. Undoing consists of reapplying all changes from the
-    original `spike_clusters` array, except the last one.
+    made successively. Every item stores the new cluster ids of the affected spikes, and also
+    their previous cluster ids (reverse delta). Undoing consists of restoring the previous
+    cluster ids of the spikes affected by the last change, so that the cost of undo and redo
+    only depends on the size of the change, not on the length of the history.
 
     UpdateInfo
     ----------
@@ -139,24 +185,47 @@ class Clustering(object):
 
     """
 
+    # Whether to check the incrementally-updated cluster ids against a full scan of the spike
+    # clusters after every change. This is slow and is meant for debugging.
+    check_consistency = False
+
     def __init__(self, spike_clusters, new_cluster_id=None,
-                 spikes_per_cluster=None):
+                 spikes_per_cluster=None, checkpoint_interval=None, low_memory=False):
         super(Clustering, self).__init__()
-        self._undo_stack = History(base_item=(None, None, None))
+        # The stack contains (spike_ids, cluster_ids, old_cluster_ids, undo_state) tuples.
+        self._undo_stack = History(base_item=(None, None, None, None))
+        # Periodic full copies of the spike clusters, {history_index: spike_clusters}.
+        self._checkpoint_interval = checkpoint_interval
+        self._checkpoints = {}
         # Spike -> cluster mapping.
-        self._spike_clusters = _as_array(spike_clusters)
-        self._spikes_per_cluster = {}
+        self.low_memory = low_memory
+        if low_memory:
+            if not isinstance(spike_clusters, np.ndarray):
+                spike_clusters = _as_array(spike_clusters, dtype=np.int32)
+            self._spike_clusters = OverlayArray(spike_clusters, dtype=np.int32)
+        else:
+            self._spike_clusters = _as_array(spike_clusters)
         self._n_spikes = len(self._spike_clusters)
-        self._spike_ids = np.arange(self._n_spikes).astype(np.int64)
-        # We can pass the precomputed spikes_per_cluster dictionary for
+        # We can pass the precomputed spikes_per_cluster index for
         # performance reasons.
-        self._update_cluster_ids(to_add=spikes_per_cluster)
-        self._new_cluster_id_0 = int(new_cluster_id or self._spike_clusters.max() + 1)
+        if isinstance(spikes_per_cluster, dict):
+            spikes_per_cluster = SpikesPerCluster.from_dict(spikes_per_cluster)
+        self._spikes_per_cluster = spikes_per_cluster or SpikesPerCluster()
+        self._update_cluster_ids()
+        max_cluster_id = int(self._cluster_ids.max()) if len(self._cluster_ids) else -1
+        self._new_cluster_id_0 = int(new_cluster_id or max_cluster_id + 1)
         self._new_cluster_id = self._new_cluster_id_0
         assert self._new_cluster_id >= 0
-        assert np.all(self._spike_clusters < self._new_cluster_id)
-        # Keep a copy of the original spike clusters assignment.
-        self._spike_clusters_base = self._spike_clusters.copy()
+        assert max_cluster_id < self._new_cluster_id
+        # Keep a copy of the original spike clusters assignment (the base array of the overlay
+        # in low-memory mode).
+        if low_memory:
+            self._spike_clusters_base = self._spike_clusters.base
+        else:
+            self._spike_clusters_base = self._spike_clusters.copy()
+        # List of (spike_ids, old_spike_clusters) changes in the current batch, if any.
+        self._batch = None
+        self._batch_up = None  # UpdateInfo instance yielded by the current batch
 
     def reset(self):
         """Reset the clustering to the original clustering.
@@ -164,9 +233,30 @@ class Clustering(object):
         All changes are lost.
 
         """
-        self._undo_stack.clear()
-        self._spike_clusters = self._spike_clusters_base
+        self._undo_stack.clear((None, None, None, None))
+        self._checkpoints.clear()
+        if self.low_memory:
+            self._spike_clusters.reset()
+        else:
+            self._spike_clusters = self._spike_clusters_base.copy()
         self._new_cluster_id = self._new_cluster_id_0
+        # The per-cluster structures need to be recomputed from scratch.
+        self._spikes_per_cluster = SpikesPerCluster()
+        self._update_cluster_ids()
+
+    def rebase(self, spike_clusters):
+        """In low-memory mode, replace the base array of the spike clusters overlay by an array
+        with the current spike clusters, typically the memory-mapped file where they have been
+        saved. The previous base array is no longer referenced, so that its file can be
+        replaced, and `reset()` then restores the saved assignment."""
+        assert self.low_memory
+        self._spike_clusters.rebase(spike_clusters)
+        assert self._spike_clusters.n_modified == 0
+        self._spike_clusters_base = spike_clusters
+        # Checkpoint of the saved assignment, used to reconstruct the history from this point.
+        index = self._undo_stack.current_position
+        if index:
+            self._checkpoints[index] = spike_clusters
 
     @property
     def spike_clusters(self):
@@ -175,7 +265,7 @@ class Clustering(object):
 
     @property
     def spikes_per_cluster(self):
-        """A dictionary {cluster_id: spike_ids}."""
+        """A `SpikesPerCluster` index, behaving like a dictionary {cluster_id: spike_ids}."""
         return self._spikes_per_cluster
 
     @property
@@ -183,6 +273,11 @@ class Clustering(object):
         """Ordered list of ids of all non-empty clusters."""
         return self._cluster_ids
 
+    @property
+    def cluster_sizes(self):
+        """Number of spikes in every cluster, in the same order as `cluster_ids`."""
+        return self._cluster_sizes
+
     def new_cluster_id(self):
         """Generate a brand new cluster id.
 
@@ -210,33 +305,59 @@ class Clustering(object):
     @property
     def spike_ids(self):
         """Array of all spike ids."""
-        return self._spike_ids
+        # NOTE: this array is created on demand rather than kept in memory.
+        return np.arange(self._n_spikes)
 
     def spikes_in_clusters(self, clusters):
         """Return the array of spike ids belonging to a list of clusters."""
-        return _spikes_in_clusters(self.spike_clusters, clusters)
+        return self._spikes_per_cluster.spikes_in_clusters(clusters)
+
+    def set_history_max_memory(self, max_memory, path=None):
+        """Set the maximum memory size of the undo stack, beyond which older actions are
+        compressed and spilled to disk, in the specified file."""
+        self._undo_stack.set_max_memory(max_memory, path=path)
 
     # Actions
     #--------------------------------------------------------------------------
 
     def _update_cluster_ids(self, to_remove=None, to_add=None):
-        # Update the list of non-empty cluster ids.
-        self._cluster_ids = _unique(self._spike_clusters)
-        # Clusters to remove.
-        if to_remove is not None:
-            for clu in to_remove:
-                self._spikes_per_cluster.pop(clu, None)
-        # Clusters to add.
-        if to_add:
-            for clu, spk in to_add.items():
-                self._spikes_per_cluster[clu] = spk
+        if to_remove is None and to_add is None:
+            self._reset_cluster_ids()
+        else:
+            # OPTIM: update the sorted list of non-empty cluster ids and their sizes from
+            # the removed and added clusters only, without scanning all spikes.
+            keep = ~np.isin(self._cluster_ids, to_remove)
+            to_add = np.unique(_as_array(to_add, dtype=np.int64))
+            cluster_ids = np.concatenate((self._cluster_ids[keep], to_add))
+            sizes = np.concatenate((
+                self._cluster_sizes[keep], self._spikes_per_cluster.counts(to_add)))
+            order = np.argsort(cluster_ids, kind='mergesort')
+            self._cluster_ids, self._cluster_sizes = cluster_ids[order], sizes[order]
+        if self.check_consistency:
+            self._check_cluster_ids()
+
+    def _reset_cluster_ids(self):
+        """Recompute the list of non-empty cluster ids and their sizes from scratch."""
+        self._cluster_ids, n_spikes = _scan_clusters(self._spike_clusters)
         # If spikes_per_cluster is invalid, recompute the entire
-        # spikes_per_cluster array.
-        coherent = np.all(np.in1d(self._cluster_ids, sorted(self._spikes_per_cluster)))
+        # spikes_per_cluster index.
+        spc = self._spikes_per_cluster
+        coherent = (
+            spc.n_spikes == n_spikes and
+            np.array_equal(self._cluster_ids, spc.cluster_ids))
         if not coherent:
             logger.debug("Recompute spikes_per_cluster manually: this might take a while.")
-            sc = self._spike_clusters
-            self._spikes_per_cluster = _spikes_per_cluster(sc)
+            self._spikes_per_cluster = SpikesPerCluster.from_spike_clusters(self._spike_clusters)
+        self._cluster_sizes = self._spikes_per_cluster.counts(self._cluster_ids)
+
+    def _check_cluster_ids(self):
+        """Check that the incremental cluster structures match the spike clusters (slow)."""
+        spike_clusters = np.asarray(self._spike_clusters)
+        cluster_ids = _unique(spike_clusters)
+        assert np.array_equal(self._cluster_ids, cluster_ids)
+        assert np.array_equal(self._spikes_per_cluster.cluster_ids, cluster_ids)
+        sizes = np.bincount(spike_clusters[spike_clusters >= 0])[cluster_ids]
+        assert np.array_equal(self._cluster_sizes, sizes)
 
     def _do_assign(self, spike_ids, new_spike_clusters):
         """Make spike-cluster assignments after the spike selection has
@@ -271,20 +392,24 @@ class Clustering(object):
         # We make the assignments.
         self._spike_clusters[spike_ids] = new_spike_clusters
         # OPTIM: we update spikes_per_cluster manually.
-        new_spc = _spikes_per_cluster(new_spike_clusters, spike_ids)
-        self._update_cluster_ids(to_remove=old_clusters, to_add=new_spc)
+        self._spikes_per_cluster.remove(old_clusters)
+        self._spikes_per_cluster.assign(spike_ids, new_spike_clusters)
+        self._update_cluster_ids(to_remove=up.deleted, to_add=up.added)
         return up
 
     def _do_merge(self, spike_ids, cluster_ids, to):
 
         # Create the UpdateInfo instance here.
+        cluster_ids = [int(cluster) for cluster in cluster_ids]
+        to = int(to)
         descendants = [(cluster, to) for cluster in cluster_ids]
-        largest_old_cluster = np.bincount(self.spike_clusters[spike_ids]).argmax()
+        sizes = self._spikes_per_cluster.counts(cluster_ids)
+        largest_old_cluster = int(cluster_ids[np.argmax(sizes)])
         up = UpdateInfo(
             description='merge',
-            spike_ids=list(spike_ids),
+            spike_ids=_read_only(spike_ids),
             added=[to],
-            deleted=list(cluster_ids),
+            deleted=cluster_ids,
             descendants=descendants,
             largest_old_cluster=largest_old_cluster,
         )
@@ -296,7 +421,9 @@ class Clustering(object):
         self.spike_clusters[spike_ids] = to
         # Update the list of non-empty cluster ids.
         # OPTIM: we update spikes_per_cluster manually.
-        self._update_cluster_ids(to_remove=cluster_ids, to_add={to: spike_ids})
+        self._spikes_per_cluster.remove(cluster_ids)
+        self._spikes_per_cluster.add(to, spike_ids)
+        self._update_cluster_ids(to_remove=cluster_ids, to_add=[to])
         return up
 
     def merge(self, cluster_ids, to=None):
@@ -337,15 +464,12 @@ class Clustering(object):
         # cheaper operation.
 
         # Find all spikes in the specified clusters.
-        spike_ids = _spikes_in_clusters(self.spike_clusters, cluster_ids)
+        spike_ids = self.spikes_in_clusters(cluster_ids)
+        # Keep the old cluster ids for undo.
+        old_spike_clusters = self._spike_clusters[spike_ids]
 
         up = self._do_merge(spike_ids, cluster_ids, to)
-        undo_state = emit('request_undo_state', self, up)
-
-        # Add to stack.
-        self._undo_stack.add((spike_ids, [to], undo_state))
-
-        emit('cluster', self, up)
+        self._commit(up, spike_ids, [to], old_spike_clusters)
         return up
 
     def assign(self, spike_ids, spike_clusters_rel=0):
@@ -411,15 +535,50 @@ class Clustering(object):
         # belong to clusters affected by the operation, will be assigned
         # to brand new clusters.
         spike_ids, cluster_ids = _extend_assignment(
-            spike_ids, self._spike_clusters, spike_clusters_rel, self.new_cluster_id())
+            spike_ids, self._spike_clusters, spike_clusters_rel, self.new_cluster_id(),
+            spikes_per_cluster=self._spikes_per_cluster)
+        # Keep the old cluster ids for undo.
+        old_spike_clusters = self._spike_clusters[spike_ids]
 
         up = self._do_assign(spike_ids, cluster_ids)
-        undo_state = emit('request_undo_state', self, up)
+        self._commit(up, spike_ids, cluster_ids, old_spike_clusters)
+        return up
 
-        # Add the assignment to the undo stack.
-        self._undo_stack.add((spike_ids, cluster_ids, undo_state))
+    def apply(self, spike_ids, spike_clusters):
+        """Make spike-cluster assignments with absolute cluster ids.
 
-        emit('cluster', self, up)
+        Unlike `assign()`, the cluster ids are not renumbered, and the spikes must cover whole
+        clusters. This is used to replay recorded actions.
+
+        Parameters
+        ----------
+
+        spike_ids : array-like
+            List of spike ids.
+        spike_clusters : array-like
+            New cluster ids of the spikes in `spike_ids`, or a single cluster id.
+
+        Returns
+        -------
+
+        up : UpdateInfo instance
+
+        """
+        spike_ids = _as_array(spike_ids, dtype=np.int64)
+        spike_clusters = _as_array(spike_clusters, dtype=np.int64)
+        if len(spike_ids) == 0:
+            return UpdateInfo()
+        if len(spike_clusters) == 1:
+            spike_clusters = np.repeat(spike_clusters, len(spike_ids))
+        old_spike_clusters = self._spike_clusters[spike_ids]
+        old_clusters = _unique(old_spike_clusters)
+        if self._spikes_per_cluster.counts(old_clusters).sum() != len(spike_ids):
+            raise ValueError("The spikes should cover whole clusters.")
+        existing = np.setdiff1d(self._cluster_ids, old_clusters)
+        if np.isin(spike_clusters, existing).any():
+            raise ValueError("Some clusters already exist.")
+        up = self._do_assign(spike_ids, spike_clusters)
+        self._commit(up, spike_ids, spike_clusters, old_spike_clusters)
         return up
 
     def split(self, spike_ids, spike_clusters_rel=0):
@@ -451,29 +610,127 @@ class Clustering(object):
         # self.assign() accepts relative numbers as second argument.
         return self.assign(spike_ids, spike_clusters_rel)
 
-    def undo(self):
-        """Undo the last cluster assignment operation.
+    def _commit(self, up, spike_ids, cluster_ids, old_spike_clusters):
+        """Register an action that has just been applied: add it to the undo stack and
+        emit the `cluster` event, or record it in the current batch."""
+        if self._batch is not None:
+            self._batch.append((_as_array(spike_ids), _as_array(old_spike_clusters)))
+            return
+        undo_state = emit('request_undo_state', self, up)
+        # Add the assignment to the undo stack.
+        self._add_to_stack(spike_ids, cluster_ids, old_spike_clusters, undo_state)
+        emit('cluster', self, up)
+
+    def _end_batch(self, changes):
+        """Combine the changes of a batch into a single action."""
+        spike_ids = np.concatenate([spk for spk, _ in changes])
+        old_spike_clusters = np.concatenate([clu for _, clu in changes])
+        # Keep the cluster of every spike before its first change in the batch.
+        spike_ids, first = np.unique(spike_ids, return_index=True)
+        old_spike_clusters = old_spike_clusters[first]
+        new_spike_clusters = self._spike_clusters[spike_ids]
+        # NOTE: as every action assigns brand new clusters to whole clusters, the combined
+        # action is an assignment from the old clusters to the new ones. Clusters created
+        # and deleted within the batch are neither added nor deleted.
+        up = _assign_update_info(spike_ids, old_spike_clusters, new_spike_clusters)
+        undo_state = emit('request_undo_state', self, up)
+        self._add_to_stack(spike_ids, new_spike_clusters, old_spike_clusters, undo_state)
+        return up
+
+    @contextmanager
+    def batch(self):
+        """Context manager grouping several merges and assignments into a single action.
+
+        The actions are applied immediately, but the `cluster` event is only emitted once at the
+        end of the batch, with an `UpdateInfo` instance combining all changes. The batch is a
+        single item in the undo stack. The context manager yields this `UpdateInfo` instance,
+        which is filled at the end of the batch. Nested batches are part of the outer batch, and
+        yield the `UpdateInfo` instance of the outer batch.
+
+        """
+        if self._batch is not None:
+            yield self._batch_up
+            return
+        up = self._batch_up = UpdateInfo()
+        self._batch = []
+        try:
+            yield up
+        finally:
+            changes, self._batch = self._batch, None
+            self._batch_up = None
+            if changes:
+                up.update(self._end_batch(changes))
+                emit('cluster', self, up)
+
+    def apply_batch(self, actions):
+        """Apply a list of actions as a single action.
+
+        Parameters
+        ----------
+
+        actions : list
+            List of `(name, *args)` tuples, where `name` is `merge`, `assign`, or `split`, and
+            `args` are the arguments of the corresponding method.
 
         Returns
         -------
 
-        up : UpdateInfo instance of the changes done by this operation.
+        up : UpdateInfo instance combining the changes of all actions
 
         """
-        _, _, undo_state = self._undo_stack.back()
-
-        # Retrieve the initial spike_cluster structure.
-        spike_clusters_new = self._spike_clusters_base.copy()
+        with self.batch() as up:
+            for name, *args in actions:
+                if name not in ('merge', 'assign', 'split'):
+                    raise ValueError("Unknown clustering action `%s`." % name)
+                getattr(self, name)(*args)
+        return up
 
-        # Loop over the history (except the last item because we undo).
-        for spike_ids, cluster_ids, _ in self._undo_stack:
-            # We update the spike clusters accordingly.
+    def _add_to_stack(self, spike_ids, cluster_ids, old_spike_clusters, undo_state):
+        """Add an action to the undo stack, with its reverse delta, and possibly a checkpoint."""
+        self._undo_stack.add((spike_ids, cluster_ids, old_spike_clusters, undo_state))
+        index = self._undo_stack.current_position
+        # Remove the checkpoints of the discarded redo items.
+        for i in [i for i in self._checkpoints if i >= index]:
+            del self._checkpoints[i]
+        if self._checkpoint_interval and index % self._checkpoint_interval == 0:
+            logger.log(5, "Checkpoint the spike clusters at history index %d.", index)
+            self._checkpoints[index] = self._spike_clusters.copy()
+
+    def _spike_clusters_at(self, index):
+        """Reconstruct the spike clusters assignment at a given position in the history,
+        starting from the closest checkpoint (or the original assignment)."""
+        start = max((i for i in self._checkpoints if i <= index), default=0)
+        spike_clusters = (
+            self._checkpoints[start] if start else self._spike_clusters_base).copy()
+        for spike_ids, cluster_ids, _, _ in self._undo_stack.iter(start + 1, index + 1):
             if spike_ids is not None:
-                spike_clusters_new[spike_ids] = cluster_ids
+                spike_clusters[spike_ids] = cluster_ids
+        return spike_clusters
+
+    def undo(self):
+        """Undo the last cluster assignment operation.
+
+        Returns
+        -------
+
+        up : UpdateInfo instance of the changes done by this operation.
 
-        # What are the spikes affected by the last changes?
-        changed = np.nonzero(self._spike_clusters != spike_clusters_new)[0]
-        clusters_changed = spike_clusters_new[changed]
+        """
+        if self._batch is not None:
+            raise RuntimeError("Cannot undo during a batch.")
+        spike_ids, _, old_spike_clusters, undo_state = self._undo_stack.back()
+
+        if old_spike_clusters is not None:
+            # Restore the previous cluster ids of the spikes affected by the last change.
+            spike_ids = _as_array(spike_ids)
+            old_spike_clusters = _as_array(old_spike_clusters)
+            changed = self._spike_clusters[spike_ids] != old_spike_clusters
+            changed, clusters_changed = spike_ids[changed], old_spike_clusters[changed]
+        else:  # pragma: no cover
+            # Fallback when there is no reverse delta: replay the history.
+            spike_clusters_new = self._spike_clusters_at(self._undo_stack.current_position)
+            changed = np.nonzero(np.asarray(self._spike_clusters) != spike_clusters_new)[0]
+            clusters_changed = spike_clusters_new[changed]
 
         up = self._do_assign(changed, clusters_changed)
         up.history = 'undo'
@@ -492,6 +749,8 @@ class Clustering(object):
         up : UpdateInfo instance of the changes done by this operation.
 
         """
+        if self._batch is not None:
+            raise RuntimeError("Cannot redo during a batch.")
         # Go forward in the stack, and retrieve the new assignment.
         item = self._undo_stack.forward()
         if item is None:
@@ -502,7 +761,7 @@ class Clustering(object):
         # It represents data associated to the state
         # *before* the action. What might be more useful would be the
         # undo_state object of the next item in the list (if it exists).
-        spike_ids, cluster_ids, undo_state = item
+        spike_ids, cluster_ids, _, undo_state = item
         assert spike_ids is not None
 
         # We apply the new assignment.
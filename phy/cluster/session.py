@@ -0,0 +1,493 @@
+# -*- coding: utf-8 -*-
+
+"""Headless curation session."""
+
+
+# -----------------------------------------------------------------------------
+# Imports
+# -----------------------------------------------------------------------------
+
+from contextlib import contextmanager
+import logging
+
+from ._history import GlobalHistory
+from ._index import SpikesPerCluster
+from ._journal import ActionJournal, ASSIGN, MERGE, METADATA
+from ._utils import batch_metric, create_cluster_meta, _metric_values
+from .clustering import Clustering
+
+from phylib.utils import emit, connect
+
+logger = logging.getLogger(__name__)
+
+
+# -----------------------------------------------------------------------------
+# Utility functions
+# -----------------------------------------------------------------------------
+
+def _process_ups(ups):  # pragma: no cover
+    """This function processes the UpdateInfo instances of the two
+    undo stacks (clustering and cluster metadata) and concatenates them
+    into a single UpdateInfo instance."""
+    if len(ups) == 0:
+        return
+    elif len(ups) == 1:
+        return ups[0]
+    elif len(ups) == 2:
+        up = ups[0]
+        up.update(ups[1])
+        return up
+    else:
+        raise NotImplementedError()
+
+
+def _ensure_all_ints(l):
+    if (l is None or l == []):
+        return
+    for i in range(len(l)):
+        l[i] = int(l[i])
+
+
+def _is_group_masked(group):
+    return group in ('noise', 'mua')
+
+
+# -----------------------------------------------------------------------------
+# Curation session
+# -----------------------------------------------------------------------------
+
+class CurationSession(object):
+    """Clustering and cluster metadata changes with a global undo stack, without any GUI.
+
+    This object does not depend on Qt and can be driven from a Python script, for example
+    to run automated curation on a compute node. The `Supervisor` derives from this class
+    and adds the cluster and similarity views.
+
+    Constructor
+    -----------
+
+    spike_clusters : array-like
+        Spike-clusters assignments.
+    cluster_groups : dict
+        Maps a cluster id to a group name (noise, mea, good, None for unsorted).
+    cluster_metrics : dict
+        Maps a metric name to a function `cluster_id => value`, or to a batch function
+        `cluster_ids => values` decorated with `batch_metric`.
+    cluster_labels : dict
+        Maps a label name to a dictionary `{cluster_id: value}`.
+    new_cluster_id : function
+        Function that takes no argument and returns a brand new cluster id (smallest cluster id
+        not used in the cache).
+    context : Context
+        Handles the cache.
+    low_memory : boolean
+        Whether to use the low-memory mode of the `Clustering` instance, where `spike_clusters`
+        may be a read-only memory-mapped array.
+    history_max_memory : int
+        If set, maximum memory size in bytes of the undo stacks. Older actions are compressed
+        and spilled to disk, in the `history` subdirectory of the cache directory.
+
+    Events
+    ------
+
+    * `cluster(up)`
+        When a clustering action occurs, changing the spike clusters assignment of the cluster
+        metadata.
+    * `save_clustering(spike_clusters, cluster_groups, *cluster_labels)`
+        When the user wants to save the spike cluster assignments and the cluster metadata.
+
+    """
+
+    def __init__(
+            self, spike_clusters=None, cluster_groups=None, cluster_metrics=None,
+            cluster_labels=None, new_cluster_id=None, context=None, low_memory=False,
+            history_max_memory=None):
+        super(CurationSession, self).__init__()
+        self.context = context
+        self._is_dirty = None
+        self._in_batch = False
+        self._journal = None
+
+        # Cluster metrics.
+        # This is a dict {name: func cluster_id => value}.
+        self.cluster_metrics = cluster_metrics or {}
+        self.cluster_metrics['n_spikes'] = self.n_spikes
+
+        # Cluster labels.
+        # This is a dict {name: {cl: value}}
+        self.cluster_labels = cluster_labels or {}
+
+        # Create Clustering and ClusterMeta.
+        # Load the cached spikes_per_cluster index.
+        spc = context.load('spikes_per_cluster') if context else None
+        if spc and set(spc) == {'spikes', 'offsets', 'clusters'}:
+            spc = SpikesPerCluster(**spc)
+        self.clustering = Clustering(
+            spike_clusters, spikes_per_cluster=spc, new_cluster_id=new_cluster_id,
+            low_memory=low_memory)
+
+        # Cache the spikes_per_cluster index.
+        self._save_spikes_per_cluster()
+
+        # Create the ClusterMeta instance.
+        self.cluster_meta = create_cluster_meta(cluster_groups or {})
+        # Add the labels.
+        for label, values in self.cluster_labels.items():
+            if label == 'group':
+                continue
+            self.cluster_meta.add_field(label)
+            for cl, v in values.items():
+                self.cluster_meta.set(label, [cl], v, add_to_stack=False)
+
+        # Bound the memory used by the undo stacks.
+        if history_max_memory:
+            self._set_history_max_memory(history_max_memory)
+
+        # Create the GlobalHistory instance.
+        self._global_history = GlobalHistory(process_ups=_process_ups)
+
+        # Log the actions.
+        connect(self._log_action, event='cluster', sender=self.clustering)
+        connect(self._log_action_meta, event='cluster', sender=self.cluster_meta)
+
+        # Raise session.cluster
+        @connect(sender=self.clustering)
+        def on_cluster(sender, up):
+            # NOTE: update the cluster meta of new clusters, depending on the values of the
+            # ancestor clusters. In case of a conflict between the values of the old clusters,
+            # the largest cluster wins and its value is set to its descendants.
+            if up.added:
+                self.cluster_meta.set_from_descendants(
+                    up.descendants, largest_old_cluster=up.largest_old_cluster)
+            emit('cluster', self, up)
+
+        @connect(sender=self.cluster_meta)  # noqa
+        def on_cluster(sender, up):
+            emit('cluster', self, up)
+
+        connect(self._save_new_cluster_id, event='cluster', sender=self)
+
+    # Internal methods
+    # -------------------------------------------------------------------------
+
+    def _register_action(self, controller, up=None):
+        """Add an action to the global history, unless it is part of a batch."""
+        if not self._in_batch:
+            self._global_history.action(controller)
+        elif up is not None and up.added:
+            # NOTE: the clustering does not emit events during a batch, so we update the
+            # cluster meta of the new clusters here, as in on_cluster.
+            self.cluster_meta.set_from_descendants(
+                up.descendants, largest_old_cluster=up.largest_old_cluster)
+
+    def _set_history_max_memory(self, max_memory):
+        """Share the memory budget between the clustering and cluster metadata undo stacks."""
+        # NOTE: the cluster metadata changes are generally much smaller than the clustering
+        # changes.
+        history_dir = self.context.cache_dir / 'history' if self.context else None
+        for obj, name, fraction in (
+                (self.clustering, 'clustering', .9), (self.cluster_meta, 'cluster_meta', .1)):
+            path = history_dir / (name + '.bin') if history_dir else None
+            obj.set_history_max_memory(int(fraction * max_memory), path=path)
+
+    def _journal_action(self, sender, up):
+        """Append a clustering or cluster metadata change to the action journal."""
+        journal = self._journal
+        if journal is None:
+            return
+        if up.description == 'merge':
+            journal.append_merge(up.deleted, up.added[0])
+        elif up.description == 'assign':
+            journal.append_assign(up.spike_ids, up.spike_clusters)
+        elif up.history:
+            # NOTE: undoing a metadata change may restore several older values, so we record
+            # the current values of the affected clusters.
+            if up.description == 'metadata':
+                fields = sorted(set(field for field, _, _ in up.metadata_changes))
+            else:
+                fields = [up.description.replace('metadata_', '')]
+            for field in fields:
+                groups = {}
+                for cluster_id in up.metadata_changed:
+                    value = self.cluster_meta.get(field, cluster_id)
+                    groups.setdefault(value, []).append(cluster_id)
+                for value, cluster_ids in groups.items():
+                    journal.append_metadata(field, cluster_ids, value)
+        elif up.description == 'metadata':
+            for field, cluster_ids, value in up.metadata_changes:
+                journal.append_metadata(field, cluster_ids, value)
+        elif up.description.startswith('metadata_'):
+            journal.append_metadata(
+                up.description.replace('metadata_', ''), up.metadata_changed, up.metadata_value)
+
+    def _replay_journal(self, journal):
+        """Replay the actions recorded in a journal, and return the number of actions."""
+        records = journal.recover()
+        offset = None
+        for i, (kind, data, end) in enumerate(records):
+            try:
+                if kind == ASSIGN:
+                    spike_ids, spike_clusters = data
+                    up = self.clustering.apply(spike_ids, spike_clusters)
+                    self._register_action(self.clustering, up)
+                elif kind == MERGE:
+                    cluster_ids, to = data
+                    spike_ids = self.clustering.spikes_in_clusters(cluster_ids)
+                    up = self.clustering.apply(spike_ids, [to])
+                    self._register_action(self.clustering, up)
+                elif kind == METADATA:
+                    field, cluster_ids, value = data
+                    self.label(field, value, cluster_ids=cluster_ids)
+            except Exception as e:
+                # Discard the records that cannot be replayed.
+                logger.warning("Unable to replay the action journal: %s.", e)
+                if offset:
+                    journal.truncate(offset)
+                else:
+                    journal.clear()
+                return i
+            offset = end
+        return len(records)
+
+    def _save_spikes_per_cluster(self):
+        """Cache on the disk the index with the spikes belonging to each cluster, if it has
+        changed since it was loaded."""
+        spc = self.clustering.spikes_per_cluster
+        if not self.context or not spc.is_dirty:
+            return
+        self.context.save('spikes_per_cluster', spc.to_arrays(), kind='npy')
+        spc.is_dirty = False
+
+    def _log_action(self, sender, up):
+        """Log the clustering action (merge, split)."""
+        if sender != self.clustering:
+            return
+        if up.history:
+            logger.info(up.history.title() + " cluster assign.")
+        elif up.description == 'merge':
+            logger.info("Merge clusters %s to %s.", ', '.join(map(str, up.deleted)), up.added[0])
+        else:
+            logger.info("Assigned %s spikes.", len(up.spike_ids))
+
+    def _log_action_meta(self, sender, up):
+        """Log the cluster meta action (move, label)."""
+        if sender != self.cluster_meta:
+            return
+        if up.history:
+            logger.info(up.history.title() + " move.")
+        else:
+            logger.info(
+                "Change %s for clusters %s to %s.", up.description,
+                ', '.join(map(str, up.metadata_changed)), up.metadata_value)
+
+        # Skip cluster metadata other than groups.
+        if up.description != 'metadata_group':
+            return
+
+    def _save_new_cluster_id(self, sender, up):
+        """Save the new cluster id on disk, knowing that cluster ids are unique for
+        easier cache consistency."""
+        new_cluster_id = self.clustering.new_cluster_id()
+        if self.context:
+            logger.log(5, "Save the new cluster id: %d.", new_cluster_id)
+            self.context.save('new_cluster_id', dict(new_cluster_id=new_cluster_id))
+
+    def _get_clusters_info(self, cluster_ids, exclude=()):
+        """Return the data associated to a list of clusters."""
+        cluster_ids = [int(c) for c in cluster_ids]
+        # The metadata values of all clusters are retrieved field by field.
+        # NOTE: this includes group.
+        meta = {key: self.cluster_meta.get(key, cluster_ids) for key in self.cluster_meta.fields}
+        # The metrics are also computed column by column.
+        metrics = {
+            key: _metric_values(func, cluster_ids) for key, func in self.cluster_metrics.items()}
+        out = []
+        for i, cluster_id in enumerate(cluster_ids):
+            info = {'id': cluster_id}
+            for key, values in metrics.items():
+                info[key] = values[i]
+            for key, values in meta.items():
+                info[key] = values[i]
+            info['is_masked'] = _is_group_masked(info.get('group', None))
+            out.append({k: v for k, v in info.items() if k not in exclude})
+        return out
+
+    def _get_cluster_info(self, cluster_id, exclude=()):
+        """Return the data associated to a given cluster."""
+        return self._get_clusters_info([cluster_id], exclude=exclude)[0]
+
+    # Public methods
+    # -------------------------------------------------------------------------
+
+    @property
+    def cluster_ids(self):
+        """Sorted array of all non-empty cluster ids."""
+        return self.clustering.cluster_ids
+
+    @property
+    def cluster_info(self):
+        """The cluster view table as a list of per-cluster dictionaries."""
+        return self._get_clusters_info(self.clustering.cluster_ids)
+
+    def get_metric(self, name, cluster_ids=None):
+        """Return the values of a cluster metric, as a dictionary `{cluster_id: value}`, for
+        the specified clusters or for all clusters."""
+        cluster_ids = self.clustering.cluster_ids if cluster_ids is None else cluster_ids
+        cluster_ids = [int(c) for c in cluster_ids]
+        return dict(zip(cluster_ids, _metric_values(self.cluster_metrics[name], cluster_ids)))
+
+    @batch_metric
+    def n_spikes(self, cluster_ids):
+        """Number of spikes in the given clusters."""
+        return self.clustering.spikes_per_cluster.counts(cluster_ids)
+
+    # Clustering actions
+    # -------------------------------------------------------------------------
+
+    def merge(self, cluster_ids, to=None):
+        """Merge some clusters."""
+        if len(cluster_ids or []) <= 1:
+            return
+        out = self.clustering.merge(cluster_ids, to=to)
+        self._register_action(self.clustering, out)
+        return out
+
+    def split(self, spike_ids, spike_clusters_rel=0):
+        """Make a new cluster out of the specified spikes."""
+        if len(spike_ids) == 0:
+            logger.warning(
+                """No spikes selected, cannot split.""")
+            return
+        out = self.clustering.split(
+            spike_ids, spike_clusters_rel=spike_clusters_rel)
+        self._register_action(self.clustering, out)
+        return out
+
+    # Move actions
+    # -------------------------------------------------------------------------
+
+    @property
+    def fields(self):
+        """List of all cluster label names."""
+        return tuple(f for f in self.cluster_meta.fields if f not in ('group',))
+
+    def get_labels(self, field):
+        """Return the labels of all clusters, for a given label name."""
+        cluster_ids = self.clustering.cluster_ids
+        return dict(zip(cluster_ids.tolist(), self.cluster_meta.get(field, cluster_ids)))
+
+    def label(self, name, value, cluster_ids):
+        """Assign a label to some clusters."""
+        if not hasattr(cluster_ids, '__len__'):
+            cluster_ids = [cluster_ids]
+        if len(cluster_ids) == 0:
+            return
+        self.cluster_meta.set(name, cluster_ids, value)
+        self._register_action(self.cluster_meta)
+
+    def move(self, group, cluster_ids):
+        """Assign a cluster group to some clusters."""
+        if not hasattr(cluster_ids, '__len__'):
+            cluster_ids = [cluster_ids]
+        cluster_ids = list(cluster_ids)
+        if not cluster_ids:
+            return
+        _ensure_all_ints(cluster_ids)
+        logger.debug("Move %s to %s.", cluster_ids, group)
+        group = 'unsorted' if group is None else group
+        self.label('group', group, cluster_ids=cluster_ids)
+
+    # Other actions
+    # -------------------------------------------------------------------------
+
+    def attach_journal(self, path):
+        """Record all subsequent actions in an append-only journal file.
+
+        The actions already recorded in the journal, that is, the changes that were not saved
+        in a previous session, are replayed first.
+
+        """
+        journal = ActionJournal(path, n_spikes=self.clustering.n_spikes)
+        n = self._replay_journal(journal)
+        if n:
+            logger.info("Replayed %d unsaved actions from %s.", n, path)
+        self._journal = journal
+        connect(self._journal_action, event='cluster', sender=self)
+
+    def clear_journal(self):
+        """Discard the actions recorded in the action journal, so that they are not replayed
+        in the next session. This is called when the changes are saved or discarded."""
+        if self._journal:
+            self._journal.clear()
+
+    @contextmanager
+    def batch(self):
+        """Context manager grouping several clustering and metadata actions into a single action.
+
+        All merges, splits, and label changes done within the context manager are applied
+        immediately, but the `cluster` events are only emitted once at the end, and the whole
+        batch is a single step in the undo stack.
+
+        Example
+        -------
+
+        ```python
+        with session.batch():
+            for cluster_ids in pairs:
+                session.merge(cluster_ids)
+            session.move('good', good_clusters)
+        ```
+
+        """
+        if self._in_batch:
+            yield
+            return
+        self._in_batch = True
+        try:
+            # NOTE: the clustering batch ends first, so that the views know about the new
+            # clusters before their metadata changes.
+            with self.cluster_meta.batch() as up_meta:
+                with self.clustering.batch() as up_clustering:
+                    yield
+        finally:
+            self._in_batch = False
+            controllers = [
+                controller for controller, up in (
+                    (self.clustering, up_clustering), (self.cluster_meta, up_meta))
+                if up.description]
+            if controllers:
+                self._global_history.action(*controllers)
+
+    def is_dirty(self):
+        """Return whether there are any pending changes."""
+        return self._is_dirty if self._is_dirty in (False, True) else len(self._global_history) > 1
+
+    def undo(self):
+        """Undo the last action."""
+        self._global_history.undo()
+
+    def redo(self):
+        """Undo the last undone action."""
+        self._global_history.redo()
+
+    def save(self):
+        """Save the manual clustering back to disk.
+
+        This method emits the `save_clustering(spike_clusters, groups, *labels)` event.
+        It is up to the caller to react to this event and save the data to disk.
+
+        """
+        spike_clusters = self.clustering.spike_clusters
+        groups = {
+            c: self.cluster_meta.get('group', c) or 'unsorted'
+            for c in self.clustering.cluster_ids}
+        # List of tuples (field_name, dictionary).
+        labels = [
+            (field, self.get_labels(field)) for field in self.cluster_meta.fields
+            if field not in ('next_cluster')]
+        emit('save_clustering', self, spike_clusters, groups, *labels)
+        # All changes are saved, the action journal can be cleared.
+        self.clear_journal()
+        # Cache the spikes_per_cluster index.
+        self._save_spikes_per_cluster()
+        self._is_dirty = False
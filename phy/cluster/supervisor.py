@@ -13,45 +13,16 @@ import logging
 
 import numpy as np
 
-from ._history import GlobalHistory
-from ._utils import create_cluster_meta
-from .clustering import Clustering
+from .session import CurationSession, _is_group_masked
 
 from phylib.utils import Bunch, emit, connect, unconnect
 from phy.gui.actions import Actions
 from phy.gui.qt import _block, set_busy, _wait
-from phy.gui.widgets import Table, HTMLWidget, _uniq, Barrier
+from phy.gui.widgets import Table, NativeTable, HTMLWidget, _TableRows, _uniq, Barrier
 
 logger = logging.getLogger(__name__)
 
 
-# ----------------------------------------------------------------------------
-# Utility functions
-# -----------------------------------------------------------------------------
-
-def _process_ups(ups):  # pragma: no cover
-    """This function processes the UpdateInfo instances of the two
-    undo stacks (clustering and cluster metadata) and concatenates them
-    into a single UpdateInfo instance."""
-    if len(ups) == 0:
-        return
-    elif len(ups) == 1:
-        return ups[0]
-    elif len(ups) == 2:
-        up = ups[0]
-        up.update(ups[1])
-        return up
-    else:
-        raise NotImplementedError()
-
-
-def _ensure_all_ints(l):
-    if (l is None or l == []):
-        return
-    for i in range(len(l)):
-        l[i] = int(l[i])
-
-
 # -----------------------------------------------------------------------------
 # Tasks
 # -----------------------------------------------------------------------------
@@ -271,33 +242,12 @@ table tr[data-group='noise'] {
 '''
 
 
-class ClusterView(Table):
-    """Display a table of all clusters with metrics and labels as columns. Derive from Table.
-
-    Constructor
-    -----------
-
-    parent : Qt widget
-    data : list
-        List of dictionaries mapping fields to values.
-    columns : list
-        List of columns in the table.
-    sort : 2-tuple
-        Initial sort of the table as a pair (column_name, order), where order is
-        either `asc` or `desc`.
-
-    """
+class _ClusterViewMixin(object):
+    """Cluster view methods that are common to all table backends."""
 
     _required_columns = ('n_spikes',)
     _view_name = 'cluster_view'
-    _styles = _CLUSTER_VIEW_STYLES
-
-    def __init__(self, *args, data=None, columns=(), sort=None):
-        # NOTE: debounce select events.
-        HTMLWidget.__init__(
-            self, *args, title=self.__class__.__name__, debounce_events=('select',))
-        self._set_styles()
-        self._reset_table(data=data, columns=columns, sort=sort)
+    _default_sort = ('n_spikes', 'desc')
 
     def _reset_table(self, data=None, columns=(), sort=None):
         """Recreate the table with specified columns, data, and sort."""
@@ -316,12 +266,9 @@ class ClusterView(Table):
         # Allow to have <tr data_group="good"> etc. which allows for CSS styling.
         value_names = columns + [{'data': ['group']}]
         # Default sort.
-        sort = sort or ('n_spikes', 'desc')
+        sort = sort or self._default_sort
         self._init_table(columns=columns, value_names=value_names, data=data, sort=sort)
 
-    def _set_styles(self):
-        self.builder.add_style(self._styles)
-
     @property
     def state(self):
         """Return the cluster view state, with the current sort and selection."""
@@ -349,7 +296,57 @@ class ClusterView(Table):
             self.select(selected)
 
 
-class SimilarityView(ClusterView):
+class _SimilarityViewMixin(object):
+    """Similarity view methods that are common to all table backends."""
+
+    _required_columns = ('n_spikes', 'similarity')
+    _view_name = 'similarity_view'
+
+    def reset(self, cluster_ids):
+        """Recreate the similarity view, given the selected clusters in the cluster view."""
+        if not len(cluster_ids):
+            return
+        similar = emit('request_similar_clusters', self, cluster_ids[-1])
+        # Clear the table.
+        if similar:
+            self.remove_all_and_add(
+                [cl for cl in similar[0] if cl['id'] not in cluster_ids])
+        else:  # pragma: no cover
+            self.remove_all()
+        return similar
+
+
+class ClusterView(_ClusterViewMixin, Table):
+    """Display a table of all clusters with metrics and labels as columns. Derive from Table.
+
+    Constructor
+    -----------
+
+    parent : Qt widget
+    data : list
+        List of dictionaries mapping fields to values.
+    columns : list
+        List of columns in the table.
+    sort : 2-tuple
+        Initial sort of the table as a pair (column_name, order), where order is
+        either `asc` or `desc`.
+
+    """
+
+    _styles = _CLUSTER_VIEW_STYLES
+
+    def __init__(self, *args, data=None, columns=(), sort=None):
+        # NOTE: debounce select events.
+        HTMLWidget.__init__(
+            self, *args, title=self.__class__.__name__, debounce_events=('select',))
+        self._set_styles()
+        self._reset_table(data=data, columns=columns, sort=sort)
+
+    def _set_styles(self):
+        self.builder.add_style(self._styles)
+
+
+class SimilarityView(_SimilarityViewMixin, ClusterView):
     """Display a table of clusters with metrics and labels as columns, and an additional
     similarity column.
 
@@ -363,26 +360,45 @@ class SimilarityView(ClusterView):
 
     """
 
-    _required_columns = ('n_spikes', 'similarity')
-    _view_name = 'similarity_view'
-
     def set_selected_index_offset(self, n):
         """Set the index of the selected cluster, used for correct coloring in the similarity
         view."""
         self.eval_js('table._setSelectedIndexOffset(%d);' % n)
 
-    def reset(self, cluster_ids):
-        """Recreate the similarity view, given the selected clusters in the cluster view."""
-        if not len(cluster_ids):
-            return
-        similar = emit('request_similar_clusters', self, cluster_ids[-1])
-        # Clear the table.
-        if similar:
-            self.remove_all_and_add(
-                [cl for cl in similar[0] if cl['id'] not in cluster_ids])
-        else:  # pragma: no cover
-            self.remove_all()
-        return similar
+
+class NativeClusterView(_ClusterViewMixin, NativeTable):
+    """Cluster view using a native Qt table instead of an HTML table. Derive from NativeTable.
+
+    It has the same constructor, events, and methods as `ClusterView`.
+
+    """
+
+    _group_colors = {
+        'good': '#86D16D',
+        'mua': '#afafaf',
+        'noise': '#777',
+    }
+
+    def __init__(self, *args, data=None, columns=(), sort=None):
+        # NOTE: debounce select events.
+        NativeTable.__init__(
+            self, *args, title=self.__class__.__name__, debounce_events=('select',))
+        self._reset_table(data=data, columns=columns, sort=sort)
+
+
+class NativeSimilarityView(_SimilarityViewMixin, NativeClusterView):
+    """Similarity view using a native Qt table instead of an HTML table.
+
+    It has the same constructor, events, and methods as `SimilarityView`.
+
+    """
+
+
+# Classes of the cluster view and similarity view for every table backend.
+_TABLE_BACKENDS = {
+    'html': (ClusterView, SimilarityView),
+    'native': (NativeClusterView, NativeSimilarityView),
+}
 
 
 # -----------------------------------------------------------------------------
@@ -553,18 +569,15 @@ class ActionCreator(object):
 # Clustering GUI component
 # -----------------------------------------------------------------------------
 
-def _is_group_masked(group):
-    return group in ('noise', 'mua')
-
-
-class Supervisor(object):
-    """Component that brings manual clustering facilities to a GUI:
+class Supervisor(CurationSession):
+    """Component that brings manual clustering facilities to a GUI, on top of the
+    `CurationSession`:
 
     * `Clustering` instance: merge, split, undo, redo.
     * `ClusterMeta` instance: change cluster metadata (e.g. group).
     * Cluster selection.
     * Many manual clustering-related actions, snippets, shortcuts, etc.
-    * Two HTML tables : `ClusterView` and `SimilarityView`.
+    * Two tables : `ClusterView` and `SimilarityView` (or their native Qt counterparts).
 
     Constructor
     -----------
@@ -584,6 +597,14 @@ class Supervisor(object):
         Initial sort as a pair `(column_name, order)` where `order` is either `asc` or `desc`
     context : Context
         Handles the cache.
+    low_memory : boolean
+        Whether to keep the spike-cluster assignments in low-memory mode.
+    history_max_memory : int
+        Maximum memory size in bytes of the undo stacks, beyond which older actions are
+        spilled to disk.
+    table_backend : str
+        Either `html` (web view tables, the default) or `native` (Qt model/view tables) for
+        the cluster view and similarity view.
 
     Events
     ------
@@ -592,6 +613,8 @@ class Supervisor(object):
 
     * `select(cluster_ids)`
         When clusters are selected in the cluster view or similarity view.
+    * `upcoming(cluster_ids)`
+        After a selection, with the clusters that are likely to be selected next by the wizard.
     * `cluster(up)`
         When a clustering action occurs, changing the spike clusters assignment of the cluster
         metadata.
@@ -606,22 +629,25 @@ class Supervisor(object):
 
     def __init__(
             self, spike_clusters=None, cluster_groups=None, cluster_metrics=None,
-            cluster_labels=None, similarity=None, new_cluster_id=None, sort=None, context=None):
-        super(Supervisor, self).__init__()
-        self.context = context
+            cluster_labels=None, similarity=None, new_cluster_id=None, sort=None, context=None,
+            low_memory=False, history_max_memory=None, table_backend=None):
+        super(Supervisor, self).__init__(
+            spike_clusters=spike_clusters, cluster_groups=cluster_groups,
+            cluster_metrics=cluster_metrics, cluster_labels=cluster_labels,
+            new_cluster_id=new_cluster_id, context=context, low_memory=low_memory,
+            history_max_memory=history_max_memory)
         self.similarity = similarity  # function cluster => [(cl, sim), ...]
         self.actions = None  # will be set when attaching the GUI
-        self._is_dirty = None
+        self.cluster_view = self.similarity_view = None  # will be set when attaching the GUI
+        # Python mirror of the cluster view table, with the same rows, sort, and filter, so that
+        # the ordered cluster ids are known without waiting for the view.
+        self._cluster_table = None
         self._sort = sort  # Initial sort requested in the constructor
-
-        # Cluster metrics.
-        # This is a dict {name: func cluster_id => value}.
-        self.cluster_metrics = cluster_metrics or {}
-        self.cluster_metrics['n_spikes'] = self.n_spikes
-
-        # Cluster labels.
-        # This is a dict {name: {cl: value}}
-        self.cluster_labels = cluster_labels or {}
+        table_backend = table_backend or 'html'
+        if table_backend not in _TABLE_BACKENDS:
+            raise ValueError(
+                "The table backend should be one of %s." % ', '.join(sorted(_TABLE_BACKENDS)))
+        self._cluster_view_class, self._similarity_view_class = _TABLE_BACKENDS[table_backend]
 
         self.columns = ['id']  # n_spikes comes from cluster_metrics
         self.columns += list(self.cluster_metrics.keys())
@@ -629,98 +655,15 @@ class Supervisor(object):
             label for label in self.cluster_labels.keys()
             if label not in self.columns + ['group']]
 
-        # Create Clustering and ClusterMeta.
-        # Load the cached spikes_per_cluster array.
-        spc = context.load('spikes_per_cluster') if context else None
-        self.clustering = Clustering(
-            spike_clusters, spikes_per_cluster=spc, new_cluster_id=new_cluster_id)
-
-        # Cache the spikes_per_cluster array.
-        self._save_spikes_per_cluster()
-
-        # Create the ClusterMeta instance.
-        self.cluster_meta = create_cluster_meta(cluster_groups or {})
-        # Add the labels.
-        for label, values in self.cluster_labels.items():
-            if label == 'group':
-                continue
-            self.cluster_meta.add_field(label)
-            for cl, v in values.items():
-                self.cluster_meta.set(label, [cl], v, add_to_stack=False)
-
-        # Create the GlobalHistory instance.
-        self._global_history = GlobalHistory(process_ups=_process_ups)
-
         # Create The Action Creator instance.
         self.action_creator = ActionCreator(self)
         connect(self._on_action, event='action', sender=self.action_creator)
 
-        # Log the actions.
-        connect(self._log_action, event='cluster', sender=self.clustering)
-        connect(self._log_action_meta, event='cluster', sender=self.cluster_meta)
-
-        # Raise supervisor.cluster
-        @connect(sender=self.clustering)
-        def on_cluster(sender, up):
-            # NOTE: update the cluster meta of new clusters, depending on the values of the
-            # ancestor clusters. In case of a conflict between the values of the old clusters,
-            # the largest cluster wins and its value is set to its descendants.
-            if up.added:
-                self.cluster_meta.set_from_descendants(
-                    up.descendants, largest_old_cluster=up.largest_old_cluster)
-            emit('cluster', self, up)
-
-        @connect(sender=self.cluster_meta)  # noqa
-        def on_cluster(sender, up):
-            emit('cluster', self, up)
-
-        connect(self._save_new_cluster_id, event='cluster', sender=self)
-
         self._is_busy = False
 
     # Internal methods
     # -------------------------------------------------------------------------
 
-    def _save_spikes_per_cluster(self):
-        """Cache on the disk the dictionary with the spikes belonging to each cluster."""
-        if not self.context:
-            return
-        self.context.save('spikes_per_cluster', self.clustering.spikes_per_cluster, kind='pickle')
-
-    def _log_action(self, sender, up):
-        """Log the clustering action (merge, split)."""
-        if sender != self.clustering:
-            return
-        if up.history:
-            logger.info(up.history.title() + " cluster assign.")
-        elif up.description == 'merge':
-            logger.info("Merge clusters %s to %s.", ', '.join(map(str, up.deleted)), up.added[0])
-        else:
-            logger.info("Assigned %s spikes.", len(up.spike_ids))
-
-    def _log_action_meta(self, sender, up):
-        """Log the cluster meta action (move, label)."""
-        if sender != self.cluster_meta:
-            return
-        if up.history:
-            logger.info(up.history.title() + " move.")
-        else:
-            logger.info(
-                "Change %s for clusters %s to %s.", up.description,
-                ', '.join(map(str, up.metadata_changed)), up.metadata_value)
-
-        # Skip cluster metadata other than groups.
-        if up.description != 'metadata_group':
-            return
-
-    def _save_new_cluster_id(self, sender, up):
-        """Save the new cluster id on disk, knowing that cluster ids are unique for
-        easier cache consistency."""
-        new_cluster_id = self.clustering.new_cluster_id()
-        if self.context:
-            logger.log(5, "Save the new cluster id: %d.", new_cluster_id)
-            self.context.save('new_cluster_id', dict(new_cluster_id=new_cluster_id))
-
     def _save_gui_state(self, gui):
         """Save the GUI state with the cluster view and similarity view."""
         gui.state.update_view_state(self.cluster_view, self.cluster_view.state)
@@ -735,30 +678,24 @@ class Supervisor(object):
             for c, s in sim if c in clusters_set]
         return data
 
-    def _get_cluster_info(self, cluster_id, exclude=()):
-        """Return the data associated to a given cluster."""
-        out = {'id': cluster_id}
-        for key, func in self.cluster_metrics.items():
-            out[key] = func(cluster_id)
-        for key in self.cluster_meta.fields:
-            # includes group
-            out[key] = self.cluster_meta.get(key, cluster_id)
-        out['is_masked'] = _is_group_masked(out.get('group', None))
-        return {k: v for k, v in out.items() if k not in exclude}
-
     def _create_views(self, gui=None, sort=None):
         """Create the cluster view and similarity view."""
 
         sort = sort or self._sort  # comes from either the GUI state or constructor
 
         # Create the cluster view.
-        self.cluster_view = ClusterView(
-            gui, data=self.cluster_info, columns=self.columns, sort=sort)
+        data = self.cluster_info
+        self.cluster_view = self._cluster_view_class(
+            gui, data=data, columns=self.columns, sort=sort)
+        self._reset_cluster_table(data, sort)
         # Update the action flow and similarity view when selection changes.
         connect(self._clusters_selected, event='select', sender=self.cluster_view)
+        # Keep the Python mirror up-to-date when the user sorts or filters the cluster view.
+        connect(self._on_table_sort, event='table_sort', sender=self.cluster_view)
+        connect(self._on_table_filter, event='table_filter', sender=self.cluster_view)
 
         # Create the similarity view.
-        self.similarity_view = SimilarityView(
+        self.similarity_view = self._similarity_view_class(
             gui, columns=self.columns + ['similarity'], sort=('similarity', 'desc'))
         connect(
             self._get_similar_clusters, event='request_similar_clusters',
@@ -771,21 +708,42 @@ class Supervisor(object):
     def _reset_cluster_view(self):
         """Recreate the cluster view."""
         logger.debug("Reset the cluster view.")
-        self.cluster_view._reset_table(
-            data=self.cluster_info, columns=self.columns, sort=self._sort)
+        data = self.cluster_info
+        self.cluster_view._reset_table(data=data, columns=self.columns, sort=self._sort)
+        self._reset_cluster_table(data, self._sort)
+
+    def _reset_cluster_table(self, data, sort=None):
+        """Recreate the Python mirror of the cluster view table."""
+        self._cluster_table = _TableRows(self.cluster_view.columns)
+        self._cluster_table.add(data)
+        self._cluster_table.set_sort(*(sort or self.cluster_view._default_sort))
+        self._cluster_table.set_order()
+
+    def _on_table_sort(self, sender, cluster_ids):
+        """Mirror the order of the cluster view after a sort, from the displayed ids."""
+        self._cluster_table.set_displayed(cluster_ids)
+        self._cluster_table.infer_sort()
+
+    def _on_table_filter(self, sender, cluster_ids):
+        """Mirror the displayed clusters of the cluster view after a filter."""
+        self._cluster_table.set_displayed(cluster_ids, filtered=True)
 
     def _clusters_added(self, cluster_ids):
         """Update the cluster and similarity views when new clusters are created."""
         logger.log(5, "Clusters added: %s", cluster_ids)
-        data = [self._get_cluster_info(cluster_id) for cluster_id in cluster_ids]
+        data = self._get_clusters_info(cluster_ids)
         self.cluster_view.add(data)
         self.similarity_view.add(data)
+        self._cluster_table.add(data)
+        self._cluster_table.set_order()
 
     def _clusters_removed(self, cluster_ids):
         """Update the cluster and similarity views when clusters are removed."""
         logger.log(5, "Clusters removed: %s", cluster_ids)
         self.cluster_view.remove(cluster_ids)
         self.similarity_view.remove(cluster_ids)
+        self._cluster_table.remove(cluster_ids)
+        self._cluster_table.set_order()
 
     def _cluster_metadata_changed(self, field, cluster_ids, value):
         """Update the cluster and similarity views when clusters metadata is updated."""
@@ -795,6 +753,8 @@ class Supervisor(object):
             _['is_masked'] = _is_group_masked(_.get('group', None))
         self.cluster_view.change(data)
         self.similarity_view.change(data)
+        self._cluster_table.change(data)
+        self._cluster_table.set_order()
 
     def _clusters_selected(self, sender, obj, **kwargs):
         """When clusters are selected in the cluster view, register the action in the history
@@ -818,6 +778,7 @@ class Supervisor(object):
         if cluster_ids:
             self.cluster_view.scroll_to(cluster_ids[-1])
         self.cluster_view.dock.set_status('clusters: %s' % ', '.join(map(str, cluster_ids)))
+        emit('upcoming', self, self.upcoming_clusters)
 
     def _similar_selected(self, sender, obj):
         """When clusters are selected in the similarity view, register the action in the history
@@ -833,6 +794,7 @@ class Supervisor(object):
         if similar:
             self.similarity_view.scroll_to(similar[-1])
         self.similarity_view.dock.set_status('similar clusters: %s' % ', '.join(map(str, similar)))
+        emit('upcoming', self, self.upcoming_clusters)
 
     def _on_action(self, sender, name, *args):
         """Called when an action is triggered: enqueue and process the task."""
@@ -853,8 +815,13 @@ class Supervisor(object):
         # Update the views with the old and new clusters.
         self._clusters_added(up.added)
         self._clusters_removed(up.deleted)
-        self._cluster_metadata_changed(
-            up.description.replace('metadata_', ''), up.metadata_changed, up.metadata_value)
+        if up.description == 'metadata':
+            # Batch of metadata changes with several fields or values.
+            for field, cluster_ids, value in up.metadata_changes:
+                self._cluster_metadata_changed(field, cluster_ids, value)
+        else:
+            self._cluster_metadata_changed(
+                up.description.replace('metadata_', ''), up.metadata_changed, up.metadata_value)
         # After the action has finished, we process the pending actions,
         # like selection of new clusters in the tables.
         self.task_logger.process()
@@ -895,29 +862,32 @@ class Supervisor(object):
     def sort(self, column, sort_dir='desc'):
         """Sort the cluster view by a given column, in a given order (asc or desc)."""
         self.cluster_view.sort_by(column, sort_dir=sort_dir)
+        self._cluster_table.set_sort(column, sort_dir)
+        self._cluster_table.set_order()
 
     def filter(self, text):
         """Filter the clusters using a Javascript expression on the column names."""
         self.cluster_view.filter(text)
+        self._cluster_table.set_filter(text)
+        self._cluster_table.set_order()
 
     def clear_filter(self):
-        self.cluster_view.filter('')
+        self.filter('')
 
     # Properties
     # -------------------------------------------------------------------------
 
-    @property
-    def cluster_info(self):
-        """The cluster view table as a list of per-cluster dictionaries."""
-        return [self._get_cluster_info(cluster_id) for cluster_id in self.clustering.cluster_ids]
-
     @property
     def all_cluster_ids(self):
-        """The sorted list of cluster ids as they are currently shown in the cluster view."""
-        b = Barrier()
-        self.cluster_view.get_ids(callback=b(1))
-        b.wait()
-        return b.result(1)[0][0]
+        """The sorted list of cluster ids as they are currently shown in the cluster view.
+
+        This list is computed from a Python mirror of the cluster view rows, sort, and filter,
+        so that it does not wait for the view.
+
+        """
+        if self._cluster_table is None:
+            return self.clustering.cluster_ids.tolist()
+        return self._cluster_table.displayed_ids()
 
     @property
     def state(self):
@@ -931,11 +901,11 @@ class Supervisor(object):
 
         # Make sure the selected field in cluster and similarity views are saved in the local
         # supervisor state, as this information is dataset-dependent.
-        gui.state.add_local_keys(['ClusterView.selected'])
+        name = self._cluster_view_class.__name__
+        gui.state.add_local_keys(['%s.selected' % name])
 
         # Create the cluster view and similarity view.
-        self._create_views(
-            gui=gui, sort=gui.state.get('ClusterView', {}).get('current_sort', None))
+        self._create_views(gui=gui, sort=gui.state.get(name, {}).get('current_sort', None))
 
         # Create the TaskLogger.
         self.task_logger = TaskLogger(
@@ -977,7 +947,7 @@ class Supervisor(object):
         @connect(sender=self.cluster_view)
         def on_ready(sender):
             """Select the clusters from the cluster view state."""
-            selected = gui.state.get('ClusterView', {}).get('selected', [])
+            selected = gui.state.get(name, {}).get('selected', [])
             if selected:  # pragma: no cover
                 self.cluster_view.select(selected)
 
@@ -998,9 +968,15 @@ class Supervisor(object):
         """Selected clusters in the cluster and similarity views."""
         return _uniq(self.selected_clusters + self.selected_similar)
 
-    def n_spikes(self, cluster_id):
-        """Number of spikes in a given cluster."""
-        return len(self.clustering.spikes_per_cluster.get(cluster_id, []))
+    @property
+    def upcoming_clusters(self):
+        """Clusters that are likely to be selected next by the wizard: the next cluster in the
+        similarity view, and the next cluster in the cluster view."""
+        state = self.task_logger.last_state()
+        if not state:
+            return []
+        _, next_cluster, _, next_similar = state
+        return _uniq([c for c in (next_similar, next_cluster) if c is not None])
 
     # Clustering actions
     # -------------------------------------------------------------------------
@@ -1009,11 +985,7 @@ class Supervisor(object):
         """Merge the selected clusters."""
         if cluster_ids is None:
             cluster_ids = self.selected
-        if len(cluster_ids or []) <= 1:
-            return
-        out = self.clustering.merge(cluster_ids, to=to)
-        self._global_history.action(self.clustering)
-        return out
+        return super(Supervisor, self).merge(cluster_ids, to=to)
 
     def split(self, spike_ids=None, spike_clusters_rel=0):
         """Make a new cluster out of the specified spikes."""
@@ -1023,28 +995,11 @@ class Supervisor(object):
             spike_ids = np.concatenate(spike_ids).astype(np.int64)
             assert spike_ids.dtype == np.int64
             assert spike_ids.ndim == 1
-        if len(spike_ids) == 0:
-            logger.warning(
-                """No spikes selected, cannot split.""")
-            return
-        out = self.clustering.split(
-            spike_ids, spike_clusters_rel=spike_clusters_rel)
-        self._global_history.action(self.clustering)
-        return out
+        return super(Supervisor, self).split(spike_ids, spike_clusters_rel=spike_clusters_rel)
 
     # Move actions
     # -------------------------------------------------------------------------
 
-    @property
-    def fields(self):
-        """List of all cluster label names."""
-        return tuple(f for f in self.cluster_meta.fields if f not in ('group',))
-
-    def get_labels(self, field):
-        """Return the labels of all clusters, for a given label name."""
-        return {c: self.cluster_meta.get(field, c)
-                for c in self.clustering.cluster_ids}
-
     def label(self, name, value, cluster_ids=None):
         """Assign a label to some clusters."""
         if cluster_ids is None:
@@ -1053,13 +1008,13 @@ class Supervisor(object):
             cluster_ids = [cluster_ids]
         if len(cluster_ids) == 0:
             return
-        self.cluster_meta.set(name, cluster_ids, value)
-        self._global_history.action(self.cluster_meta)
+        super(Supervisor, self).label(name, value, cluster_ids)
         # Add column if needed.
         if name != 'group' and name not in self.columns:
             logger.debug("Add column %s.", name)
             self.columns.append(name)
-            self._reset_cluster_view()
+            if self.cluster_view is not None:
+                self._reset_cluster_view()
 
     def move(self, group, which):
         """Assign a cluster group to some clusters."""
@@ -1069,14 +1024,7 @@ class Supervisor(object):
             which = self.selected_clusters
         elif which == 'similar':
             which = self.selected_similar
-        if isinstance(which, int):
-            which = [which]
-        if not which:
-            return
-        _ensure_all_ints(which)
-        logger.debug("Move %s to %s.", which, group)
-        group = 'unsorted' if group is None else group
-        self.label('group', group, cluster_ids=which)
+        super(Supervisor, self).move(group, which)
 
     # Wizard actions
     # -------------------------------------------------------------------------
@@ -1123,38 +1071,6 @@ class Supervisor(object):
     # Other actions
     # -------------------------------------------------------------------------
 
-    def is_dirty(self):
-        """Return whether there are any pending changes."""
-        return self._is_dirty if self._is_dirty in (False, True) else len(self._global_history) > 1
-
-    def undo(self):
-        """Undo the last action."""
-        self._global_history.undo()
-
-    def redo(self):
-        """Undo the last undone action."""
-        self._global_history.redo()
-
-    def save(self):
-        """Save the manual clustering back to disk.
-
-        This method emits the `save_clustering(spike_clusters, groups, *labels)` event.
-        It is up to the caller to react to this event and save the data to disk.
-
-        """
-        spike_clusters = self.clustering.spike_clusters
-        groups = {
-            c: self.cluster_meta.get('group', c) or 'unsorted'
-            for c in self.clustering.cluster_ids}
-        # List of tuples (field_name, dictionary).
-        labels = [
-            (field, self.get_labels(field)) for field in self.cluster_meta.fields
-            if field not in ('next_cluster')]
-        emit('save_clustering', self, spike_clusters, groups, *labels)
-        # Cache the spikes_per_cluster array.
-        self._save_spikes_per_cluster()
-        self._is_dirty = False
-
     def block(self):
         """Block until there are no pending actions.
 
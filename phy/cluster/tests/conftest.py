@@ -10,10 +10,14 @@ from pytest import fixture
 
 from phylib.io.array import get_closest_clusters
 import phy.gui.qt
+from phy.cluster.clustering import Clustering
 
 # Reduce the debouncer delay for tests.
 phy.gui.qt.Debouncer.delay = 1
 
+# Check the incremental cluster structures after every clustering change.
+Clustering.check_consistency = True
+
 
 #------------------------------------------------------------------------------
 # Fixtures
@@ -476,6 +476,7 @@ def test_clustering_long():
     # Merge to a given cluster.
     clustering.spike_clusters[:] = spike_clusters_base[:]
     clustering._new_cluster_id = 11
+    clustering._update_cluster_ids()
 
     my_spikes_0 = np.nonzero(np.in1d(clustering.spike_clusters, [4, 6]))[0]
     info = clustering.merge([4, 6], 11)
@@ -494,3 +495,233 @@ def test_clustering_long():
     clustering.assign(my_spikes, clusters)
     clu = clustering.spike_clusters[my_spikes]
     ae(clu - clu[0], clusters)
+
+
+def test_clustering_undo_delta():
+    n_spikes = 1000
+    n_clusters = 10
+    spike_clusters = artificial_spike_clusters(n_spikes, n_clusters)
+
+    clustering = Clustering(spike_clusters, checkpoint_interval=2)
+
+    checkpoints = [clustering.spike_clusters.copy()]
+    clustering.merge([0, 1])
+    checkpoints.append(clustering.spike_clusters.copy())
+    clustering.split(clustering.spikes_in_clusters([9])[::2])
+    checkpoints.append(clustering.spike_clusters.copy())
+    clustering.merge([2, 3, 4])
+    checkpoints.append(clustering.spike_clusters.copy())
+
+    # Only the second action has a checkpoint.
+    assert list(clustering._checkpoints) == [2]
+
+    # The history can be replayed from the checkpoints.
+    for i, sc in enumerate(checkpoints):
+        ae(clustering._spike_clusters_at(i), sc)
+
+    # The undo does not depend on the original assignment, only on the reverse deltas.
+    clustering._spike_clusters_base = None
+    for i in range(2, -1, -1):
+        up = clustering.undo()
+        assert up.history == 'undo'
+        ae(clustering.spike_clusters, checkpoints[i])
+        ae(clustering.cluster_ids, np.unique(checkpoints[i]))
+    for i in range(1, 4):
+        up = clustering.redo()
+        assert up.history == 'redo'
+        ae(clustering.spike_clusters, checkpoints[i])
+
+    # A new action after an undo discards the checkpoints of the redo items.
+    clustering.undo()
+    clustering.undo()
+    clustering.merge([5, 6])
+    assert list(clustering._checkpoints) == [2]
+    ae(clustering._checkpoints[2], clustering.spike_clusters)
+
+
+def test_clustering_cluster_sizes():
+    spike_clusters = np.array([2, 5, 2, 3, 7, 5, 2])
+    clustering = Clustering(spike_clusters)
+    ae(clustering.cluster_ids, [2, 3, 5, 7])
+    ae(clustering.cluster_sizes, [3, 1, 2, 1])
+
+    clustering.merge([3, 7])
+    ae(clustering.cluster_ids, [2, 5, 8])
+    ae(clustering.cluster_sizes, [3, 2, 2])
+
+    clustering.split([0, 1])
+    ae(clustering.cluster_ids, [8, 9, 10, 11])
+    ae(clustering.cluster_sizes, [2, 2, 2, 1])
+
+    clustering.undo()
+    ae(clustering.cluster_sizes, [3, 2, 2])
+    clustering.undo()
+    ae(clustering.cluster_sizes, [3, 1, 2, 1])
+
+    # The consistency check catches external changes of the spike clusters.
+    clustering.spike_clusters[0] = 3
+    with raises(AssertionError):
+        clustering._check_cluster_ids()
+
+
+def test_clustering_batch():
+    spike_clusters = np.array([2, 5, 2, 3, 7, 5, 2])
+    clustering = Clustering(spike_clusters)
+
+    _l = []
+
+    @connect(sender=clustering)
+    def on_cluster(sender, up):
+        _l.append(up)
+
+    with clustering.batch() as up:
+        clustering.merge([3, 7])  # 8
+        clustering.merge([5, 8])  # 9
+        clustering.split([0])  # 10, 11
+        # Nested batches are part of the outer batch.
+        with clustering.batch() as up_nested:
+            clustering.merge([9, 11])  # 12
+        assert up_nested is up
+        with raises(RuntimeError):
+            clustering.undo()
+
+    # A single event with the combined changes.
+    assert _l == [up]
+    assert up.description == 'assign'
+    assert up.added == [10, 12]
+    assert up.deleted == [2, 3, 5, 7]
+    assert up.descendants == [(2, 10), (2, 12), (3, 12), (5, 12), (7, 12)]
+    ae(up.spike_ids, np.arange(7))
+    ae(clustering.spike_clusters, [10, 12, 12, 12, 12, 12, 12])
+    ae(clustering.cluster_sizes, [1, 6])
+
+    # A single undo step.
+    clustering.undo()
+    ae(clustering.spike_clusters, spike_clusters)
+    ae(clustering.cluster_ids, [2, 3, 5, 7])
+    clustering.redo()
+    ae(clustering.spike_clusters, [10, 12, 12, 12, 12, 12, 12])
+    assert len(_l) == 3
+
+    # Empty batch.
+    with clustering.batch():
+        pass
+    assert len(_l) == 3
+
+
+def test_clustering_apply_batch():
+    spike_clusters = np.array([2, 5, 2, 3, 7, 5, 2])
+    clustering = Clustering(spike_clusters)
+
+    up = clustering.apply_batch([('merge', [3, 7]), ('merge', [5, 8], 20), ('split', [0, 1])])
+    assert up.added == [21, 22, 23]
+    ae(clustering.spike_clusters, [21, 21, 22, 23, 23, 23, 22])
+
+    with raises(ValueError):
+        clustering.apply_batch([('undo',)])
+
+
+def test_clustering_apply():
+    spike_clusters = np.array([2, 5, 3, 2, 7, 5, 2])
+    clustering = Clustering(spike_clusters)
+
+    # Absolute cluster ids are not renumbered.
+    up = clustering.apply([1, 5], [20])
+    assert up.description == 'merge'
+    assert up.added == [20]
+    ae(clustering.spike_clusters, [2, 20, 3, 2, 7, 20, 2])
+    assert clustering.new_cluster_id() == 21
+
+    up = clustering.apply([0, 3, 6], [30, 31, 30])
+    ae(up.added, [30, 31])
+    ae(clustering.cluster_ids, [3, 7, 20, 30, 31])
+
+    # Partial clusters or existing clusters are not allowed.
+    with raises(ValueError):
+        clustering.apply([0], [40])
+    with raises(ValueError):
+        clustering.apply([2], [7])
+
+    clustering.undo()
+    ae(clustering.spike_clusters, [2, 20, 3, 2, 7, 20, 2])
+
+
+def test_clustering_update_info_arrays():
+    spike_clusters = np.repeat([0, 1, 2], 1000)
+    clustering = Clustering(spike_clusters)
+
+    # The spike ids are passed as read-only arrays.
+    up = clustering.merge([0, 1])
+    assert isinstance(up.spike_ids, np.ndarray)
+    ae(up.spike_ids, np.arange(2000))
+    assert not up.spike_ids.flags.writeable
+    assert up.added == [3]
+    assert up.deleted == [0, 1]
+    assert all(type(c) is int for c in up.deleted)
+
+    up = clustering.split(np.arange(10))
+    assert isinstance(up.spike_clusters, np.ndarray)
+    assert len(up.spike_ids) == len(up.spike_clusters) == 2000
+    with raises(ValueError):
+        up.spike_clusters[0] = 0
+    assert all(type(c) is int for c in up.added)
+
+    up = clustering.undo()
+    ae(up.spike_ids, np.arange(2000))
+
+
+def test_clustering_low_memory(tempdir):
+    n_spikes = 1000
+    spike_clusters = artificial_spike_clusters(n_spikes, 10)
+    path = tempdir / 'spike_clusters.npy'
+    np.save(path, spike_clusters)
+
+    clustering = Clustering(spike_clusters.copy())
+    clustering_lm = Clustering(np.load(path, mmap_mode='r'), low_memory=True)
+    assert clustering_lm.spike_clusters.dtype == np.int32
+    ae(clustering_lm.cluster_ids, clustering.cluster_ids)
+    ae(clustering_lm.spike_ids, np.arange(n_spikes))
+
+    def _check():
+        ae(clustering_lm.spike_clusters, clustering.spike_clusters)
+        ae(clustering_lm.cluster_ids, clustering.cluster_ids)
+        ae(clustering_lm.cluster_sizes, clustering.cluster_sizes)
+
+    for c in (clustering, clustering_lm):
+        c.merge([0, 1])
+        c.split(c.spikes_in_clusters([2])[::2])
+        c.assign(np.arange(10), np.arange(10) % 3)
+        c.undo()
+        c.undo()
+        c.redo()
+    _check()
+    assert 0 < clustering_lm.spike_clusters.n_modified < n_spikes
+
+    # The file is never modified.
+    ae(np.load(path), spike_clusters)
+
+    clustering.reset()
+    clustering_lm.reset()
+    _check()
+    assert clustering_lm.spike_clusters.n_modified == 0
+
+
+def test_clustering_history_spill(tempdir):
+    n_spikes = 1000
+    spike_clusters = artificial_spike_clusters(n_spikes, 10)
+    clustering = Clustering(spike_clusters.copy())
+    clustering.set_history_max_memory(1000, path=tempdir / 'history.bin')
+
+    states = [clustering.spike_clusters.copy()]
+    for i in range(10):
+        clustering.split(clustering.spikes_in_clusters(clustering.cluster_ids[:1])[::2])
+        states.append(clustering.spike_clusters.copy())
+    assert clustering._undo_stack.n_spilled > 0
+
+    for i in range(10, 0, -1):
+        ae(clustering.spike_clusters, states[i])
+        clustering.undo()
+    ae(clustering.spike_clusters, spike_clusters)
+    for i in range(1, 11):
+        clustering.redo()
+        ae(clustering.spike_clusters, states[i])
@@ -7,8 +7,9 @@
 #------------------------------------------------------------------------------
 
 import numpy as np
+from numpy.testing import assert_array_equal as ae
 
-from .._history import History, GlobalHistory
+from .._history import History, GlobalHistory, _EncodedArray
 
 
 #------------------------------------------------------------------------------
@@ -91,6 +92,56 @@ def test_iter_history():
         assert id(item) == id(locals()['item{0:d}'.format(i + 1)])
 
 
+def test_encoded_array():
+    for arr in (
+            np.array([], dtype=np.int64),
+            np.array([3], dtype=np.int32),
+            np.array([10, 12, 12, 100000, 100001], dtype=np.int64),
+            np.array([5, -1, 3, 2 ** 40], dtype=np.int64),
+            np.arange(10000, dtype=np.uint32)):
+        enc = _EncodedArray(arr)
+        out = enc.decode()
+        assert out.dtype == arr.dtype
+        ae(out, arr)
+    # Sorted spike ids are delta-encoded with a small type.
+    enc = _EncodedArray(np.arange(0, 300000, 3, dtype=np.int64))
+    assert enc.delta
+    assert enc.storage_dtype == np.uint8
+
+
+def test_history_spill(tempdir):
+    path = tempdir / 'history' / 'history.bin'
+    history = History((None, None), max_memory=2000)
+    items = [(np.arange(i, i + 100), np.full(100, i)) for i in range(10)]
+    for item in items:
+        history.add(item)
+    # Each item is 1600 bytes: only the current item is kept in memory.
+    assert history.n_spilled == 9
+    history.set_max_memory(4000, path=path)
+
+    def _check(item, i):
+        ae(item[0], items[i][0])
+        ae(item[1], items[i][1])
+
+    # Deep undo, loading the items back from disk.
+    for i in range(9, -1, -1):
+        _check(history.back(), i)
+        assert history.n_spilled >= 8
+    assert history.back() is None
+
+    for i in range(10):
+        _check(history.forward(), i)
+    for i, item in enumerate(history.iter(1)):
+        _check(item, i)
+
+    # Adding an item after an undo discards the next items.
+    history.back()
+    history.add((np.arange(3), np.arange(3)))
+    assert len(history) == 11
+    history.clear()
+    assert history.n_spilled == 0
+
+
 def test_global_history():
     gh = GlobalHistory()
 
@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+
+"""Test the spikes per cluster index."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import numpy as np
+from numpy.testing import assert_array_equal as ae
+from pytest import raises
+
+from phylib.io.array import _spikes_per_cluster
+from phylib.io.mock import artificial_spike_clusters
+from phylib.utils import connect
+from phy.utils.context import Context
+from ..clustering import Clustering
+from .._utils import UpdateInfo
+from .._overlay import OverlayArray
+from .._index import SpikesPerCluster, TemplateCounts, BestChannels, ClustersPerChannel
+
+
+#------------------------------------------------------------------------------
+# Test SpikesPerCluster
+#------------------------------------------------------------------------------
+
+def _check(spc, spike_clusters):
+    expected = _spikes_per_cluster(spike_clusters[spike_clusters >= 0])
+    spike_ids = np.nonzero(spike_clusters >= 0)[0]
+    assert spc.keys() == sorted(expected)
+    assert spc.n_spikes == len(spike_ids)
+    for cluster_id in expected:
+        ae(spc[cluster_id], spike_ids[expected[cluster_id]])
+
+
+def test_spikes_per_cluster_empty():
+    spc = SpikesPerCluster()
+    assert len(spc) == 0
+    assert spc.n_spikes == 0
+    assert spc.keys() == []
+    assert 0 not in spc
+    assert spc.get(0) is None
+    ae(spc.spikes_in_clusters([0, 1]), [])
+    with raises(KeyError):
+        spc[0]
+    spc.remove([0])
+    spc.assign([], [])
+    assert len(spc) == 0
+
+
+def test_spikes_per_cluster_1():
+    spike_clusters = np.array([2, 5, 2, -1, 7, 5, 2])
+    spc = SpikesPerCluster.from_spike_clusters(spike_clusters)
+    assert spc.is_dirty
+    assert str(spc) == '<SpikesPerCluster 3 clusters, 6 spikes>'
+    _check(spc, spike_clusters)
+
+    # The spike clusters are read in chunks.
+    for chunk_size in (1, 2, 3, 100):
+        _check(SpikesPerCluster.from_spike_clusters(
+            OverlayArray(spike_clusters), chunk_size=chunk_size), spike_clusters)
+
+    ae(spc[2], [0, 2, 6])
+    ae(spc.counts([2, 3, 5, 7, 100, -1]), [3, 0, 2, 1, 0, 0])
+    ae(spc.spikes_in_clusters([7, 5]), [1, 4, 5])
+
+    # Views are read-only.
+    with raises(ValueError):
+        spc[2][0] = 0
+
+    # Merge.
+    spike_clusters[[1, 4, 5]] = 8
+    spc.remove([5, 7])
+    spc.add(8, [1, 4, 5])
+    _check(spc, spike_clusters)
+
+    # Split.
+    spike_clusters[[2, 4]] = [9, 10]
+    spc.assign([0, 1, 2, 4, 5, 6], spike_clusters[[0, 1, 2, 4, 5, 6]])
+    _check(spc, spike_clusters)
+
+    # Compact.
+    spc.compact()
+    assert spc._n_dead == 0
+    _check(spc, spike_clusters)
+
+
+def test_spikes_per_cluster_dict():
+    d = {3: np.array([1, 2]), 1: np.array([0, 4])}
+    spc = SpikesPerCluster.from_dict(d)
+    assert spc.keys() == [1, 3]
+    assert list(spc) == [1, 3]
+    ae(spc.values()[1], [1, 2])
+    ae(dict(spc.items())[1], [0, 4])
+
+
+def test_spikes_per_cluster_random():
+    n_spikes = 2000
+    spike_clusters = artificial_spike_clusters(n_spikes, 20)
+    spc = SpikesPerCluster.from_spike_clusters(spike_clusters)
+    rng = np.random.RandomState(0)
+    for i in range(50):
+        spike_ids = np.unique(rng.randint(0, n_spikes, 100))
+        # Extend to whole clusters, as done by Clustering.
+        old_clusters = np.unique(spike_clusters[spike_ids])
+        spike_ids = spc.spikes_in_clusters(old_clusters)
+        spike_clusters[spike_ids] = 100 + i + rng.randint(0, 3, len(spike_ids))
+        spc.remove(old_clusters)
+        spc.assign(spike_ids, spike_clusters[spike_ids])
+        _check(spc, spike_clusters)
+    # The index has been compacted automatically.
+    assert spc._n_dead < n_spikes
+
+
+def test_spikes_per_cluster_save(tempdir):
+    spike_clusters = artificial_spike_clusters(100, 10)
+    spc = SpikesPerCluster.from_spike_clusters(spike_clusters)
+    spike_ids = np.nonzero(spike_clusters == 1)[0]
+    spike_clusters[spike_ids] = 20
+    spc.remove([1])
+    spc.add(20, spike_ids)
+
+    context = Context(tempdir)
+    context.save('spc', spc.to_arrays(), kind='npy')
+    spc = SpikesPerCluster(**context.load('spc'))
+    assert not spc.is_dirty
+    assert isinstance(spc._base, np.memmap)
+    _check(spc, spike_clusters)
+
+    # Update a memory-mapped index.
+    spike_clusters[spike_ids[::2]] = 21
+    spc.assign(spike_ids, spike_clusters[spike_ids])
+    assert spc.is_dirty
+    _check(spc, spike_clusters)
+
+
+#------------------------------------------------------------------------------
+# Test TemplateCounts
+#------------------------------------------------------------------------------
+
+def _check_counts(counts, spike_clusters, spike_templates):
+    assert counts.cluster_ids.tolist() == sorted(set(spike_clusters))
+    for cluster_id in counts.cluster_ids:
+        expected = np.bincount(
+            spike_templates[spike_clusters == cluster_id], minlength=counts.n_templates)
+        ae(counts.dense(cluster_id), expected)
+        templates, n = counts[cluster_id]
+        ae(templates, np.nonzero(expected)[0])
+        ae(n, expected[templates])
+        assert counts.best_templates([cluster_id])[0] == np.argmax(expected)
+
+
+def test_template_counts_1():
+    counts = TemplateCounts.from_spike_templates([2, 2, 0, 2, 0, -1], [1, 3, 0, 1, 2, 0])
+    for chunk_size in (1, 4, 100):
+        other = TemplateCounts.from_spike_templates(
+            OverlayArray(np.array([2, 2, 0, 2, 0, -1])), np.array([1, 3, 0, 1, 2, 0]),
+            chunk_size=chunk_size)
+        for key, arr in counts.to_arrays().items():
+            ae(other.to_arrays()[key], arr)
+    assert len(counts) == 2
+    assert 1 not in counts
+    with raises(KeyError):
+        counts[1]
+    ae(counts.dense(2), [0, 2, 0, 1])
+    ae(counts.best_templates([0, 2]), [0, 1])
+
+    values = np.array([.5, .25, 1., .75])
+    ae(counts.reduce(values), [1., .75])
+    ae(counts.reduce(values, [2]), [.75])
+    ae(counts.reduce(values, ufunc=np.minimum), [.5, .25])
+
+    counts.merge([0, 2], 5)
+    assert counts.cluster_ids.tolist() == [5]
+    ae(counts.reduce(values), [1.])
+    assert counts._n_dead == 4
+    ae(counts.dense(5), [1, 2, 1, 1])
+    arrays = counts.to_arrays()
+    ae(arrays['templates'], [0, 1, 2, 3])
+    ae(arrays['offsets'], [0, 4])
+    ae(arrays['clusters'], [5])
+
+
+def test_template_counts_clustering():
+    n_spikes, n_templates = 1000, 20
+    rng = np.random.RandomState(0)
+    spike_templates = rng.randint(0, n_templates, n_spikes)
+    clustering = Clustering(spike_templates.copy())
+    counts = TemplateCounts.from_spike_templates(spike_templates, spike_templates)
+
+    @connect(sender=clustering)
+    def on_cluster(sender, up):
+        counts.update(up, spike_templates)
+
+    def _check():
+        _check_counts(counts, clustering.spike_clusters, spike_templates)
+
+    clustering.merge([0, 1, 2])
+    _check()
+
+    clustering.split(np.arange(0, n_spikes, 3))
+    _check()
+
+    for _ in range(10):
+        clustering.merge(rng.choice(clustering.cluster_ids, 2, replace=False))
+    _check()
+
+    clustering.undo()
+    clustering.undo()
+    _check()
+
+    clustering.redo()
+    _check()
+
+
+#------------------------------------------------------------------------------
+# Test BestChannels
+#------------------------------------------------------------------------------
+
+def test_best_channels(tempdir):
+    best_channels = {3: [2, 1], 0: [0], 5: [4, 2, 3]}
+    table = BestChannels.from_dict(best_channels)
+    assert table.is_dirty
+    assert len(table) == 3
+    ae(table.cluster_ids, [0, 3, 5])
+    ae(table[5], [4, 2, 3])
+    assert 1 not in table
+    assert table.get(1) is None
+    with raises(KeyError):
+        table[1]
+    ae(table.missing([0, 1, 5, 6]), [1, 6])
+
+    context = Context(tempdir)
+    context.save('best_channels', table.to_arrays([0, 3, 5, 7]), kind='npy')
+    table = BestChannels(**context.load('best_channels'))
+    assert not table.is_dirty
+    for cluster_id, channel_ids in best_channels.items():
+        ae(table[cluster_id], channel_ids)
+    ae(table.best_channel([5, 0, 3]), [4, 0, 2])
+
+    # New clusters.
+    table.set([7, 1], [[1, 0], [3]])
+    assert table.is_dirty
+    ae(table.cluster_ids, [0, 1, 3, 5, 7])
+    ae(table.best_channel([7, 5, 1]), [1, 4, 3])
+    assert not len(table.missing([1, 7]))
+
+    # Only keep some clusters.
+    table = BestChannels(**table.to_arrays([1, 5, 8]))
+    ae(table.cluster_ids, [1, 5])
+    ae(table[1], [3])
+
+
+#------------------------------------------------------------------------------
+# Test ClustersPerChannel
+#------------------------------------------------------------------------------
+
+def test_clusters_per_channel():
+    best_channels = {0: [1, 2], 1: [2, 3], 2: [0], 3: [2]}
+    calls = []
+
+    def get_best_channels(cluster_id):
+        calls.append(cluster_id)
+        return best_channels[cluster_id]
+
+    index = ClustersPerChannel(get_best_channels, [0, 1, 2, 3])
+    assert calls == []
+
+    assert index.clusters(2) == [0, 1, 3]
+    assert index.clusters(0) == [2]
+    assert index.clusters(10) == []
+    assert sorted(calls) == [0, 1, 2, 3]
+
+    # Merge: only the best channels of the new cluster are requested.
+    del calls[:]
+    best_channels[4] = [2, 4]
+    index.update(UpdateInfo(added=[4], deleted=[0, 1]))
+    assert calls == []
+    assert index.clusters(2) == [3, 4]
+    assert index.clusters(1) == []
+    assert index.clusters(4) == [4]
+    assert calls == [4]
+
+    # Clusters deleted before being indexed.
+    best_channels[5] = [0]
+    index.update(UpdateInfo(added=[5], deleted=[]))
+    index.update(UpdateInfo(added=[], deleted=[5]))
+    assert index.clusters(0) == [2]
+    assert calls == [4]
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+"""Test the action journal."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import numpy as np
+from numpy.testing import assert_array_equal as ae
+
+from .._journal import ActionJournal, ASSIGN, MERGE, METADATA
+
+
+#------------------------------------------------------------------------------
+# Test action journal
+#------------------------------------------------------------------------------
+
+def test_journal_1(tempdir):
+    path = tempdir / 'journal.bin'
+    journal = ActionJournal(path, n_spikes=10)
+    assert journal.read() == []
+
+    journal.append_merge([2, 3], 4)
+    journal.append_assign([0, 1], [5, 6])
+    journal.append_metadata('group', np.array([4]), 'good')
+    assert len(journal) == 3
+
+    (k0, d0, o0), (k1, d1, o1), (k2, d2, o2) = ActionJournal(path, n_spikes=10).read()
+    assert (k0, k1, k2) == (MERGE, ASSIGN, METADATA)
+    ae(d0[0], [2, 3])
+    assert d0[1] == 4
+    ae(d1, [[0, 1], [5, 6]])
+    assert d2 == ['group', [4], 'good']
+    assert o0 < o1 < o2 == path.stat().st_size
+
+    # Truncate the last record.
+    journal.truncate(o1)
+    assert len(journal) == 2
+
+    journal.clear()
+    assert not path.exists()
+    assert len(journal) == 0
+
+
+def test_journal_truncated(tempdir):
+    path = tempdir / 'journal.bin'
+    journal = ActionJournal(path, n_spikes=10)
+    journal.append_merge([2, 3], 4)
+    journal.append_merge([4, 5], 6)
+
+    # Simulate an interrupted write.
+    with open(path, 'r+b') as f:
+        f.truncate(path.stat().st_size - 3)
+    records = journal.read()
+    assert len(records) == 1
+    assert records[0][1][1] == 4
+
+    # The truncated record is discarded before new records are appended.
+    assert len(journal.recover()) == 1
+    journal.append_merge([4, 7], 8)
+    records = journal.read()
+    assert [data[1] for _, data, _ in records] == [4, 8]
+    ae(records[1][1][0], [4, 7])
+
+    # A journal without any valid record is removed.
+    with open(path, 'r+b') as f:
+        f.truncate(records[0][2] - 3)
+    assert journal.recover() == []
+    assert not path.exists()
+
+
+def test_journal_mismatch(tempdir):
+    path = tempdir / 'journal.bin'
+    ActionJournal(path, n_spikes=10).append_merge([2, 3], 4)
+    assert ActionJournal(path, n_spikes=20).read() == []
+    assert not path.exists()
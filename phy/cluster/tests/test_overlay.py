@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+
+"""Test the overlay array."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import numpy as np
+from numpy.testing import assert_array_equal as ae
+
+from .._overlay import OverlayArray
+
+
+#------------------------------------------------------------------------------
+# Test OverlayArray
+#------------------------------------------------------------------------------
+
+def test_overlay_array_1(tempdir):
+    path = tempdir / 'arr.npy'
+    np.save(path, np.arange(10, dtype=np.int64))
+    base = np.load(path, mmap_mode='r')
+    arr = OverlayArray(base, dtype=np.int32)
+    assert len(arr) == 10
+    assert arr.shape == (10,)
+    assert arr.n_modified == 0
+    assert str(arr) == '<OverlayArray 10 items, 0 modified>'
+
+    ae(arr[2:5], [2, 3, 4])
+    assert arr[3] == 3
+
+    # Writes only go to the overlay.
+    arr[[5, 1, 5]] = [50, 10, 51]
+    arr[-1] = 90
+    assert arr.n_modified == 3
+    ae(base, np.arange(10))
+    assert arr[5] == 51
+    ae(arr[[9, 1, 2]], [90, 10, 2])
+    ae(arr[np.arange(10) >= 8], [8, 90])
+    ae(arr[::3], [0, 3, 6, 90])
+    ae(arr, [0, 10, 2, 3, 4, 51, 6, 7, 8, 90])
+    assert arr.copy().dtype == np.int32
+    assert arr.max() == 90
+
+    # Restoring the base values empties the overlay.
+    arr[[1, 5]] = [1, 5]
+    assert arr.n_modified == 1
+    arr.reset()
+    assert arr.n_modified == 0
+    ae(arr, np.arange(10))
+
+
+def test_overlay_array_chunks():
+    arr = OverlayArray(np.zeros(10, dtype=np.int32))
+    arr.chunk_size = 3
+    arr[[2, 7]] = 1
+    chunks = list(arr.iter_chunks())
+    assert [len(chunk) for chunk in chunks] == [3, 3, 3, 1]
+    ae(np.concatenate(chunks), np.asarray(arr))
+
+
+def test_overlay_array_save_rebase(tempdir):
+    base = np.arange(10, dtype=np.int64)
+    arr = OverlayArray(base, dtype=np.int32)
+    arr.chunk_size = 3
+    arr[[1, 8]] = [10, 80]
+
+    path = tempdir / 'arr.npy'
+    arr.save(path)
+    saved = np.load(path, mmap_mode='r')
+    ae(saved, arr)
+    assert saved.dtype == np.int32
+
+    arr.rebase(saved)
+    assert arr.base is saved
+    assert arr.n_modified == 0
+    ae(arr, [0, 10, 2, 3, 4, 5, 6, 7, 80, 9])
+
+    # Only the items that differ from the new base are kept in the overlay.
+    arr[[2, 3]] = [20, 30]
+    new = np.array(saved)
+    new[2] = 20
+    arr.rebase(new)
+    assert arr.n_modified == 1
+    ae(arr, [0, 10, 20, 30, 4, 5, 6, 7, 80, 9])
@@ -0,0 +1,261 @@
+# -*- coding: utf-8 -*-
+
+"""Test the headless curation session."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+import numpy as np
+from numpy.testing import assert_array_equal as ae
+from pytest import fixture
+
+from phylib.utils import connect
+from phy.utils.context import Context
+from .._utils import batch_metric
+from ..session import CurationSession
+
+
+#------------------------------------------------------------------------------
+# Fixtures
+#------------------------------------------------------------------------------
+
+@fixture
+def session(cluster_ids, cluster_groups, cluster_labels, tempdir):
+    spike_clusters = np.repeat(cluster_ids, 2)
+    return CurationSession(
+        spike_clusters,
+        cluster_groups=cluster_groups,
+        cluster_labels=cluster_labels,
+        context=Context(tempdir),
+    )
+
+
+#------------------------------------------------------------------------------
+# Tests
+#------------------------------------------------------------------------------
+
+def test_session_1(session):
+    ae(session.cluster_ids, [0, 1, 2, 10, 11, 20, 30])
+    assert session.fields == ('test_label',)
+    assert session.get_labels('test_label')[10] == 123
+    assert session.get_metric('n_spikes', [0, 1]) == {0: 2, 1: 2}
+    assert session.cluster_info[0] == {
+        'id': 0, 'n_spikes': 2, 'group': 'noise', 'test_label': 456, 'is_masked': True}
+    assert not session.is_dirty()
+
+    assert session.merge([20]) is None
+    up = session.merge([20, 30])
+    assert up.added == [31]
+    assert session.n_spikes(31) == 4
+
+    session.split([0, 2])
+    ae(session.cluster_ids, [2, 10, 11, 31, 32, 33, 34])
+
+    session.undo()
+    session.undo()
+    ae(session.cluster_ids, [0, 1, 2, 10, 11, 20, 30])
+    session.redo()
+    ae(session.cluster_ids, [0, 1, 2, 10, 11, 31])
+    assert session.is_dirty()
+
+
+def test_session_labels(session):
+    # Metric-based labeling.
+    session.cluster_metrics['depth'] = lambda cl: 10 * cl
+    assert not session.move('', [])
+    session.move('mua', [c for c, d in session.get_metric('depth').items() if d >= 200])
+    assert session.cluster_meta.get('group', 30) == 'mua'
+
+    # The new cluster gets the label of its parents.
+    up = session.merge([20, 30])
+    assert session.cluster_meta.get('group', up.added[0]) == 'mua'
+
+    session.label('my_field', 1.23, 2)
+    assert 'my_field' in session.fields
+    assert session.get_labels('my_field')[2] == 1.23
+
+
+def test_session_batch_metric(session):
+    _calls = []
+
+    @batch_metric
+    def depth(cluster_ids):
+        _calls.append(cluster_ids)
+        return 10. * cluster_ids
+
+    session.cluster_metrics['depth'] = depth
+    session.cluster_metrics['label'] = lambda cl: 'c%d' % cl
+    assert session.get_metric('depth', [1, 20]) == {1: 10., 20: 200.}
+    info = session.cluster_info
+    assert len(_calls) == 2
+    assert [i['depth'] for i in info] == [10. * c for c in session.cluster_ids]
+    assert info[-1]['label'] == 'c30'
+    assert info[-1]['n_spikes'] == 2
+    assert session.n_spikes(30) == 2
+
+
+def test_session_save(session, tempdir):
+    _saved = []
+
+    @connect(sender=session)
+    def on_save_clustering(sender, spike_clusters, groups, *labels):
+        _saved.append((spike_clusters.copy(), groups, labels))
+
+    with session.batch():
+        session.merge([20, 30])
+        session.move('good', 31)
+    session.save()
+    assert not session.is_dirty()
+
+    spike_clusters, groups, labels = _saved[0]
+    ae(spike_clusters, np.repeat([0, 1, 2, 10, 11, 31, 31], 2))
+    assert groups[31] == 'good'
+    assert groups[2] == 'unsorted'
+    assert labels[1][0] == 'test_label'
+
+    # The new cluster id and the spikes per cluster index are cached in the context.
+    context = Context(tempdir)
+    assert context.load('new_cluster_id')['new_cluster_id'] == 32
+    session = CurationSession(np.repeat([0, 1, 2, 10, 11, 31, 31], 2), context=context)
+    assert not session.clustering.spikes_per_cluster.is_dirty
+
+
+def test_session_journal(cluster_ids, cluster_groups, tempdir):
+    spike_clusters = np.repeat(cluster_ids, 2)
+    path = tempdir / 'journal.bin'
+
+    def _session():
+        session = CurationSession(
+            spike_clusters.copy(), cluster_groups=cluster_groups, context=Context(tempdir))
+        session.attach_journal(path)
+        return session
+
+    session = _session()
+    session.merge([20, 30])
+    session.split([0, 2])
+    session.undo()
+    session.move('good', 31)
+    session.label('my_field', 3, [1, 31])
+    with session.batch():
+        new = session.merge([10, 11]).added[0]
+        session.move('mua', new)
+    session.move('noise', [1, 2])
+    session.undo()
+    ids = session.cluster_ids
+    sc = session.clustering.spike_clusters.copy()
+
+    # Simulate a crash: a new session replays the journal.
+    session = _session()
+    ae(session.cluster_ids, ids)
+    ae(session.clustering.spike_clusters, sc)
+    assert session.cluster_meta.get('group', 31) == 'good'
+    assert session.cluster_meta.get('group', new) == 'mua'
+    assert session.cluster_meta.get('group', 1) == 'good'
+    assert session.cluster_meta.get('group', 2) is None
+    labels = session.get_labels('my_field')
+    assert labels[1] == labels[31] == 3
+    assert labels[0] is None
+    assert session.is_dirty()
+
+    # The replayed actions can be undone.
+    session.undo()
+    assert session.cluster_meta.get('group', 2) == 'noise'
+
+    # The journal is cleared on save.
+    session.save()
+    assert not path.exists()
+    session = _session()
+    ae(session.cluster_ids, [0, 1, 2, 10, 11, 20, 30])
+
+
+def test_session_journal_batch_metadata(cluster_ids, tempdir):
+    spike_clusters = np.repeat(cluster_ids, 2)
+    path = tempdir / 'journal.bin'
+
+    def _session():
+        session = CurationSession(spike_clusters.copy(), context=Context(tempdir))
+        session.attach_journal(path)
+        return session
+
+    session = _session()
+    with session.batch():
+        session.move('good', [1])
+        session.move('mua', [1, 2])
+        session.move('good', [1])
+    assert session.cluster_meta.get('group', 1) == 'good'
+
+    # The journal replays the final values.
+    session = _session()
+    assert session.cluster_meta.get('group', 1) == 'good'
+    assert session.cluster_meta.get('group', 2) == 'mua'
+
+
+def test_session_journal_discard(cluster_ids, tempdir):
+    path = tempdir / 'journal.bin'
+
+    def _session(spike_clusters):
+        session = CurationSession(spike_clusters.copy(), context=Context(tempdir))
+        session.attach_journal(path)
+        return session
+
+    saved = []
+    session = _session(np.repeat(cluster_ids, 2))
+
+    @connect(sender=session)
+    def on_save_clustering(sender, spike_clusters, *args):
+        saved.append(spike_clusters.copy())
+
+    session.merge([20, 30])
+    session.save()
+
+    # The unsaved changes are discarded when closing.
+    session.merge([10, 11])
+    session.split([0, 2])
+    assert path.exists()
+    session.clear_journal()
+
+    # They are not replayed at the next launch.
+    session = _session(saved[-1])
+    ae(session.clustering.spike_clusters, saved[-1])
+    ae(session.cluster_ids, [0, 1, 2, 10, 11, 31])
+    assert not session.is_dirty()
+
+
+def test_session_journal_truncated(cluster_ids, tempdir):
+    spike_clusters = np.repeat(cluster_ids, 2)
+    path = tempdir / 'journal.bin'
+    session = CurationSession(spike_clusters.copy())
+    session.attach_journal(path)
+    session.merge([20, 30])
+    session.merge([10, 11])
+
+    # Simulate a crash during the last write.
+    with open(path, 'r+b') as f:
+        f.truncate(path.stat().st_size - 3)
+
+    # The valid action is replayed, and new actions are appended after it.
+    session = CurationSession(spike_clusters.copy())
+    session.attach_journal(path)
+    ae(session.cluster_ids, [0, 1, 2, 10, 11, 31])
+    session.merge([0, 1])
+
+    session = CurationSession(spike_clusters.copy())
+    session.attach_journal(path)
+    ae(session.cluster_ids, [2, 10, 11, 31, 32])
+
+
+def test_session_journal_invalid(cluster_ids, tempdir):
+    spike_clusters = np.repeat(cluster_ids, 2)
+    path = tempdir / 'journal.bin'
+    session = CurationSession(spike_clusters.copy())
+    session.attach_journal(path)
+    session.merge([20, 30])
+    session.merge([10, 11])
+
+    # The journal does not match the new clustering: the first action cannot be replayed.
+    spike_clusters[-1] = 31
+    session = CurationSession(spike_clusters)
+    session.attach_journal(path)
+    ae(session.cluster_ids, [0, 1, 2, 10, 11, 20, 30, 31])
+    assert not path.exists()
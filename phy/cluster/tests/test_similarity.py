@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+
+"""Test the template similarity index."""
+
+#------------------------------------------------------------------------------
+# Imports
+#------------------------------------------------------------------------------
+
+from operator import itemgetter
+
+import numpy as np
+from numpy.testing import assert_array_equal as ae
+
+from phylib.utils import Bunch, connect
+from .._utils import UpdateInfo
+from ..clustering import Clustering
+from .._index import TemplateCounts
+from .._similarity import TemplateSimilarity, WaveformSimilarity
+
+
+#------------------------------------------------------------------------------
+# Test TemplateSimilarity
+#------------------------------------------------------------------------------
+
+def _expected(clustering, spike_templates, similar_templates, cluster_id, k):
+    spc = clustering.spikes_per_cluster
+    temp_i = np.unique(spike_templates[spc[cluster_id]])
+    sims = similar_templates[temp_i, :].max(axis=0)
+    out = [
+        (cj, float(sims[np.unique(spike_templates[spc[cj]])].max()))
+        for cj in clustering.cluster_ids]
+    return sorted(out, key=itemgetter(1), reverse=True)[:k]
+
+
+def test_template_similarity():
+    n_spikes, n_templates = 1000, 20
+    rng = np.random.RandomState(0)
+    spike_templates = rng.randint(0, n_templates, n_spikes)
+    similar_templates = rng.rand(n_templates, n_templates)
+    clustering = Clustering(spike_templates.copy())
+
+    k = 5
+    counts = TemplateCounts.from_spike_templates(spike_templates, spike_templates)
+    index = TemplateSimilarity(similar_templates, counts, k=k)
+
+    @connect(sender=clustering)
+    def on_cluster(sender, up):
+        counts.update(up, spike_templates)
+        index.update(up)
+
+    def _check():
+        for cluster_id in clustering.cluster_ids:
+            expected = _expected(clustering, spike_templates, similar_templates, cluster_id, k)
+            assert index.similarity(cluster_id) == expected
+        ae(index.cluster_ids, clustering.cluster_ids)
+
+    _check()
+    assert index.similarity(1000) == []
+
+    clustering.merge([0, 1, 2])
+    _check()
+
+    clustering.split(np.arange(0, n_spikes, 3))
+    _check()
+
+    for _ in range(10):
+        clustering.merge(rng.choice(clustering.cluster_ids, 2, replace=False))
+    _check()
+
+    clustering.undo()
+    clustering.undo()
+    _check()
+
+    clustering.redo()
+    _check()
+
+    # The index does not compact the template counts.
+    assert counts._n_dead > 0
+
+
+#------------------------------------------------------------------------------
+# Test WaveformSimilarity
+#------------------------------------------------------------------------------
+
+def test_waveform_similarity():
+    n_clusters, n_channels, n_samples = 10, 8, 5
+    rng = np.random.RandomState(0)
+    waveforms = {}
+
+    def _add(cluster_id, channel_ids):
+        waveforms[cluster_id] = Bunch(
+            data=rng.randn(1, n_samples, len(channel_ids)), channel_ids=channel_ids)
+
+    for cluster_id in range(n_clusters):
+        _add(cluster_id, np.sort(rng.choice(n_channels, 3, replace=False)))
+
+    def _expected(ci, cj):
+        dense = []
+        for c in (ci, cj):
+            w = np.zeros((n_samples, n_channels))
+            w[:, waveforms[c].channel_ids] = waveforms[c].data[0]
+            dense.append(w / np.sqrt(np.sum(w ** 2)))
+        return np.sum(dense[0] * dense[1])
+
+    k = 4
+    calls = []
+
+    def get_mean_waveforms(cluster_id):
+        calls.append(cluster_id)
+        return waveforms[cluster_id]
+
+    ws = WaveformSimilarity(get_mean_waveforms, range(n_clusters), n_channels, k=k)
+
+    def _check():
+        cluster_ids = ws.cluster_ids
+        for ci in cluster_ids:
+            sims = ws.similarity(ci)
+            assert len(sims) <= k
+            assert ci not in [c for c, _ in sims]
+            assert [s for _, s in sims] == sorted([s for _, s in sims], reverse=True)
+            for cj, s in sims:
+                assert np.allclose(s, _expected(ci, cj), atol=1e-5)
+            overlapping = [
+                cj for cj in cluster_ids if cj != ci and
+                np.intersect1d(waveforms[ci].channel_ids, waveforms[cj].channel_ids).size]
+            assert len(sims) == min(k, len(overlapping))
+
+        ids, pairwise = ws.pairwise()
+        ae(ids, cluster_ids)
+        i, j = 0, len(ids) - 1
+        assert np.allclose(pairwise[i, j], _expected(ids[i], ids[j]), atol=1e-5)
+
+    assert ws.similarity(100) == []
+    _check()
+    assert sorted(calls) == list(range(n_clusters))
+
+    # Merge: only the mean waveforms of the new cluster are computed.
+    del calls[:]
+    _add(10, np.arange(4))
+    ws.update(UpdateInfo(added=[10], deleted=[0, 1]))
+    _check()
+    assert calls == [10]
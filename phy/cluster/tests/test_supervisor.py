@@ -14,7 +14,7 @@ from numpy.testing import assert_array_equal as ae
 
 from .. import supervisor as _supervisor
 from ..supervisor import (
-    Supervisor, TaskLogger, ClusterView, SimilarityView, ActionCreator)
+    Supervisor, TaskLogger, ClusterView, SimilarityView, NativeClusterView, ActionCreator)
 from phy.gui import GUI
 from phy.gui.widgets import Barrier
 from phy.gui.qt import qInstallMessageHandler
@@ -240,6 +240,21 @@ def test_cluster_view_extra_columns(qtbot, gui, data):
     _wait_until_table_ready(qtbot, cv)
 
 
+def test_native_cluster_view_1(qtbot, gui, data):
+    cv = NativeClusterView(gui, data=data)
+    _wait_until_table_ready(qtbot, cv)
+
+    # The default sort is by decreasing number of spikes.
+    _assert(cv.get_ids, list(range(10)))
+
+    cv.sort_by('n_spikes', 'asc')
+    cv.select([1])
+    assert cv.state == {'current_sort': ('n_spikes', 'asc'), 'selected': [1]}
+
+    cv.set_state({'current_sort': ('id', 'desc'), 'selected': [2]})
+    assert cv.state == {'current_sort': ('id', 'desc'), 'selected': [2]}
+
+
 #------------------------------------------------------------------------------
 # Test ActionCreator
 #------------------------------------------------------------------------------
@@ -398,6 +413,59 @@ def test_supervisor_skip(qtbot, gui, supervisor):
         _assert_selected(supervisor, [clu])
 
 
+def test_supervisor_native_tables(
+        qtbot, gui, cluster_ids, cluster_groups, cluster_labels, similarity, tempdir):
+    spike_clusters = np.repeat(cluster_ids, 2)
+
+    with raises(ValueError):
+        Supervisor(spike_clusters, similarity=similarity, table_backend='unknown')
+
+    s = Supervisor(
+        spike_clusters,
+        cluster_groups=cluster_groups,
+        cluster_labels=cluster_labels,
+        similarity=similarity,
+        context=Context(tempdir),
+        sort=('id', 'desc'),
+        table_backend='native',
+    )
+    s.attach(gui)
+    b = Barrier()
+    connect(b('cluster_view'), event='ready', sender=s.cluster_view)
+    connect(b('similarity_view'), event='ready', sender=s.similarity_view)
+    b.wait()
+
+    # Same wizard as with the HTML tables, skipping the masked clusters.
+    for clu in [30, 20, 11, 2, 1]:
+        s.select_actions.next_best()
+        s.block()
+        _assert_selected(s, [clu])
+
+    _select(s, [30], [20])
+    _assert_selected(s, [30, 20])
+    assert s.all_cluster_ids == [30, 20, 11, 10, 2, 1, 0]
+    # The next cluster in the similarity view, then in the cluster view.
+    assert s.upcoming_clusters == [11, 20]
+
+    s.actions.merge()
+    s.block()
+    _assert_selected(s, [31])
+    assert s.all_cluster_ids == [31, 11, 10, 2, 1, 0]
+
+    s.actions.undo()
+    s.block()
+    _assert_selected(s, [30, 20])
+
+    s.filter('5 <= id && id <= 20')
+    assert s.all_cluster_ids == [20, 11, 10]
+    s.clear_filter()
+
+    # The mirror follows sorts made in the view itself.
+    s.cluster_view.sort_by('id', 'asc')
+    assert s.all_cluster_ids == [0, 1, 2, 10, 11, 20, 30]
+    assert s.all_cluster_ids == s.cluster_view.get_ids()
+
+
 def test_supervisor_sort(qtbot, supervisor):
     supervisor.sort('id', 'desc')
     qtbot.wait(50)
@@ -618,6 +686,42 @@ def test_supervisor_label_cluster_3(supervisor):
     assert supervisor.get_labels('my_field')[up.added[0]] == 3.14
 
 
+def test_supervisor_batch(supervisor):
+
+    _l = []
+
+    @connect(sender=supervisor)
+    def on_cluster(sender, up):
+        _l.append(up)
+
+    supervisor.label('my_field', 3.14, cluster_ids=[20])
+    n = len(_l)
+
+    with supervisor.batch():
+        up = supervisor.merge([20, 30])
+        supervisor.merge(up.added + [10])
+        supervisor.move('good', [0, 1])
+        supervisor.label('my_field', 1.23, cluster_ids=[2])
+    supervisor.block()
+
+    # One event per controller.
+    assert len(_l) == n + 2
+    assert supervisor.get_labels('my_field')[32] == 3.14
+    assert supervisor.cluster_meta.get('group', 0) == 'good'
+    assert supervisor.clustering.cluster_ids.tolist() == [0, 1, 2, 11, 32]
+
+    # The whole batch is undone at once.
+    supervisor.undo()
+    supervisor.block()
+    assert supervisor.clustering.cluster_ids.tolist() == [0, 1, 2, 10, 11, 20, 30]
+    assert supervisor.cluster_meta.get('group', 1) == 'good'
+    assert supervisor.get_labels('my_field')[2] is None
+
+    supervisor.redo()
+    supervisor.block()
+    assert supervisor.clustering.cluster_ids.tolist() == [0, 1, 2, 11, 32]
+
+
 def test_supervisor_move_1(supervisor):
 
     _select(supervisor, [20])
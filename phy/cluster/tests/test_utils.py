@@ -8,10 +8,12 @@
 
 import logging
 
+import numpy as np
 from pytest import raises
 
-from .._utils import (ClusterMeta, UpdateInfo, RotatingProperty,
-                      _update_cluster_selection, create_cluster_meta)
+from phylib.utils import connect
+from .._utils import (ClusterMeta, UpdateInfo, RotatingProperty, batch_metric,
+                      _metric_values, _update_cluster_selection, create_cluster_meta)
 
 logger = logging.getLogger(__name__)
 
@@ -140,6 +142,73 @@ def test_metadata_history_complex():
     assert info is None
 
 
+def test_metadata_batch():
+    meta = ClusterMeta()
+    meta.add_field('group')
+
+    _l = []
+
+    @connect(sender=meta)
+    def on_cluster(sender, up):
+        _l.append(up)
+
+    # Same field and value.
+    with meta.batch() as up:
+        meta.set('group', [2], 'good')
+        meta.set('group', [3, 2], 'good')
+    assert _l == [up]
+    assert up.description == 'metadata_group'
+    assert up.metadata_changed == [2, 3]
+    assert up.metadata_value == 'good'
+
+    # Several fields and values.
+    with meta.batch() as up:
+        meta.set('group', [2], 'noise')
+        meta.set('quality', [3], 1)
+        meta.set('quality', [4], 1)
+    assert len(_l) == 2
+    assert up.description == 'metadata'
+    assert up.metadata_changed == [2, 3, 4]
+    assert up.metadata_changes == [('group', [2], 'noise'), ('quality', [3, 4], 1)]
+
+    # A batch is a single undo step.
+    meta.undo()
+    assert meta.get('group', 2) == 'good'
+    assert meta.get('quality', 3) is None
+    meta.undo()
+    assert meta.get('group', 2) is None
+    meta.redo()
+    meta.redo()
+    assert meta.get('group', 2) == 'noise'
+    assert meta.get('quality', 4) == 1
+
+
+def test_metadata_batch_final_value():
+    meta = ClusterMeta()
+    meta.add_field('group')
+
+    _l = []
+
+    @connect(sender=meta)
+    def on_cluster(sender, up):
+        _l.append(up)
+
+    # The changes contain the final value of every cluster.
+    with meta.batch() as up:
+        meta.set('group', [1], 'good')
+        meta.set('group', [1, 2], 'mua')
+        meta.set('group', [1], 'good')
+        # Nested batches are part of the outer batch.
+        with meta.batch() as up_nested:
+            meta.set('quality', [2], 3)
+        assert up_nested is up
+    assert _l == [up]
+    assert meta.get('group', 1) == 'good'
+    assert up.metadata_changed == [1, 2]
+    assert up.metadata_changes == [
+        ('group', [1], 'good'), ('group', [2], 'mua'), ('quality', [2], 3)]
+
+
 def test_metadata_descendants():
     """Test ClusterMeta history."""
 
@@ -180,6 +249,36 @@ def test_metadata_descendants():
     assert meta.group(2) == 2
 
 
+def test_metadata_columns():
+    meta = ClusterMeta()
+    meta.add_field('group')
+    meta.add_field('quality', 0)
+    meta.from_dict({5: {'group': 'good'}, 2: {'quality': 1.}})
+
+    assert meta.get('group', np.array([2, 5, 100])) == [None, 'good', None]
+    assert meta.get('quality', [2, 5]) == [1., 0]
+    assert meta.to_dict('group') == {5: 'good', 2: None}
+
+    # Values of different types are kept distinct.
+    meta.set('quality', [5], 1)
+    meta.set('quality', [7], True)
+    assert meta.quality(5) == 1 and isinstance(meta.quality(5), int)
+    assert meta.quality(7) is True
+    assert meta.quality(2) == 1. and isinstance(meta.quality(2), float)
+
+    # Undo and redo only restore the changed clusters.
+    meta.set('group', [5, 7], 'mua')
+    meta.set_from_descendants([(5, 8)])
+    assert meta.group(8) == 'mua'
+    meta.undo()
+    assert meta.get('group', [5, 7, 8]) == ['good', None, 'mua']
+    meta.undo()
+    meta.undo()
+    assert meta.to_dict('quality') == {5: 0, 2: 1., 8: 1}
+    meta.redo()
+    assert meta.to_dict('quality') == {5: 1, 2: 1., 8: 1}
+
+
 def test_update_cluster_selection():
     clusters = [1, 2, 3]
     up = UpdateInfo(deleted=[2], added=[4, 0])
@@ -210,3 +309,22 @@ def test_rotating_property():
     assert rp.get() == 3
     assert rp.next() == 'f1'
     assert rp.previous() == 'f3'
+
+
+def test_batch_metric():
+    _calls = []
+
+    @batch_metric
+    def f(cluster_ids):
+        _calls.append(cluster_ids)
+        return 10 * cluster_ids
+
+    assert f.is_batch
+    assert f(3) == 30
+    assert isinstance(f(3), int)
+    assert list(f([1, 2])) == [10, 20]
+    assert _metric_values(f, [1, 2, 5]) == [10, 20, 50]
+    assert len(_calls) == 4
+
+    # Non-batch metrics are called once per cluster.
+    assert _metric_values(lambda c: c + 1, [1, 2]) == [2, 3]
@@ -23,6 +23,9 @@ from phy.utils.color import ClusterColorSelector
 
 logger = logging.getLogger(__name__)
 
+# Class names of the cluster and similarity views, with all table backends.
+_TABLE_VIEW_NAMES = ('ClusterView', 'SimilarityView', 'NativeClusterView', 'NativeSimilarityView')
+
 
 # -----------------------------------------------------------------------------
 # Manual clustering view
@@ -211,7 +214,7 @@ class ManualClusteringView(object):
         if not self.auto_update or self._closed:
             return
         # Only the Supervisor and some specific views can trigger a proper select event.
-        if sender.__class__.__name__ in ('ClusterView', 'SimilarityView'):
+        if sender.__class__.__name__ in _TABLE_VIEW_NAMES:
             return
         assert isinstance(cluster_ids, list)
         if not cluster_ids:
@@ -470,7 +473,7 @@ class BaseGlobalView(object):
         if not self.auto_update:
             return
         # Only the Supervisor and some specific views can trigger a proper select event.
-        if sender.__class__.__name__ in ('ClusterView', 'SimilarityView'):
+        if sender.__class__.__name__ in _TABLE_VIEW_NAMES:
             return
         assert isinstance(cluster_ids, list)
         if not cluster_ids:
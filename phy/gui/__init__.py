@@ -5,8 +5,8 @@
 
 from .qt import (
     require_qt, create_app, run_app, prompt, message_box, input_dialog, busy_cursor,
-    screenshot, screen_size, is_high_dpi, thread_pool, Worker, Debouncer
+    screenshot, screen_size, is_high_dpi, thread_pool, Worker, Prefetcher, Debouncer
 )
 from .gui import GUI, GUIState, DockWidget
 from .actions import Actions, Snippets
-from .widgets import HTMLWidget, HTMLBuilder, Table, IPythonView, KeyValueWidget
+from .widgets import HTMLWidget, HTMLBuilder, Table, NativeTable, IPythonView, KeyValueWidget
@@ -31,12 +31,13 @@ from OpenGL import GL  # noqa
 from PyQt5.QtCore import (Qt, QByteArray, QMetaObject, QObject,  # noqa
                           QVariant, QEventLoop, QTimer, QPoint, QTimer,
                           QThreadPool, QRunnable,
+                          QAbstractTableModel, QModelIndex,
                           pyqtSignal, pyqtSlot, QSize, QUrl,
                           QEvent, QCoreApplication,
                           qInstallMessageHandler,
                           )
 from PyQt5.QtGui import (  # noqa
-    QKeySequence, QIcon, QColor, QMouseEvent, QGuiApplication,
+    QKeySequence, QIcon, QColor, QBrush, QFont, QMouseEvent, QGuiApplication,
     QFontDatabase, QWindow, QOpenGLWindow)
 from PyQt5.QtWebEngineWidgets import (QWebEngineView,  # noqa
                                       QWebEnginePage,
@@ -49,7 +50,8 @@ from PyQt5.QtWidgets import (# noqa
     QPushButton, QLabel, QCheckBox, QPlainTextEdit,
     QLineEdit, QSlider, QSpinBox, QDoubleSpinBox,
     QMessageBox, QApplication, QMenuBar,
-    QInputDialog, QOpenGLWidget)
+    QInputDialog, QOpenGLWidget,
+    QTableView, QAbstractItemView, QHeaderView)
 
 # Enable high DPI support.
 # BUG: uncommenting this create scaling bugs on high DPI screens
@@ -540,6 +542,57 @@ class Worker(QRunnable):
             self.signals.finished.emit()
 
 
+class Prefetcher(object):
+    """Run function calls in the thread pool with a low priority, for example to warm up
+    caches, and cancel the pending calls when new calls are requested.
+
+    The calls are executed in sequence in a single task of the thread pool, which has a lower
+    priority than the default one, so that other tasks run first when the pool is busy.
+    A call that has already started is not interrupted.
+
+    Example
+    -------
+
+    ```python
+    p = Prefetcher()
+    p.prefetch([(print, ("hello",)), (print, ("world",))])
+    p.cancel()  # the calls that have not started yet are skipped
+    ```
+
+    """
+
+    priority = -1
+
+    def __init__(self):
+        self._generation = 0
+
+    def cancel(self):
+        """Cancel the pending calls."""
+        self._generation += 1
+
+    def _run(self, calls, generation):
+        for f, args in calls:
+            if generation != self._generation:
+                logger.log(5, "Prefetch cancelled.")
+                return
+            try:
+                f(*args)
+            except Exception as e:  # pragma: no cover
+                logger.debug("Prefetch error in %s%s: %s", f, args, e)
+
+    def prefetch(self, calls, run_in_thread=True):
+        """Cancel the pending calls, and run a list of `(function, args)` calls in a
+        background thread."""
+        self.cancel()
+        calls = list(calls)
+        if not calls:
+            return
+        if run_in_thread:
+            thread_pool().start(Worker(self._run, calls, self._generation), self.priority)
+        else:
+            self._run(calls, self._generation)
+
+
 class Debouncer(object):
     """Debouncer to work in a Qt application.
 
@@ -13,7 +13,7 @@ from ..qt import (
     QMessageBox, Qt, QWebEngineView, QTimer, _button_name_from_enum, _button_enum_from_name,
     prompt, screen_size, is_high_dpi, _wait_signal, require_qt, create_app, QApplication,
     WebView, busy_cursor, AsyncCaller, _wait, Worker, _block, screenshot, screenshot_default_path,
-    Debouncer, thread_pool)
+    Debouncer, Prefetcher, thread_pool)
 
 
 #------------------------------------------------------------------------------
@@ -65,6 +65,25 @@ def test_worker(qtbot):
     assert _l == [0]
 
 
+def test_prefetcher(qtbot):
+    p = Prefetcher()
+    _l = []
+
+    def f(i):  # pragma: no cover
+        _l.append(i)
+        if i == 1:
+            # Cancel the remaining calls.
+            p.cancel()
+
+    p.prefetch([(f, (0,)), (f, (1,)), (f, (2,))])
+    qtbot.waitUntil(lambda: _l == [0, 1])
+    _wait(10)
+    assert _l == [0, 1]
+
+    p.prefetch([(f, (3,))], run_in_thread=False)
+    assert _l == [0, 1, 3]
+
+
 def test_debouncer_1(qtbot):
     d = Debouncer(delay=50)
     _l = []
@@ -14,7 +14,8 @@ from phylib.utils import connect, unconnect
 from phylib.utils.testing import captured_logging
 import phy
 from .test_qt import _block
-from ..widgets import HTMLWidget, Table, Barrier, IPythonView, KeyValueWidget
+from ..widgets import (
+    HTMLWidget, Table, NativeTable, _TableRows, Barrier, IPythonView, KeyValueWidget)
 
 
 #------------------------------------------------------------------------------
@@ -413,3 +414,193 @@ def test_table_filter(qtbot, table):
 
     table.filter()
     _assert(table.get_ids, list(range(10)))
+
+
+#------------------------------------------------------------------------------
+# Test native table
+#------------------------------------------------------------------------------
+
+@yield_fixture
+def native_table(qtbot):
+    columns = ["id", "count"]
+    data = [{"id": i,
+             "count": 100 - 10 * i,
+             "float": float(i),
+             "is_masked": True if i in (2, 3, 5) else False,
+             } for i in range(10)]
+    table = NativeTable(
+        columns=columns,
+        value_names=['id', 'count', {'data': ['is_masked']}],
+        data=data)
+    _wait_until_table_ready(qtbot, table)
+
+    yield table
+
+    table.close()
+
+
+def test_native_table_empty_1(qtbot):
+    table = NativeTable()
+    _wait_until_table_ready(qtbot, table)
+    assert table.debouncer
+    _assert(table.get_ids, [])
+    _assert(table.get_next_id, None)
+    table.close()
+
+
+def test_native_table_1(qtbot, native_table):
+    table = native_table
+    assert table.is_ready()
+    _assert(table.get_selected, [])
+
+    _sel = []
+
+    @connect(sender=table)
+    def on_select(sender, obj):
+        _sel.append(obj)
+
+    table.select([1, 2, 1])
+    _assert(table.get_selected, [1, 2])
+    assert _sel == [{'selected': [1, 2], 'next': 4, 'kwargs': {}}]
+
+    table.scroll_to(8)
+    unconnect(on_select)
+
+
+def test_native_table_nav(qtbot, native_table):
+    table = native_table
+
+    table.previous()
+    _assert(table.get_selected, [0])
+    _assert(table.get_previous_id, None)
+
+    table.select([4])
+    table.next()
+    _assert(table.get_selected, [6])
+    table.previous()
+    _assert(table.get_selected, [4])
+
+    table.last()
+    _assert(table.get_selected, [9])
+    table.next()
+    _assert(table.get_selected, [9])
+
+
+def test_native_table_sort(qtbot, native_table):
+    table = native_table
+    table.select([1])
+    table.next()
+    table.next()
+    _assert(table.get_selected, [6])
+
+    _l = []
+
+    @connect(sender=table)
+    def on_table_sort(sender, row_ids):
+        _l.append(row_ids)
+
+    table.sort_by('count', 'asc')
+
+    _assert(table.get_current_sort, ['count', 'asc'])
+    _assert(table.get_selected, [6])
+    _assert(table.get_ids, list(range(9, -1, -1)))
+
+    table.next()
+    _assert(table.get_selected, [4])
+
+    table.sort_by('count', 'desc')
+    _assert(table.get_ids, list(range(10)))
+
+    assert _l == [list(range(9, -1, -1)), list(range(10))]
+    unconnect(on_table_sort)
+
+
+def test_native_table_add_change_remove(qtbot, native_table):
+    table = native_table
+    _assert(table.get_ids, list(range(10)))
+
+    table.add({'id': 100, 'count': 1000})
+    _assert(table.get_ids, list(range(10)) + [100])
+
+    table.remove([0, 1])
+    _assert(table.get_ids, list(range(2, 10)) + [100])
+
+    _assert(partial(table.get, 100), {'id': 100, 'count': 1000})
+    table.change([{'id': 100, 'count': 2000}])
+    _assert(partial(table.get, 100), {'id': 100, 'count': 2000})
+
+    table.remove_all_and_add({"id": 1000})
+    _assert(table.get_ids, [1000])
+
+    table.remove_all()
+    _assert(table.get_ids, [])
+
+
+def test_native_table_change_and_sort(qtbot, native_table):
+    table = native_table
+    table.sort_by('count', 'asc')
+    _assert(table.get_ids, list(range(9, -1, -1)))
+
+    # Check that the table is automatically resorted after a change.
+    table.change([{'id': 5, 'count': 1000}])
+    _assert(table.get_ids, [9, 8, 7, 6, 4, 3, 2, 1, 0, 5])
+
+
+def test_native_table_filter(qtbot, native_table):
+    table = native_table
+    table.filter("id == 5")
+    _assert(table.get_ids, [5])
+
+    table.filter("count == 80 || (id >= 8 && !is_masked)")
+    _assert(table.get_ids, [2, 8, 9])
+
+    # Invalid expressions keep all rows.
+    table.filter("count ==")
+    _assert(table.get_ids, list(range(10)))
+
+    table.filter()
+    _assert(table.get_ids, list(range(10)))
+
+
+def test_table_rows():
+    rows = _TableRows(['id', 'count'])
+    rows.add([{'id': i, 'count': 100 - 10 * i, 'is_masked': i == 2} for i in range(5)])
+    rows.set_order()
+    assert rows.displayed_ids() == [0, 1, 2, 3, 4]
+
+    rows.set_sort('count', 'asc')
+    rows.set_order()
+    assert rows.displayed_ids() == [4, 3, 2, 1, 0]
+
+    assert 'count' in rows.change([{'id': 4, 'count': 200}])
+    rows.remove([0])
+    rows.add({'id': 5, 'count': 75})
+    rows.set_order()
+    assert rows.displayed_ids() == [3, 5, 2, 1, 4]
+
+    rows.set_filter('count >= 75 && !is_masked')
+    rows.set_order()
+    assert rows.displayed_ids() == [5, 1, 4]
+    assert rows.get(2)['is_masked']
+
+
+def test_table_rows_set_displayed():
+    rows = _TableRows(['id', 'count'])
+    rows.add([{'id': i, 'count': 100 - 10 * i} for i in range(5)])
+    rows.set_sort('id', 'asc')
+    rows.set_order()
+
+    # Sort event sent by a view: the order and the sort are taken from the displayed ids.
+    rows.set_displayed([4, 3, 2, 1, 0])
+    assert rows.infer_sort() == ('id', 'desc')
+    rows.add({'id': 5, 'count': 0})
+    rows.set_order()
+    assert rows.displayed_ids() == [5, 4, 3, 2, 1, 0]
+
+    # Filter event sent by a view.
+    rows.set_displayed([5, 2], filtered=True)
+    assert rows.is_filtered
+    assert rows.displayed_ids() == [5, 2]
+    rows.change([{'id': 2, 'count': 1000}])
+    rows.set_order()
+    assert rows.displayed_ids() == [5, 2]
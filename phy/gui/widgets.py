@@ -10,13 +10,18 @@
 import json
 import logging
 from functools import partial
+import re
+
+import numpy as np
 
 from qtconsole.rich_jupyter_widget import RichJupyterWidget
 from qtconsole.inprocess import QtInProcessKernelManager
 
 from .qt import (
-    WebView, QObject, QWebChannel, QWidget, QGridLayout, QPlainTextEdit,
+    WebView, QObject, QWebChannel, QWidget, QGridLayout, QVBoxLayout, QPlainTextEdit,
     QLabel, QLineEdit, QCheckBox, QSpinBox, QDoubleSpinBox,
+    QAbstractTableModel, QModelIndex, QTableView, QAbstractItemView, QHeaderView,
+    QApplication, QBrush, QColor, QFont, QEvent, QTimer, Qt,
     pyqtSlot, _static_abs_path, _block, is_high_dpi, Debouncer)
 from phylib.utils import emit, connect
 from phy.utils.color import colormaps, _is_bright
@@ -556,6 +561,840 @@ class Table(HTMLWidget):
         """Get the current sort as a tuple `(name, dir)`."""
         self.eval_js('table._currentSort()', callback=callback)
 
+    def get_filter(self, callback=None):
+        """Get the current filter expression."""
+        self.eval_js('table.fel.value', callback=callback)
+
+
+# -----------------------------------------------------------------------------
+# Native table
+# -----------------------------------------------------------------------------
+
+def _is_number(value):
+    """Whether a value can be stored in a floating-point column."""
+    return (
+        isinstance(value, (int, float, np.integer, np.floating)) and
+        not isinstance(value, (bool, np.bool_)))
+
+
+def _numeric_array(values):
+    """Return the values as a NumPy array if they are all numbers, or None otherwise."""
+    try:
+        arr = np.asarray(values)
+    except ValueError:  # pragma: no cover
+        return
+    return arr if arr.dtype.kind in 'iuf' else None
+
+
+def _js_value(value):
+    """Convert numeric strings into numbers, like the Javascript comparisons."""
+    if isinstance(value, str):
+        try:
+            return float(value)
+        except ValueError:
+            return value
+    return value
+
+
+def _js_to_python(expr):
+    """Convert a Javascript filter expression, as accepted by the HTML table, into a Python
+    expression."""
+    expr = expr.replace('!==', '!=').replace('===', '==')
+    expr = expr.replace('&&', ' and ').replace('||', ' or ')
+    expr = re.sub(r'!(?!=)', ' not ', expr)
+    for js, py in (('true', 'True'), ('false', 'False'), ('null', 'None'), ('undefined', 'None')):
+        expr = re.sub(r'\b%s\b' % js, py, expr)
+    return expr.strip()
+
+
+def _sort_keys(values):
+    """Return the sort keys of a column: numbers if all values are numeric (including numeric
+    strings, like the similarity), strings otherwise."""
+    if values.dtype != object:
+        return values
+    try:
+        return np.array(
+            [np.nan if v is None or v == '' else float(v) for v in values], dtype=np.float64)
+    except (TypeError, ValueError):
+        return np.array(['' if v is None else str(v) for v in values])
+
+
+def _uniq_names(objects):
+    """Return the names of the fields of a list of dictionaries, by keeping the order."""
+    return list(dict.fromkeys(name for o in objects for name in o))
+
+
+class _TableRows(object):
+    """Rows of a table stored in NumPy columns, with the sort and filter semantics of the HTML
+    table. This class does not depend on Qt.
+
+    Like the items of the HTML table, rows are kept in a list where new rows are appended, and
+    that is reordered by a stable sort. The displayed rows are the rows of that list that
+    match the current filter.
+
+    """
+
+    def __init__(self, columns=None):
+        self.columns = columns or ['id']
+        self.sort = None  # current sort as a pair (name, dir)
+        self.is_filtered = False
+        self._filter = None  # compiled filter expression
+        self.clear()
+
+    def clear(self):
+        """Remove all rows."""
+        self.ids = np.zeros(0, dtype=np.int64)  # ids of the stored rows
+        self.values = {}  # mapping name => values of the stored rows
+        self._integer = {}  # mapping name => whether a numeric column only has integers
+        self._rows = {}  # mapping id => stored row
+        self._items = np.zeros(0, dtype=np.int64)  # stored rows, in list order
+        self._matching = np.zeros(0, dtype=bool)  # whether stored rows match the filter
+        self.order = np.zeros(0, dtype=np.int64)  # displayed stored rows
+        self._position = np.zeros(0, dtype=np.int64)  # display position of stored rows, or -1
+
+    # Values
+    # -------------------------------------------------------------------------
+
+    def value(self, name, row):
+        """Return the value of a stored row, or None if it is not set."""
+        arr = self.values.get(name, None)
+        if arr is None:
+            return
+        value = arr[row]
+        if arr.dtype == object:
+            return value
+        if np.isnan(value):
+            return
+        return int(value) if self._integer[name] else float(value)
+
+    def _to_object(self, name):
+        """Convert a numeric column into an object column."""
+        arr = self.values[name]
+        missing = np.isnan(arr)
+        obj = np.where(missing, 0, arr).astype(np.int64 if self._integer[name] else np.float64)
+        obj = obj.astype(object)
+        obj[missing] = None
+        self.values[name] = obj
+        return obj
+
+    def _set_values(self, name, rows, values):
+        """Set the values of some stored rows. A numeric column is converted into an object
+        column as soon as a non-numeric value is set."""
+        numeric = _numeric_array(values)
+        arr = self.values.get(name, None)
+        if arr is None:
+            arr = np.full(len(self.ids), np.nan if numeric is not None else None)
+            self.values[name] = arr
+            self._integer[name] = True
+        if (arr.dtype != object and numeric is None and
+                not all(v is None or _is_number(v) for v in values)):
+            arr = self._to_object(name)
+        if arr.dtype == object:
+            for row, value in zip(rows, values):
+                arr[row] = value
+        elif numeric is not None:
+            arr[rows] = numeric
+            self._integer[name] &= numeric.dtype.kind in 'iu'
+        else:
+            arr[rows] = [np.nan if v is None else v for v in values]
+            self._integer[name] &= all(
+                isinstance(v, (int, np.integer)) for v in values if v is not None)
+
+    def _set_objects(self, rows, objects):
+        """Set the values of some stored rows from a list of dictionaries."""
+        names = _uniq_names(objects)
+        for name in names:
+            self._set_values(name, rows, [o.get(name, None) for o in objects])
+        return names
+
+    def get(self, id):
+        """Return the values of a row, or None if there is no such row."""
+        row = self._rows.get(id, None)
+        if row is None:
+            return
+        out = {name: self.value(name, row) for name in self.values}
+        return {name: value for name, value in out.items() if value is not None}
+
+    def is_masked(self, id):
+        """Whether a row is masked (skipped when navigating through the rows)."""
+        row = self._rows.get(id, None)
+        return row is not None and self.value('is_masked', row) is True
+
+    # Rows
+    # -------------------------------------------------------------------------
+
+    def add(self, objects):
+        """Add rows. Rows with an id that already exists are changed instead."""
+        if isinstance(objects, dict):
+            objects = [objects]
+        new = {}
+        for o in objects:
+            if o['id'] not in self._rows:
+                new[o['id']] = o
+        existing = [o for o in objects if o['id'] not in new]
+        objects = list(new.values())
+        n, k = len(self.ids), len(objects)
+        if k:
+            rows = np.arange(n, n + k)
+            self.ids = np.concatenate([self.ids, np.array(list(new), dtype=np.int64)])
+            for name, arr in self.values.items():
+                fill = np.full(k, None if arr.dtype == object else np.nan, dtype=arr.dtype)
+                self.values[name] = np.concatenate([arr, fill])
+            self._set_objects(rows, objects)
+            self._rows.update(zip(new, rows.tolist()))
+            self._items = np.concatenate([self._items, rows])
+            self._matching = np.concatenate([self._matching, np.ones(k, dtype=bool)])
+            self._position = np.concatenate([self._position, np.full(k, -1)])
+            if self._filter is not None:
+                self._apply_filter(rows)
+        if existing:
+            self.change(existing)
+        self._sort_items()
+
+    def change(self, objects):
+        """Change some values of existing rows. Return the changed names."""
+        objects = [o for o in objects if o['id'] in self._rows]
+        if not objects:
+            return set()
+        rows = np.array([self._rows[o['id']] for o in objects], dtype=np.int64)
+        names = self._set_objects(rows, objects)
+        if self._filter is not None:
+            self._apply_filter(rows)
+        if self.sort and self.sort[0] in names:
+            self._sort_items()
+        return set(names)
+
+    def remove(self, ids):
+        """Remove the rows with the given ids."""
+        rows = [self._rows.pop(id) for id in ids if id in self._rows]
+        if not rows:
+            return
+        self._items = self._items[~np.isin(self._items, rows)]
+
+    def _compact(self):
+        """Remove the storage of deleted rows when they make up most of the arrays."""
+        if len(self.ids) <= 2 * len(self._rows) + 1024:
+            return
+        alive = np.sort(np.array(list(self._rows.values()), dtype=np.int64))
+        new_rows = np.full(len(self.ids), -1, dtype=np.int64)
+        new_rows[alive] = np.arange(len(alive))
+        self.ids = self.ids[alive]
+        self.values = {name: arr[alive] for name, arr in self.values.items()}
+        self._rows = {id: int(new_rows[row]) for id, row in self._rows.items()}
+        self._items = new_rows[self._items]
+        self._matching = self._matching[alive]
+        self.order = new_rows[self.order]
+        self._position = self._position[alive]
+
+    # Sort and filter
+    # -------------------------------------------------------------------------
+
+    def set_sort(self, name, sort_dir='asc'):
+        """Set the current sort and sort the rows."""
+        self.sort = (name, sort_dir)
+        self._sort_items()
+
+    def _sort_items(self):
+        """Stable sort of the list of rows according to the current sort."""
+        if not self.sort or self.sort[0] not in self.values or not len(self._items):
+            return
+        name, sort_dir = self.sort
+        keys = self._sort_keys(name, self._items)
+        idx = np.argsort(-keys if sort_dir == 'desc' else keys, kind='stable')
+        self._items = self._items[idx]
+
+    def _sort_keys(self, name, rows):
+        """Return the numeric sort keys of a column for some stored rows."""
+        keys = _sort_keys(self.values[name][rows])
+        if keys.dtype.kind != 'f':
+            keys = np.unique(keys, return_inverse=True)[1].ravel().astype(np.float64)
+        return keys
+
+    def _is_sorted(self, name, sort_dir, rows):
+        """Whether some stored rows are in the order of a sort, with missing values last."""
+        keys = self._sort_keys(name, rows)
+        missing = np.isnan(keys)
+        if np.any(np.diff(missing.astype(np.int8)) < 0):
+            return False
+        diff = np.diff(keys[~missing])
+        return bool(np.all(diff <= 0) if sort_dir == 'desc' else np.all(diff >= 0))
+
+    def infer_sort(self):
+        """Set the current sort from the order of the displayed rows, for example after a view
+        has been sorted and only sent the displayed ids. The current sort is kept if it is
+        consistent with that order. Return the current sort."""
+        candidates = []
+        if self.sort:
+            name, sort_dir = self.sort
+            candidates += [(name, sort_dir), (name, 'asc' if sort_dir == 'desc' else 'desc')]
+        candidates += [(name, d) for name in self.columns for d in ('asc', 'desc')]
+        for name, sort_dir in candidates:
+            if name in self.values and self._is_sorted(name, sort_dir, self.order):
+                self.sort = (name, sort_dir)
+                break
+        return self.sort
+
+    def set_filter(self, text):
+        """Filter the rows with an expression on the column names, like the Javascript
+        expressions of the HTML table."""
+        self._matching[:] = True
+        if not text:
+            self._filter = None
+            return
+        try:
+            self._filter = compile(_js_to_python(text), '<filter>', 'eval')
+        except SyntaxError:
+            # Like an invalid Javascript expression, all rows are kept.
+            self._filter = None
+            self.is_filtered = False
+            return
+        self._apply_filter(self._items)
+
+    def _apply_filter(self, rows):
+        """Evaluate the filter on some stored rows."""
+        # Names that are not in the table raise errors, but names of empty columns are None.
+        default = dict.fromkeys(self.columns + ['group'])
+        for row in rows:
+            ns = dict(default, **{
+                name: _js_value(self.value(name, row)) for name in self.values})
+            try:
+                out = bool(eval(self._filter, {'__builtins__': {}}, ns))
+                self.is_filtered = True
+            except TypeError:
+                # Comparisons with undefined values are false in Javascript.
+                out = False
+            except Exception:
+                out = True
+                self.is_filtered = False
+            self._matching[row] = out
+
+    def set_displayed(self, ids, filtered=False):
+        """Set the displayed rows from the ids sent by a view after a sort or a filter, in
+        display order. The displayed rows are moved to the start of the list of rows, and the
+        other rows no longer match.
+
+        If `filtered` is true, the view has been filtered with an expression that is not known
+        here: the current filter is dropped, and rows added later are displayed.
+
+        """
+        rows = np.array([self._rows[id] for id in ids if id in self._rows], dtype=np.int64)
+        self._items = np.concatenate([rows, self._items[~np.isin(self._items, rows)]])
+        self._matching[:] = False
+        self._matching[rows] = True
+        if filtered:
+            self._filter = None
+            self.is_filtered = True
+        self.set_order(rows)
+
+    def new_order(self):
+        """Return the displayed rows after a change in the rows, the sort, or the filter."""
+        return self._items[self._matching[self._items]]
+
+    def set_order(self, order=None):
+        """Set the displayed rows."""
+        self.order = self.new_order() if order is None else order
+        self._position = np.full(len(self.ids), -1, dtype=np.int64)
+        self._position[self.order] = np.arange(len(self.order))
+        self._compact()
+
+    # Positions
+    # -------------------------------------------------------------------------
+
+    def displayed_ids(self):
+        """Ids of the displayed rows."""
+        return self.ids[self.order].tolist()
+
+    def position(self, id):
+        """Display position of a row, or -1 if the row is not displayed."""
+        row = self._rows.get(id, None)
+        return -1 if row is None else int(self._position[row])
+
+    def id_at(self, position):
+        """Id of the row displayed at a given position, or None."""
+        if 0 <= position < len(self.order):
+            return int(self.ids[self.order[position]])
+
+
+class _TableModel(QAbstractTableModel):
+    """Qt table model displaying `_TableRows`."""
+
+    def __init__(self, columns, parent=None):
+        super(_TableModel, self).__init__(parent)
+        self.columns = columns
+        self.rows = _TableRows(columns)
+        self.selected = {}  # mapping id => selection index
+        self.selected_index_offset = 0
+        self.group_colors = {}  # mapping group => text color
+
+    def set_sort(self, name, sort_dir='asc'):
+        """Set the current sort and sort the rows."""
+        self.rows.set_sort(name, sort_dir)
+        self.headerDataChanged.emit(Qt.Horizontal, 0, len(self.columns) - 1)
+
+    def update_order(self):
+        """Update the displayed rows after a change in the rows, the sort, or the filter."""
+        order = self.rows.new_order()
+        if len(order) == len(self.rows.order) and np.array_equal(order, self.rows.order):
+            return False
+        if len(order) != len(self.rows.order):
+            self.beginResetModel()
+            self.rows.set_order(order)
+            self.endResetModel()
+        else:
+            self.layoutAboutToBeChanged.emit()
+            self.rows.set_order(order)
+            self.layoutChanged.emit()
+        return True
+
+    def reset(self, objects=()):
+        """Remove all rows and add new rows."""
+        self.beginResetModel()
+        self.rows.clear()
+        self.selected = {}
+        self.rows.add(objects)
+        self.rows.set_order()
+        self.endResetModel()
+
+    def rows_changed(self, ids):
+        """Notify the view that some rows need to be redrawn."""
+        for id in ids:
+            position = self.rows.position(id)
+            if position >= 0:
+                self.dataChanged.emit(
+                    self.index(position, 0), self.index(position, len(self.columns) - 1))
+
+    def set_selected(self, ids):
+        """Set the selected rows, in selection order."""
+        old = list(self.selected)
+        self.selected = {id: i for i, id in enumerate(ids)}
+        self.rows_changed(set(old) | set(ids))
+
+    # Qt model
+    # -------------------------------------------------------------------------
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows.order)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.columns)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation != Qt.Horizontal or role != Qt.DisplayRole:
+            return
+        name = self.columns[section]
+        sort = self.rows.sort
+        if sort and sort[0] == name:
+            name += ' ▲' if sort[1] == 'asc' else ' ▼'
+        return name
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return
+        rows = self.rows
+        row = rows.order[index.row()]
+        name = self.columns[index.column()]
+        if role == Qt.DisplayRole:
+            value = rows.value(name, row)
+            if value is None:
+                return ''
+            elif isinstance(value, (float, np.floating)):
+                return '%.2f' % value
+            elif isinstance(value, (bool, np.bool_)):
+                return 'true' if value else 'false'
+            return str(value)
+        selected = self.selected.get(int(rows.ids[row]), None)
+        color = None
+        if name == 'id' and selected is not None:
+            i = selected + self.selected_index_offset
+            if i < len(colormaps.default):
+                color = tuple(colormaps.default[i])
+        if role == Qt.BackgroundRole:
+            if color is not None:
+                return QBrush(QColor(*(int(255 * c) for c in color)))
+            elif selected is not None:
+                return QBrush(QColor('#444'))
+        elif role == Qt.ForegroundRole:
+            if color is not None:
+                return QBrush(QColor('#000' if _is_bright(color) else '#fff'))
+            group = rows.value('group', row)
+            if group in self.group_colors:
+                return QBrush(QColor(self.group_colors[group]))
+            elif rows.value('is_masked', row) is True:
+                return QBrush(QColor('#888'))
+        elif role == Qt.FontRole and name == 'id' and selected is not None:
+            font = QFont()
+            font.setBold(True)
+            return font
+
+
+class NativeTable(QWidget):
+    """A sortable table with support for selection, using a native Qt model/view rather than a
+    web view. The rows are stored in NumPy columns.
+
+    This table has the same Python interface, events, and semantics as `Table`: sortable
+    columns, a filter text box, single and multi selection of rows, and skippable rows.
+    The functions that take a callback call it immediately.
+
+    """
+
+    _ready = False
+
+    # Mapping between values of the `group` field and text colors of the rows.
+    _group_colors = {}
+
+    def __init__(
+            self, *args, columns=None, value_names=None, data=None, sort=None, title='',
+            debounce_events=()):
+        super(NativeTable, self).__init__(*args)
+        self.setWindowTitle(title)
+        self._debouncer = Debouncer()
+        self._debounce_events = debounce_events
+        self._is_busy = False
+        self._scroll = 0
+        self._model = None
+
+        self._filter_edit = QLineEdit(self)
+        self._filter_edit.setPlaceholderText('filter')
+        self._filter_edit.returnPressed.connect(
+            lambda: self._filter(self._filter_edit.text()))
+        self._filter_edit.installEventFilter(self)
+
+        self._view = QTableView(self)
+        self._view.setSelectionMode(QAbstractItemView.NoSelection)
+        self._view.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self._view.setShowGrid(False)
+        self._view.setWordWrap(False)
+        self._view.verticalHeader().hide()
+        # NOTE: fixed row heights so that the view does not measure all rows.
+        self._view.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
+        self._view.verticalHeader().setDefaultSectionSize(20)
+        self._view.horizontalHeader().setSectionsClickable(True)
+        self._view.horizontalHeader().sectionClicked.connect(self._on_header_clicked)
+        self._view.pressed.connect(self._on_pressed)
+        self.setStyleSheet('''
+            QWidget { background-color: black; color: white; font-size: 8pt; }
+            QHeaderView::section { background-color: black; color: white; border: 0; }
+        ''')
+
+        layout = QVBoxLayout(self)
+        layout.setContentsMargins(2, 2, 2, 2)
+        layout.addWidget(self._filter_edit)
+        layout.addWidget(self._view)
+        self.setLayout(layout)
+
+        self._init_table(columns=columns, value_names=value_names, data=data, sort=sort)
+
+    def _init_table(self, columns=None, value_names=None, data=None, sort=None):
+        """Build the table."""
+
+        columns = columns or ['id']
+        value_names = value_names or columns
+        data = data or []
+
+        self.data = data
+        self.columns = columns
+        self.value_names = value_names
+
+        if self._model is not None:
+            self._model.deleteLater()
+        self._model = _TableModel(columns, parent=self)
+        self._model.group_colors = self._group_colors
+        self._model.rows.add(data)
+        if sort and sort[0]:
+            self._model.set_sort(*sort)
+        self._model.update_order()
+        self._view.setModel(self._model)
+        self._model.modelAboutToBeReset.connect(self._save_scroll)
+        self._model.modelReset.connect(self._restore_scroll)
+        self._selected = []
+
+        # Like the HTML table, the ready event is emitted once the event loop has run.
+        self._ready = False
+        QTimer.singleShot(0, self._set_ready)
+
+    def _set_ready(self):
+        """Set the widget as ready."""
+        self._ready = True
+        emit('ready', self)
+
+    def is_ready(self):
+        """Whether the widget has been fully loaded."""
+        return self._ready
+
+    @property
+    def debouncer(self):
+        """Widget debouncer."""
+        return self._debouncer
+
+    def _emit(self, name, data):
+        """Emit an event, debounced if needed."""
+        logger.log(5, "Emit from native table %s %s.", name, data)
+        if name in self._debounce_events:
+            self._debouncer.submit(emit, name, self, data)
+        else:
+            emit(name, self, data)
+
+    def _return(self, out, callback):
+        """Pass the output of a function to its callback."""
+        if callback is not None:
+            callback(out)
+        return out
+
+    # Qt events
+    # -------------------------------------------------------------------------
+
+    def eventFilter(self, obj, event):
+        """Clear the filter when pressing Escape in the filter text box."""
+        if (obj == self._filter_edit and event.type() == QEvent.KeyPress and
+                event.key() == Qt.Key_Escape):
+            self.filter('')
+            return True
+        return super(NativeTable, self).eventFilter(obj, event)
+
+    def _on_pressed(self, index):
+        """Select rows when clicking, with support for ctrl and shift clicks."""
+        id = self._model.rows.id_at(index.row())
+        if id is None:  # pragma: no cover
+            return
+        modifiers = QApplication.keyboardModifiers()
+        if modifiers & (Qt.ControlModifier | Qt.MetaModifier):
+            self._select_toggle(id)
+        elif modifiers & Qt.ShiftModifier:
+            self._select_until(id)
+        else:
+            self._select([id])
+
+    def _on_header_clicked(self, section):
+        """Sort by a column when clicking on its header."""
+        name = self.columns[section]
+        sort = self._model.rows.sort
+        self.sort_by(name, 'desc' if sort == (name, 'asc') else 'asc')
+
+    def _save_scroll(self):
+        self._scroll = self._view.verticalScrollBar().value()
+
+    def _restore_scroll(self):
+        self._view.verticalScrollBar().setValue(self._scroll)
+
+    # Selection
+    # -------------------------------------------------------------------------
+
+    def _selection(self):
+        """Selected rows that are currently displayed, in selection order."""
+        return [id for id in self._selected if self._model.rows.position(id) >= 0]
+
+    def _set_selection(self, ids):
+        self._selected = ids
+        self._model.set_selected(ids)
+
+    def _emit_selected(self, kwargs=None):
+        """Emit the select event and return the selection."""
+        selected = self._selection()
+        next_id = self._sibling_id(selected[-1]) if selected else None
+
+        # NOTE: the event and the caller receive different objects, like the objects
+        # deserialized from JSON with the HTML table.
+        def _obj():
+            obj = {'selected': list(selected), 'next': next_id}
+            if kwargs is not None:
+                obj['kwargs'] = dict(kwargs)
+            return obj
+
+        self._emit('select', _obj())
+        return _obj()
+
+    def _select(self, ids, kwargs=None):
+        self._set_selection([id for id in _uniq(ids) if self._model.rows.position(id) >= 0])
+        return self._emit_selected(kwargs)
+
+    def _select_toggle(self, id):
+        selected = self._selection()
+        if id in selected:
+            selected.remove(id)
+        else:
+            selected.append(id)
+        self._set_selection(selected)
+        return self._emit_selected()
+
+    def _select_until(self, id):
+        """Select all rows between the last selected row and a given row."""
+        selected = self._selection()
+        clicked = self._model.rows.position(id)
+        positions = [self._model.rows.position(_) for _ in selected]
+        last = max(positions) if positions else 0
+        for position in range(min(clicked, last), max(clicked, last) + 1):
+            id_ = self._model.rows.id_at(position)
+            if id_ is not None and id_ not in selected:
+                selected.append(id_)
+        self._set_selection(selected)
+        return self._emit_selected()
+
+    def _sibling_id(self, id=None, dir='next'):
+        """Return the id of the next or previous non-masked row."""
+        if id is None:
+            selected = self._selection()
+            id = selected[0] if selected else None
+        if id is None:
+            return
+        position = self._model.rows.position(id)
+        if position < 0:
+            return
+        step = 1 if dir == 'next' else -1
+        while True:
+            position += step
+            id = self._model.rows.id_at(position)
+            if id is None or not self._model.rows.is_masked(id):
+                return id
+
+    def _select_first(self, dir='next'):
+        """Select the first (or last) non-masked row."""
+        if not len(self._model.rows.order):
+            return
+        id = self._model.rows.id_at(0 if dir == 'next' else len(self._model.rows.order) - 1)
+        if self._model.rows.is_masked(id):
+            id = self._sibling_id(id, dir)
+        self._select([id] if id is not None else [])
+
+    def _move_to_sibling(self, dir='next'):
+        if not self._selection():
+            return self._select_first()
+        id = self._sibling_id(None, dir)
+        if id is None:
+            return
+        return self._select([id])
+
+    # Public methods
+    # -------------------------------------------------------------------------
+
+    def sort_by(self, name, sort_dir='asc'):
+        """Sort by a given variable."""
+        logger.log(5, "Sort by `%s` %s.", name, sort_dir)
+        self._model.set_sort(name, sort_dir)
+        self._model.update_order()
+        self._emit('table_sort', self._model.rows.displayed_ids())
+
+    def filter(self, text=''):
+        """Filter the view with an expression on the column names, using the Javascript syntax
+        of the HTML table."""
+        logger.log(5, "Filter table with `%s`.", text)
+        self._filter_edit.setText(text)
+        self._filter(text)
+
+    def _filter(self, text):
+        self._model.rows.set_filter(text)
+        self._model.update_order()
+        if self._model.rows.is_filtered:
+            self._emit('table_filter', self._model.rows.displayed_ids())
+
+    def get_ids(self, callback=None):
+        """Get the list of ids."""
+        return self._return(self._model.rows.displayed_ids(), callback)
+
+    def get_next_id(self, callback=None):
+        """Get the next non-skipped row id."""
+        return self._return(self._sibling_id(None, 'next'), callback)
+
+    def get_previous_id(self, callback=None):
+        """Get the previous non-skipped row id."""
+        return self._return(self._sibling_id(None, 'previous'), callback)
+
+    def first(self, callback=None):
+        """Select the first item."""
+        return self._return(self._select_first('next'), callback)
+
+    def last(self, callback=None):
+        """Select the last item."""
+        return self._return(self._select_first('previous'), callback)
+
+    def next(self, callback=None):
+        """Select the next non-skipped row."""
+        return self._return(self._move_to_sibling('next'), callback)
+
+    def previous(self, callback=None):
+        """Select the previous non-skipped row."""
+        return self._return(self._move_to_sibling('previous'), callback)
+
+    def select(self, ids, callback=None, **kwargs):
+        """Select some rows in the table from Python.
+
+        This raises the same select event as when the user selects rows directly in the view.
+
+        """
+        ids = _uniq(ids)
+        assert all(_is_integer(_) for _ in ids)
+        return self._return(self._select(ids, kwargs), callback)
+
+    def scroll_to(self, id):
+        """Scroll until a given row is visible."""
+        position = self._model.rows.position(id)
+        if position >= 0:
+            self._view.scrollTo(self._model.index(position, 0))
+
+    def set_busy(self, busy):
+        """Set the busy state of the GUI."""
+        self._is_busy = busy
+
+    def set_selected_index_offset(self, n):
+        """Set the index of the first selected row, used for the selection colors."""
+        self._model.selected_index_offset = n
+        self._model.rows_changed(self._selected)
+
+    def get(self, id, callback=None):
+        """Get the object given its id."""
+        return self._return(self._model.rows.get(id), callback)
+
+    def add(self, objects):
+        """Add objects object to the table."""
+        if not objects:
+            return
+        if isinstance(objects, dict):
+            objects = [objects]
+        self._model.rows.add(objects)
+        self._model.update_order()
+
+    def change(self, objects):
+        """Change some objects."""
+        if not objects:
+            return
+        names = self._model.rows.change(objects)
+        if not self._model.update_order() and names:
+            self._model.rows_changed([o['id'] for o in objects])
+
+    def remove(self, ids):
+        """Remove some objects from their ids."""
+        if not ids:
+            return
+        self._model.rows.remove(ids)
+        self._model.update_order()
+        self._set_selection(self._selection())
+
+    def remove_all(self):
+        """Remove all rows in the table."""
+        self._selected = []
+        self._model.reset()
+
+    def remove_all_and_add(self, objects):
+        """Remove all rows in the table and add new objects."""
+        if not objects:
+            return self.remove_all()
+        if isinstance(objects, dict):
+            objects = [objects]
+        self._selected = []
+        self._model.reset(objects)
+
+    def get_selected(self, callback=None):
+        """Get the currently selected rows."""
+        return self._return(self._selection(), callback)
+
+    def get_current_sort(self, callback=None):
+        """Get the current sort as a tuple `(name, dir)`."""
+        sort = self._model.rows.sort
+        return self._return(list(sort) if sort else None, callback)
+
+    def get_filter(self, callback=None):
+        """Get the current filter expression."""
+        return self._return(self._filter_edit.text(), callback)
+
 
 # -----------------------------------------------------------------------------
 # KeyValueWidget
@@ -12,7 +12,11 @@ import logging
 import os
 from pathlib import Path
 from pickle import dump, load
+from threading import Event, Lock
 
+import numpy as np
+
+from phylib.utils import Bunch
 from phylib.utils._misc import save_json, load_json, load_pickle, save_pickle, _fullname
 from .config import phy_config_dir, ensure_dir_exists
 
@@ -33,6 +37,56 @@ def _cache_methods(obj, memcached, cached):  # pragma: no cover
         setattr(obj, name, obj.context.cache(f))
 
 
+def _flight_key(args, kwargs):
+    """Return a hashable key for the arguments of a call, or None if they are not hashable."""
+    key = (args, tuple(sorted(kwargs.items()))) if kwargs else args
+    try:
+        hash(key)
+    except TypeError:
+        return None
+    return key
+
+
+class SingleFlight(object):
+    """Deduplicate concurrent calls with the same key.
+
+    The first caller of a key runs the function, whereas the callers with the same key that
+    arrive while it is running wait for its result (or its exception) instead of running the
+    function again.
+
+    """
+
+    def __init__(self):
+        self._lock = Lock()
+        # Running calls, as `{key: Bunch(done, result, error)}`.
+        self._calls = {}
+
+    def do(self, key, f, *args, **kwargs):
+        """Call `f(*args, **kwargs)`, or wait for the running call with the same key."""
+        if key is None:
+            return f(*args, **kwargs)
+        with self._lock:
+            call = self._calls.get(key, None)
+            is_running = call is not None
+            if not is_running:
+                call = self._calls[key] = Bunch(done=Event(), result=None, error=None)
+        if is_running:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = f(*args, **kwargs)
+        except Exception as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result
+
+
 class Context(object):
     """Handle function disk and memory caching with joblib.
 
@@ -72,6 +126,10 @@ class Context(object):
     """Maximum cache size, in bytes."""
     cache_limit = 2 * 1024 ** 3  # 2 GB
 
+    # NOTE: the cached functions may be called concurrently from several threads, for example
+    # by views updated in the Qt thread pool. Concurrent calls with the same arguments are
+    # deduplicated, so that the function is only called once.
+
     def __init__(self, cache_dir, verbose=0):
         self.verbose = verbose
         # Make sure the cache directory exists.
@@ -87,6 +145,7 @@ class Context(object):
 
         self._set_memory(self.cache_dir)
         self._memcache = {}
+        self._lock = Lock()
 
     def _set_memory(self, cache_dir):
         """Create the joblib Memory instance."""
@@ -117,7 +176,15 @@ class Context(object):
         else:
             ignore = None
         disk_cached = self._memory.cache(f, ignore=ignore)
-        return disk_cached
+        flight = SingleFlight()
+
+        @wraps(f)
+        def cached(*args, **kwargs):
+            """Cache the function on disk."""
+            return flight.do(_flight_key(args, kwargs), disk_cached, *args, **kwargs)
+        # Whether the result of a call is in the cache.
+        cached.check_call_in_cache = disk_cached.check_call_in_cache
+        return cached
 
     def load_memcache(self, name):
         """Load the memcache from disk (pickle file), if it exists."""
@@ -133,9 +200,11 @@ class Context(object):
 
     def save_memcache(self):
         """Save the memcache to disk using pickle."""
-        for name, cache in self._memcache.items():
+        for name, cache in list(self._memcache.items()):
             path = self.cache_dir / 'memcache' / (name + '.pkl')
             logger.debug("Save memcache for `%s`.", name)
+            with self._lock:
+                cache = cache.copy()
             with open(str(path), 'wb') as fd:
                 dump(cache, fd)
 
@@ -143,6 +212,16 @@ class Context(object):
         """Cache a function in memory using an internal dictionary."""
         name = _fullname(f)
         cache = self.load_memcache(name)
+        flight = SingleFlight()
+
+        def compute(h, *args, **kwargs):
+            # The result may have been cached by another thread in the meantime.
+            out = cache.get(h, None)
+            if out is None:
+                out = f(*args, **kwargs)
+                with self._lock:
+                    cache[h] = out
+            return out
 
         @wraps(f)
         def memcached(*args, **kwargs):
@@ -151,13 +230,12 @@ class Context(object):
             h = args
             out = cache.get(h, None)
             if out is None:
-                out = f(*args, **kwargs)
-                cache[h] = out
+                out = flight.do(h, compute, h, *args, **kwargs)
             return out
         return memcached
 
     def _get_path(self, name, location, file_ext='.json'):
-        """Get the path to the cache file."""
+        """Get the path to the cache file (or directory if `file_ext` is empty)."""
         if location == 'local':
             return self.cache_dir / (name + file_ext)
         elif location == 'global':
@@ -176,9 +254,12 @@ class Context(object):
         location : str
             Can be `local` or `global`.
         kind : str
-            Can be `json` or `pickle`.
+            Can be `json`, `pickle`, or `npy`. With `npy`, data is a dictionary of NumPy arrays
+            saved as one `.npy` file per key in a `name` subdirectory.
 
         """
+        if kind == 'npy':
+            return self._save_arrays(self._get_path(name, location, file_ext=''), data)
         file_ext = '.json' if kind == 'json' else '.pkl'
         path = self._get_path(name, location, file_ext=file_ext)
         ensure_dir_exists(path.parent)
@@ -188,6 +269,23 @@ class Context(object):
         else:
             save_pickle(path, data)
 
+    def _save_arrays(self, path, arrays):
+        """Save a dictionary of arrays as `.npy` files in a directory."""
+        ensure_dir_exists(path)
+        logger.debug("Save arrays to `%s`.", path)
+        for key, arr in arrays.items():
+            # NOTE: write to a temporary file first, so that existing files that may be
+            # memory-mapped are replaced and not overwritten in place.
+            tmp_path = path / (key + '.npy.tmp')
+            with open(str(tmp_path), 'wb') as f:
+                np.save(f, np.asarray(arr))
+            os.replace(str(tmp_path), str(path / (key + '.npy')))
+
+    def _load_arrays(self, path):
+        """Load a dictionary of memory-mapped arrays saved with `_save_arrays()`."""
+        logger.debug("Load arrays from `%s`.", path)
+        return {p.stem: np.load(str(p), mmap_mode='r') for p in sorted(path.glob('*.npy'))}
+
     def load(self, name, location='local'):
         """Load a dictionary saved in the cache directory.
 
@@ -203,6 +301,9 @@ class Context(object):
         path = self._get_path(name, location, file_ext='.json')
         if path.exists():
             return load_json(path)
+        path = self._get_path(name, location, file_ext='')
+        if path.is_dir():
+            return self._load_arrays(path)
         path = self._get_path(name, location, file_ext='.pkl')
         if path.exists():
             return load_pickle(path)
@@ -213,10 +314,12 @@ class Context(object):
         """Make sure that this class is picklable."""
         state = self.__dict__.copy()
         state['_memory'] = None
+        state['_lock'] = None
         return state
 
     def __setstate__(self, state):
         """Make sure that this class is picklable."""
         self.__dict__ = state
+        self._lock = Lock()
         # Recreate the joblib Memory instance.
         self._set_memory(state['cache_dir'])
@@ -7,13 +7,15 @@
 #------------------------------------------------------------------------------
 
 from pickle import dump, load
+from threading import Event, Thread
+from time import sleep
 
 import numpy as np
 from numpy.testing import assert_array_equal as ae
 from pytest import fixture, yield_fixture
 
 from phylib.io.array import write_array, read_array
-from ..context import Context, _fullname
+from ..context import Context, SingleFlight, _fullname
 
 
 #------------------------------------------------------------------------------
@@ -62,6 +64,21 @@ def test_context_load_save_pickle(tempdir, context, temp_phy_config_dir):
     ae(context.load('arr'), arr)
 
 
+def test_context_load_save_npy(tempdir, context, temp_phy_config_dir):
+    arrs = {'a': np.arange(10), 'b': np.random.rand(3, 2)}
+    context.save('arrs', arrs, kind='npy')
+    loaded = context.load('arrs')
+    assert sorted(loaded) == ['a', 'b']
+    ae(loaded['a'], arrs['a'])
+    ae(loaded['b'], arrs['b'])
+    assert isinstance(loaded['a'], np.memmap)
+
+    # Overwrite arrays that are currently memory-mapped.
+    context.save('arrs', {'a': np.arange(5)}, kind='npy')
+    ae(loaded['a'], arrs['a'])
+    ae(context.load('arrs')['a'], np.arange(5))
+
+
 def test_context_cache(context):
 
     _res = []
@@ -145,6 +162,101 @@ def test_context_memcache(tempdir, context):
     assert len(_res) == 1
 
 
+def _call_concurrently(f, args, started, n=4):
+    """Call a function from several threads, the other calls are made while the first one
+    is running."""
+    out = []
+    threads = [Thread(target=lambda: out.append(f(*args))) for _ in range(n)]
+    threads[0].start()
+    started.wait()
+    for thread in threads[1:]:
+        thread.start()
+    # Let the other threads reach the point where they wait for the first call.
+    sleep(.1)
+    return threads, out
+
+
+def test_single_flight():
+    flight = SingleFlight()
+    _res = []
+    started, release = Event(), Event()
+
+    def f(x):
+        _res.append(x)
+        started.set()
+        release.wait()
+        if x < 0:
+            raise ValueError(x)
+        return x ** 2
+
+    threads, out = _call_concurrently(lambda x: flight.do(x, f, x), (3,), started)
+    # Calls without a key are not deduplicated.
+    assert flight.do(None, lambda: 1) == 1
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert out == [9] * 4
+    assert _res == [3]
+    assert not flight._calls
+
+    # The exceptions are raised in all waiting callers.
+    started.clear()
+    release.clear()
+    errors = []
+
+    def g(x):
+        try:
+            flight.do(x, f, x)
+        except ValueError as e:
+            errors.append(e)
+
+    threads, _ = _call_concurrently(g, (-1,), started)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert len(errors) == 4
+    assert _res == [3, -1]
+
+
+def test_context_memcache_threads(context):
+    _res = []
+    started, release = Event(), Event()
+
+    @context.memcache
+    def f(x):
+        _res.append(x)
+        started.set()
+        release.wait()
+        return x ** 2
+
+    threads, out = _call_concurrently(f, (10,), started)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert out == [100] * 4
+    assert _res == [10]
+    context.save_memcache()
+
+
+def test_context_cache_threads(context):
+    _res = []
+    started, release = Event(), Event()
+
+    def f(x):
+        _res.append(x)
+        started.set()
+        release.wait()
+        return x ** 2
+
+    f = context.cache(f)
+    threads, out = _call_concurrently(f, (10,), started)
+    release.set()
+    for thread in threads:
+        thread.join()
+    assert out == [100] * 4
+    assert _res == [10]
+
+
 def test_pickle_cache(tempdir, context):
     """Make sure the Context is picklable."""
     with open(tempdir / 'test.pkl', 'wb') as f: